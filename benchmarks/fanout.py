@@ -0,0 +1,108 @@
+"""
+Broadcast fan-out through a local MessageDirector.
+
+A number of downstream services subscribe to one zone channel and a sender floods that channel with field
+updates. The MD has to write every update to every receiver, so this measures the outbound path of
+OTPProtocol. The number of transport writes the MD made is reported next to the number of frames.
+
+Usage: python -m benchmarks.fanout [receivers] [messages]
+"""
+
+import asyncio
+import sys
+import time
+
+from dc.util import Datagram
+
+from otp.messagedirector import MasterMessageDirector, MDProtocol
+from otp.messagetypes import STATESERVER_OBJECT_UPDATE_FIELD
+from otp.zone import location_as_channel
+
+from benchmarks.latency import BenchService, HOST
+
+
+PORT = 57101
+
+SENDER_CHANNEL = 1000
+ZONE_CHANNEL = location_as_channel(4618, 2000)
+
+
+class CountingMDProtocol(MDProtocol):
+    writes = 0
+    frames = 0
+
+    def flush(self):
+        if self.outgoing_size and self.transport is not None:
+            CountingMDProtocol.writes += 1
+            CountingMDProtocol.frames += sum(self.lane_depths())
+        MDProtocol.flush(self)
+
+
+class CountingMessageDirector(MasterMessageDirector):
+    downstream_protocol = CountingMDProtocol
+
+
+class Receiver(BenchService):
+    def __init__(self, loop, channel, expected):
+        BenchService.__init__(self, loop, channel)
+        self.count = 0
+        self.expected = expected
+        self.done = loop.create_future()
+
+    def receive(self, sender, msg_type, dgi):
+        self.count += 1
+        if self.count == self.expected:
+            self.done.set_result(time.perf_counter())
+
+
+class Sender(BenchService):
+    def receive(self, sender, msg_type, dgi):
+        pass
+
+
+async def main(receiver_count, messages):
+    loop = asyncio.get_running_loop()
+
+    md = CountingMessageDirector(loop)
+    loop.create_task(md.route())
+    loop.create_task(md.listen(HOST, PORT))
+    await asyncio.sleep(0.1)
+
+    receivers = [Receiver(loop, ZONE_CHANNEL, messages) for _ in range(receiver_count)]
+    for receiver in receivers:
+        await receiver.connect(HOST, PORT)
+        loop.create_task(receiver.route())
+        await receiver.connected
+
+    sender = Sender(loop, SENDER_CHANNEL)
+    await sender.connect(HOST, PORT)
+    await sender.connected
+    await asyncio.sleep(0.1)
+
+    CountingMDProtocol.writes = CountingMDProtocol.frames = 0
+
+    start = time.perf_counter()
+    for i in range(messages):
+        dg = Datagram()
+        dg.add_server_header([ZONE_CHANNEL], SENDER_CHANNEL, STATESERVER_OBJECT_UPDATE_FIELD)
+        dg.add_uint32(100000000 + i)
+        dg.add_uint16(0)
+        dg.add_bytes(b'\x00' * 24)
+        sender.send_datagram(dg)
+
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+
+    end = max(await asyncio.gather(*(receiver.done for receiver in receivers)))
+    delivered = receiver_count * messages
+    elapsed = end - start
+
+    print(f'{messages} messages to {receiver_count} receivers: {delivered} deliveries in {elapsed:.3f} s')
+    print(f'{delivered / elapsed:.0f} deliveries/sec')
+    print(f'MD writes: {CountingMDProtocol.writes} for {CountingMDProtocol.frames} frames '
+          f'({CountingMDProtocol.frames / max(CountingMDProtocol.writes, 1):.1f} frames per write)')
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    asyncio.run(main(*args) if args else main(50, 2000))
@@ -0,0 +1,271 @@
+"""
+MessageDirector throughput suite.
+
+Starts a MasterMessageDirector on localhost with a number of synthetic downstream participants and drives a set of
+workloads through it:
+
+    unicast    every message is addressed to one participant
+    broadcast  every message is addressed to a zone channel all participants subscribe to
+    multicast  every message is addressed to RECIPIENTS participants in one header
+    churn      unicast, while a participant subscribes to a new zone channel and drops an old one per message
+
+For every workload it reports msgs/sec and deliveries/sec, the p50/p99 latency from send to delivery, the p50/p99
+time the MD spent routing a datagram (process_datagram) and the bytes the MD copied per message, counting both
+what it read off its sockets and what it queued for writing.
+
+Usage: python -m benchmarks.harness [participants] [messages] [workload ...]
+"""
+
+import asyncio
+import sys
+import time
+from dataclasses import dataclass
+from typing import Dict, List
+
+from dc.util import Datagram
+
+from otp.messagedirector import MasterMessageDirector, MDProtocol
+from otp.messagetypes import STATESERVER_OBJECT_UPDATE_FIELD
+from otp.zone import location_as_channel
+
+from benchmarks.latency import BenchService, HOST
+
+
+PORT = 57104
+
+BASE_CHANNEL = 1000
+ZONE_CHANNEL = location_as_channel(4618, 2000)
+CHURN_PARENT = 4619
+
+RECIPIENTS = 5
+CHURN_WINDOW = 1000
+BURST = 100
+
+
+@dataclass
+class Result:
+    workload: str
+    messages: int
+    deliveries: int
+    elapsed: float
+    latency: List[float]
+    route_time: List[float]
+    bytes_copied: int
+
+    def __str__(self):
+        return (f'{self.workload:>10}: {self.messages / self.elapsed:8.0f} msgs/sec '
+                f'{self.deliveries / self.elapsed:8.0f} deliveries/sec | '
+                f'latency p50 {percentile(self.latency, 0.5):7.3f} ms p99 {percentile(self.latency, 0.99):7.3f} ms | '
+                f'route p50 {percentile(self.route_time, 0.5) * 1000:6.1f} us '
+                f'p99 {percentile(self.route_time, 0.99) * 1000:6.1f} us | '
+                f'{self.bytes_copied / self.messages:6.1f} bytes copied/msg')
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class MeteredMDProtocol(MDProtocol):
+    def data_received(self, data: bytes):
+        self.service.bytes_copied += len(data)
+        MDProtocol.data_received(self, data)
+
+    def send_frame(self, frame: bytes, lane=None):
+        self.service.bytes_copied += len(frame)
+        MDProtocol.send_frame(self, frame, lane)
+
+
+class MeteredMessageDirector(MasterMessageDirector):
+    downstream_protocol = MeteredMDProtocol
+
+    def __init__(self, loop):
+        MasterMessageDirector.__init__(self, loop)
+        self.bytes_copied = 0
+        self.route_times = []
+
+    def reset(self):
+        self.bytes_copied = 0
+        self.route_times = []
+
+    def process_datagram(self, participant, dg):
+        start = time.perf_counter_ns()
+        MasterMessageDirector.process_datagram(self, participant, dg)
+        self.route_times.append((time.perf_counter_ns() - start) / 1e6)
+
+
+class Participant(BenchService):
+    def __init__(self, loop, channel, harness):
+        BenchService.__init__(self, loop, channel)
+        self.harness = harness
+
+    def receive(self, sender, msg_type, dgi):
+        self.harness.delivered(dgi.get_uint64())
+
+
+class Workload:
+    name = None
+
+    def __init__(self, participants: List[Participant]):
+        self.participants = participants
+
+    def setup(self) -> Dict[int, int]:
+        """Subscribes what the workload needs, returns the number of subscribers to wait for per channel."""
+        return {}
+
+    def teardown(self):
+        pass
+
+    def recipients(self, i: int) -> List[int]:
+        raise NotImplementedError
+
+    def before_send(self, i: int):
+        pass
+
+
+class Unicast(Workload):
+    name = 'unicast'
+
+    def recipients(self, i):
+        return [self.participants[i % len(self.participants)].channel]
+
+
+class Broadcast(Workload):
+    name = 'broadcast'
+
+    def setup(self):
+        for participant in self.participants:
+            participant.subscribe_channel(participant._client, ZONE_CHANNEL)
+        return {ZONE_CHANNEL: len(self.participants)}
+
+    def teardown(self):
+        for participant in self.participants:
+            participant.unsubscribe_channel(participant._client, ZONE_CHANNEL)
+
+    def recipients(self, i):
+        return [ZONE_CHANNEL]
+
+
+class Multicast(Workload):
+    name = 'multicast'
+
+    def recipients(self, i):
+        count = min(RECIPIENTS, len(self.participants))
+        return [self.participants[(i + k) % len(self.participants)].channel for k in range(count)]
+
+
+class Churn(Unicast):
+    name = 'churn'
+
+    def before_send(self, i):
+        participant = self.participants[i % len(self.participants)]
+        participant.subscribe_channel(participant._client, location_as_channel(CHURN_PARENT, i))
+
+        if i >= CHURN_WINDOW:
+            old = self.participants[(i - CHURN_WINDOW) % len(self.participants)]
+            old.unsubscribe_channel(old._client, location_as_channel(CHURN_PARENT, i - CHURN_WINDOW))
+
+    def teardown(self):
+        for participant in self.participants:
+            for channel in list(participant._client.channels):
+                if channel != participant.channel:
+                    participant.unsubscribe_channel(participant._client, channel)
+
+
+WORKLOADS = {workload.name: workload for workload in (Unicast, Broadcast, Multicast, Churn)}
+
+
+class Harness:
+    def __init__(self, loop, participant_count: int, port: int = PORT):
+        self.loop = loop
+        self.port = port
+        self.md = MeteredMessageDirector(loop)
+        self.participants = [Participant(loop, BASE_CHANNEL + i, self) for i in range(participant_count)]
+        self.tasks = []
+
+        self.expected = 0
+        self.received = 0
+        self.latency = []
+        self.done = None
+
+    async def start(self):
+        self.tasks.append(self.loop.create_task(self.md.route()))
+        self.tasks.append(self.loop.create_task(self.md.listen(HOST, self.port)))
+        while self.md._server is None or not self.md._server.is_serving():
+            await asyncio.sleep(0.01)
+
+        for participant in self.participants:
+            await participant.run(self.port)
+        await self.subscribed({participant.channel: 1 for participant in self.participants})
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def subscribed(self, channels: Dict[int, int]):
+        while any(len(self.md.channel_subscriptions.lookup(channel)) < count for channel, count in channels.items()):
+            await asyncio.sleep(0.01)
+
+    def delivered(self, sent):
+        self.latency.append((time.perf_counter_ns() - sent) / 1e6)
+        self.received += 1
+        if self.received == self.expected and not self.done.done():
+            self.done.set_result(time.perf_counter())
+
+    async def run(self, name: str, messages: int) -> Result:
+        workload = WORKLOADS[name](self.participants)
+        await self.subscribed(workload.setup())
+
+        plan = [workload.recipients(i) for i in range(messages)]
+        self.expected = sum(self.fanout(recipients) for recipients in plan)
+        self.received = 0
+        self.latency = []
+        self.done = self.loop.create_future()
+        self.md.reset()
+
+        sender = self.participants[0]
+
+        start = time.perf_counter()
+        for i, recipients in enumerate(plan):
+            workload.before_send(i)
+
+            dg = Datagram()
+            dg.add_server_header(recipients, sender.channel, STATESERVER_OBJECT_UPDATE_FIELD)
+            dg.add_uint64(time.perf_counter_ns())
+            dg.add_bytes(b'\x00' * 16)
+            sender.send_datagram(dg)
+
+            if i % BURST == 0:
+                await asyncio.sleep(0)
+
+        elapsed = await self.done - start
+        workload.teardown()
+
+        return Result(name, messages, self.expected, elapsed, self.latency, self.md.route_times,
+                      self.md.bytes_copied)
+
+    def fanout(self, recipients):
+        return sum(channel in recipients or ZONE_CHANNEL in recipients for channel in
+                   (participant.channel for participant in self.participants))
+
+
+async def main(participant_count, messages, names):
+    loop = asyncio.get_running_loop()
+
+    harness = Harness(loop, participant_count)
+    await harness.start()
+
+    print(f'{participant_count} participants, {messages} messages per workload')
+    for name in names:
+        print(await harness.run(name, messages))
+
+    harness.stop()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    participant_count = int(args[0]) if len(args) > 0 else 20
+    messages = int(args[1]) if len(args) > 1 else 20000
+    asyncio.run(main(participant_count, messages, args[2:] or list(WORKLOADS)))
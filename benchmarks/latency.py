@@ -0,0 +1,190 @@
+"""
+Round trip latency through a local MessageDirector.
+
+Two downstream services are connected to a MasterMessageDirector on localhost. The first plays the
+ClientAgent and sends a field update to the second, which plays the StateServer and echoes it straight back.
+Every ping therefore takes the CA -> MD -> SS -> MD -> CA path, four socket hops in total.
+
+--baseline measures the read path this replaced, where every connection ran a task that looked for a complete frame
+in its buffer and slept 10 ms whenever there wasn't one. --compare runs both and prints the two side by side.
+
+Usage: python -m benchmarks.latency [pings] [--baseline | --compare]
+"""
+
+import asyncio
+import contextlib
+import statistics
+import struct
+import sys
+import time
+
+from dc.util import Datagram
+
+from otp.messagedirector import MasterMessageDirector, DownstreamMessageDirector, MDUpstreamProtocol
+from otp.messagetypes import STATESERVER_OBJECT_UPDATE_FIELD
+from otp.networking import OTPProtocol
+
+
+HOST = '127.0.0.1'
+PORT = 57100
+BASELINE_PORT = 57105
+
+CA_CHANNEL = 1000
+SS_CHANNEL = 1001
+
+HOPS = 4
+
+
+class BenchProtocol(MDUpstreamProtocol):
+    def handle_datagram(self, dg, dgi):
+        sender = dgi.get_channel()
+        msg_type = dgi.get_uint16()
+        self.service.receive(sender, msg_type, dgi)
+
+
+class BenchService(DownstreamMessageDirector):
+    upstream_protocol = BenchProtocol
+
+    def __init__(self, loop, channel):
+        DownstreamMessageDirector.__init__(self, loop)
+        self.channel = channel
+        self.connected = loop.create_future()
+
+    async def run(self, port=PORT):
+        await self.connect(HOST, port)
+        self.loop.create_task(self.route())
+        await self.connected
+
+    def on_upstream_connect(self):
+        self.subscribe_channel(self._client, self.channel)
+        self.connected.set_result(True)
+
+    def receive(self, sender, msg_type, dgi):
+        raise NotImplementedError
+
+
+class EchoService(BenchService):
+    def receive(self, sender, msg_type, dgi):
+        dg = Datagram()
+        dg.add_server_header([sender], self.channel, msg_type)
+        dg.add_bytes(dgi.remaining_bytes())
+        self.send_datagram(dg)
+
+
+class PingService(BenchService):
+    def __init__(self, loop, channel):
+        BenchService.__init__(self, loop, channel)
+        self.pong = None
+
+    def receive(self, sender, msg_type, dgi):
+        if self.pong is not None and not self.pong.done():
+            self.pong.set_result(time.perf_counter())
+
+    async def ping(self, target):
+        self.pong = self.loop.create_future()
+
+        dg = Datagram()
+        dg.add_server_header([target], self.channel, STATESERVER_OBJECT_UPDATE_FIELD)
+        dg.add_uint32(target)
+        dg.add_uint16(0)
+
+        start = time.perf_counter()
+        self.send_datagram(dg)
+        return await self.pong - start
+
+
+POLL_INTERVAL = 0.01
+
+
+async def poll_frames(protocol):
+    """The old OTPProtocol.handle_datagrams loop."""
+    expected = 0
+
+    while True:
+        if expected:
+            if len(protocol.buf) < expected:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+
+            dg = Datagram()
+            dg.add_bytes(bytes(protocol.buf[:expected]))
+            del protocol.buf[:expected]
+            expected = 0
+            protocol.receive_datagram(dg)
+        elif len(protocol.buf) > 2:
+            expected = struct.unpack('<H', protocol.buf[:2])[0]
+            del protocol.buf[:2]
+        else:
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+@contextlib.contextmanager
+def polling():
+    """Has every OTPProtocol read through poll_frames instead of framing in data_received."""
+    connection_made = OTPProtocol.connection_made
+    data_received = OTPProtocol.data_received
+
+    def polling_connection_made(self, transport):
+        connection_made(self, transport)
+        self.tasks.append(self.service.loop.create_task(poll_frames(self)))
+
+    def polling_data_received(self, data):
+        self.buf.extend(data)
+
+    OTPProtocol.connection_made = polling_connection_made
+    OTPProtocol.data_received = polling_data_received
+    try:
+        yield
+    finally:
+        OTPProtocol.connection_made = connection_made
+        OTPProtocol.data_received = data_received
+
+
+async def measure(pings, port=PORT):
+    loop = asyncio.get_running_loop()
+
+    md = MasterMessageDirector(loop)
+    loop.create_task(md.route())
+    loop.create_task(md.listen(HOST, port))
+    await asyncio.sleep(0.1)
+
+    ss = EchoService(loop, SS_CHANNEL)
+    ca = PingService(loop, CA_CHANNEL)
+    await ss.run(port)
+    await ca.run(port)
+    await asyncio.sleep(0.1)
+
+    samples = [await ca.ping(SS_CHANNEL) for _ in range(pings)]
+    samples.sort()
+    return samples
+
+
+def report(title, samples):
+    mean = statistics.mean(samples)
+    print(f'{title}: {len(samples)} pings over {HOPS} hops (CA -> MD -> SS -> MD -> CA)')
+    print(f'round trip: mean {mean * 1000:.3f} ms, p50 {samples[len(samples) // 2] * 1000:.3f} ms, '
+          f'p99 {samples[int(len(samples) * 0.99)] * 1000:.3f} ms')
+    print(f'per hop:    mean {mean / HOPS * 1000:.3f} ms')
+
+
+def main(pings, mode):
+    results = {}
+
+    if mode in ('', '--compare'):
+        results['current'] = asyncio.run(measure(pings))
+        report('current', results['current'])
+
+    if mode in ('--baseline', '--compare'):
+        with polling():
+            results['baseline'] = asyncio.run(measure(pings, BASELINE_PORT))
+        report(f'baseline ({POLL_INTERVAL * 1000:.0f} ms polling)', results['baseline'])
+
+    if len(results) == 2:
+        speedup = statistics.mean(results['baseline']) / statistics.mean(results['current'])
+        print(f'mean round trip is {speedup:.1f}x faster than the baseline')
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    main(int(args[0]) if args else 1000, flags[0] if flags else '')
@@ -0,0 +1,90 @@
+"""
+MessageDirector routing throughput, routed directly and through the route() queue.
+
+A sender floods a single receiver with unicast field updates through a local MasterMessageDirector. The run is
+repeated with MessageDirector.ROUTE_QUEUE off and on, and msgs/sec is reported for both.
+
+Usage: python -m benchmarks.routing [messages]
+"""
+
+import asyncio
+import sys
+import time
+
+from dc.util import Datagram
+
+from otp.messagedirector import MasterMessageDirector, MessageDirector
+from otp.messagetypes import STATESERVER_OBJECT_UPDATE_FIELD
+
+from benchmarks.latency import BenchService, HOST
+
+
+PORT = 57102
+
+SENDER_CHANNEL = 1000
+RECEIVER_CHANNEL = 1001
+
+
+class Receiver(BenchService):
+    def __init__(self, loop, channel, expected):
+        BenchService.__init__(self, loop, channel)
+        self.count = 0
+        self.expected = expected
+        self.done = loop.create_future()
+
+    def receive(self, sender, msg_type, dgi):
+        self.count += 1
+        if self.count == self.expected:
+            self.done.set_result(time.perf_counter())
+
+
+class Sender(BenchService):
+    def receive(self, sender, msg_type, dgi):
+        pass
+
+
+async def measure(port, messages):
+    loop = asyncio.get_running_loop()
+
+    md = MasterMessageDirector(loop)
+    md_route = loop.create_task(md.route())
+    md_listen = loop.create_task(md.listen(HOST, port))
+    await asyncio.sleep(0.1)
+
+    receiver = Receiver(loop, RECEIVER_CHANNEL, messages)
+    sender = Sender(loop, SENDER_CHANNEL)
+    await receiver.run(port)
+    await sender.run(port)
+    await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    for i in range(messages):
+        dg = Datagram()
+        dg.add_server_header([RECEIVER_CHANNEL], SENDER_CHANNEL, STATESERVER_OBJECT_UPDATE_FIELD)
+        dg.add_uint32(100000000 + i)
+        dg.add_uint16(0)
+        sender.send_datagram(dg)
+
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+
+    elapsed = await receiver.done - start
+
+    md_route.cancel()
+    md_listen.cancel()
+    return messages / elapsed
+
+
+async def main(messages):
+    MessageDirector.ROUTE_QUEUE = True
+    queued = await measure(PORT, messages)
+    MessageDirector.ROUTE_QUEUE = False
+    direct = await measure(PORT + 1, messages)
+
+    print(f'{messages} unicast messages')
+    print(f'queued: {queued:.0f} msgs/sec')
+    print(f'direct: {direct:.0f} msgs/sec ({direct / queued:.2f}x)')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -0,0 +1,70 @@
+"""
+Memory used by the MessageDirector's channel subscriptions.
+
+Subscribes a million channels the way a populated cluster does: most channels (objects, clients) have one
+subscriber, and every tenth channel (zones watched by the state server and a client agent) has two. The memory
+taken by SubscriptionTable is compared with the dict of sets the MD used before, measured with tracemalloc.
+
+Usage: python -m benchmarks.subscription_memory [channels]
+"""
+
+import sys
+import time
+import tracemalloc
+
+from otp.subscriptions import SubscriptionTable
+
+
+PARTICIPANTS = 64
+SHARED_EVERY = 10
+
+
+class Participant:
+    pass
+
+
+def subscriptions(channels, participants):
+    for channel in range(channels):
+        yield participants[channel % PARTICIPANTS], channel
+        if channel % SHARED_EVERY == 0:
+            yield participants[(channel + 1) % PARTICIPANTS], channel
+
+
+def build_sets(channels, participants):
+    table = {}
+    for participant, channel in subscriptions(channels, participants):
+        if channel not in table:
+            table[channel] = set()
+        table[channel].add(participant)
+    return table
+
+
+def build_table(channels, participants):
+    table = SubscriptionTable()
+    for participant, channel in subscriptions(channels, participants):
+        table.add(participant, channel)
+    return table
+
+
+def measure(build, channels, participants):
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = build(channels, participants)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del table
+    return size, elapsed
+
+
+def main(channels):
+    participants = [Participant() for _ in range(PARTICIPANTS)]
+
+    for name, build in (('dict of sets', build_sets), ('SubscriptionTable', build_table)):
+        size, elapsed = measure(build, channels, participants)
+        print(f'{name:>18}: {size / 2 ** 20:7.1f} MiB, {size / channels:5.1f} bytes per channel, '
+              f'built in {elapsed:.2f} s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -24,6 +24,8 @@ class ClientAgent(DownstreamMessageDirector, UpstreamServer, ChannelAllocator):
     min_channel = config['ClientAgent.MIN_CHANNEL']
     max_channel = config['ClientAgent.MAX_CHANNEL']
 
+    METRICS_PORT = config['ClientAgent.METRICS_PORT']
+
     def __init__(self, loop):
         DownstreamMessageDirector.__init__(self, loop)
         UpstreamServer.__init__(self, loop)
@@ -45,10 +47,14 @@ class ClientAgent(DownstreamMessageDirector, UpstreamServer, ChannelAllocator):
 
         self.listen_task = None
 
+        # Per client message logging, see ClientProtocol.
+        self.client_log = self.logger('clients')
+
     def _on_exception(self, loop, context):
         print('err', context)
 
     async def run(self):
+        await self.start_metrics()
         await self.connect(config['MessageDirector.HOST'], config['MessageDirector.PORT'])
         self.listen_task = self.loop.create_task(self.listen(config['ClientAgent.HOST'], config['ClientAgent.PORT']))
         await self.route()
@@ -56,6 +62,11 @@ class ClientAgent(DownstreamMessageDirector, UpstreamServer, ChannelAllocator):
     def on_upstream_connect(self):
         pass
 
+    def metric_gauges(self):
+        gauges = DownstreamMessageDirector.metric_gauges(self)
+        gauges['clients'] = len(self._clients)
+        return gauges
+
     def context(self):
         self._context = (self._context + 1) & 0xFFFFFFFF
         return self._context
@@ -1,3 +1,4 @@
+import logging
 import time
 import json
 from dataclasses import dataclass
@@ -13,7 +14,8 @@ from dc.util import Datagram
 from otp import config
 from otp.messagedirector import MDParticipant
 from otp.messagetypes import *
-from otp.networking import OTPProtocol, DatagramFuture
+from otp.networking import OTPProtocol, DatagramFuture, LANE_BULK, LANE_CONTROL, NO_OBJECT, message_object
+from otp.tracing import TRACING, trace_of_datagram
 from otp.zone import *
 from otp.constants import *
 from otp.util import *
@@ -91,6 +93,22 @@ class ClientProtocol(OTPProtocol, MDParticipant):
     LOGIN_MSG_TYPE = CLIENT_LOGIN
     FORWARDED_MSG_TYPES = [CLIENT_FRIEND_ONLINE, CLIENT_FRIEND_OFFLINE, CLIENT_GET_FRIEND_LIST_RESP]
 
+    WRITE_HIGH_WATER = config['ClientAgent.WRITE_HIGH_WATER']
+    WRITE_LOW_WATER = config['ClientAgent.WRITE_LOW_WATER']
+    MAX_PENDING = config['ClientAgent.MAX_PENDING']
+    SLOW_CONSUMER_POLICY = config['ClientAgent.SLOW_CONSUMER_POLICY']
+    BULK_MSG_TYPES = frozenset({CLIENT_OBJECT_UPDATE_FIELD})
+    # Offset of the do_id in the client messages about one object, see OTPProtocol.object_of.
+    OBJECT_OFFSETS = {
+        CLIENT_OBJECT_UPDATE_FIELD: 0,
+        CLIENT_OBJECT_DISABLE: 0,
+        CLIENT_OBJECT_LOCATION: 0,
+        CLIENT_CREATE_OBJECT_REQUIRED: 10,
+        CLIENT_CREATE_OBJECT_REQUIRED_OTHER: 10,
+        CLIENT_DONE_INTEREST_RESP: NO_OBJECT,
+    }
+    METRICS_KIND = 'client'
+
     def __init__(self, service):
         OTPProtocol.__init__(self, service)
         MDParticipant.__init__(self, service)
@@ -98,7 +116,7 @@ class ClientProtocol(OTPProtocol, MDParticipant):
         self.state: int = ClientState.NEW
         self.channel: int = service.new_channel_id()
         self.alloc_channel = self.channel
-        self.subscribe_channel(self.channel)
+        self.claim_channel(self.channel)
 
         self.interests: List[Interest] = []
         self.visible_objects: Dict[int, ObjectInfo] = {}
@@ -119,18 +137,21 @@ class ClientProtocol(OTPProtocol, MDParticipant):
         for task in self.tasks:
             task.cancel()
         del self.tasks[:]
+        self.discard_outgoing()
         resp = Datagram()
         resp.add_uint16(CLIENT_GO_GET_LOST)
         resp.add_uint16(booted_index)
         resp.add_string16(booted_text.encode('utf-8'))
-        self.transport.write(len(resp).to_bytes(2, byteorder='little'))
-        self.transport.write(resp.bytes())
+        # Written directly, the batcher holds frames back while the client is throttled.
+        data = resp.bytes()
+        self.transport.write(len(data).to_bytes(2, byteorder='little') + data)
         self.transport.close()
         self.service.log.debug(f'Booted client {self.channel} with index {booted_index} and text: "{booted_text}"')
 
     def connection_lost(self, exc):
         self.service.log.debug(f'Connection lost to client {self.channel}')
         OTPProtocol.connection_lost(self, exc)
+        self.service._clients.discard(self)
 
         if self.avatar_id:
             self.delete_avatar_ram()
@@ -141,6 +162,20 @@ class ClientProtocol(OTPProtocol, MDParticipant):
         OTPProtocol.connection_made(self, transport)
         self.subscribe_channel(CLIENTS_CHANNEL)
 
+    def lane_of(self, frame: bytes) -> int:
+        # Client messages start with their message type.
+        return LANE_BULK if (frame[2] | (frame[3] << 8)) in self.BULK_MSG_TYPES else LANE_CONTROL
+
+    def object_of(self, frame: bytes) -> int:
+        return message_object(frame, 2, self.OBJECT_OFFSETS)
+
+    def upstream_protocols(self):
+        return [self.service._client]
+
+    def on_slow_consumer(self):
+        self.service.flow_counters['slow_consumer_disconnects'] += 1
+        self.disconnect(ClientDisconnect.INTERNAL_ERROR, 'Connection too slow.')
+
     def delete_avatar_ram(self):
         dg = Datagram()
         dg.add_server_header([self.avatar_id], self.channel, STATESERVER_OBJECT_DELETE_RAM)
@@ -151,8 +186,8 @@ class ClientProtocol(OTPProtocol, MDParticipant):
         dgi = dg.iterator()
         msgtype = dgi.get_uint16()
 
-        if msgtype != CLIENT_OBJECT_UPDATE_FIELD:
-            self.service.log.debug(f'Got message type {MSG_TO_NAME_DICT[msgtype]} from client {self.channel}')
+        if msgtype != CLIENT_OBJECT_UPDATE_FIELD and self.service.client_log.isEnabledFor(logging.DEBUG):
+            self.service.client_log.debug('Got message type %s from client %s', MSG_TO_NAME_DICT[msgtype], self.channel)
 
         if msgtype == CLIENT_HEARTBEAT:
             self.send_datagram(dg)
@@ -247,17 +282,24 @@ class ClientProtocol(OTPProtocol, MDParticipant):
                                   f'DCField keywords: {field.keywords}')
             return
 
+        trace_id = self.service.tracer.sample() if TRACING else None
+        if trace_id:
+            self.service.tracer.record(trace_id, 'ca.receive', client=self.channel, do_id=do_id, field=field.name)
+
         pos = dgi.tell()
         field.unpack_bytes(dgi)
         dgi.seek(pos)
 
         resp = Datagram()
-        resp.add_server_header([do_id], self.channel, STATESERVER_OBJECT_UPDATE_FIELD)
+        resp.add_server_header([do_id, trace_id] if trace_id else [do_id], self.channel, STATESERVER_OBJECT_UPDATE_FIELD)
         resp.add_uint32(do_id)
         resp.add_uint16(field_number)
         resp.add_bytes(dgi.remaining_bytes())
         self.service.send_datagram(resp)
 
+        if trace_id:
+            self.service.tracer.record(trace_id, 'ca.send')
+
     def receive_client_location(self, dgi):
         do_id = dgi.get_uint32()
         parent_id = dgi.get_uint32()
@@ -456,6 +498,8 @@ class ClientProtocol(OTPProtocol, MDParticipant):
 
         if msgtype == STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER:
             self.handle_object_entrance(dgi, sender)
+        elif msgtype == STATESERVER_OBJECT_ENTERZONE_BUNDLE:
+            self.handle_object_bundle(dgi, sender)
         elif msgtype == STATESERVER_OBJECT_ENTER_OWNER_RECV:
             self.handle_owned_object_entrance(dgi, sender)
         elif msgtype == STATESERVER_OBJECT_CHANGE_ZONE:
@@ -474,12 +518,12 @@ class ClientProtocol(OTPProtocol, MDParticipant):
             if not self.object_exists(do_id):
                 queued = self.queue_pending(do_id, dgi, pos)
                 if queued:
-                    self.service.log.debug(f'Queued field update for pending object {do_id}.')
+                    self.service.client_log.debug('Queued field update for pending object %s.', do_id)
                 else:
-                    self.service.log.debug(f'Got update for unknown object {do_id}.')
+                    self.service.client_log.debug('Got update for unknown object %s.', do_id)
                 return
 
-            self.handle_update_field(dgi, sender, do_id)
+            self.handle_update_field(dgi, sender, do_id, trace_of_datagram(dg) if TRACING else None)
         elif msgtype == STATESERVER_OBJECT_DELETE_RAM:
             do_id = dgi.get_uint32()
 
@@ -495,6 +539,8 @@ class ClientProtocol(OTPProtocol, MDParticipant):
             else:
                 self.send_remove_object(do_id)
                 del self.visible_objects[do_id]
+        elif msgtype == STATESERVER_OBJECT_DELETE_RAM_MULTIPLE:
+            self.handle_delete_multiple(dgi, sender)
         elif msgtype == CLIENT_AGENT_SET_INTEREST:
             self.receive_add_interest(dgi, ai=True)
         elif msgtype == CLIENT_AGENT_REMOVE_INTEREST:
@@ -507,12 +553,15 @@ class ClientProtocol(OTPProtocol, MDParticipant):
         else:
            self.service.log.debug(f'Client {self.channel} received unhandled upstream msg {msgtype}.')
 
-    def handle_update_field(self, dgi, sender, do_id):
+    def handle_update_field(self, dgi, sender, do_id, trace_id=None):
         if sender == self.channel:
             return
 
+        if trace_id:
+            self.service.tracer.record(trace_id, 'ca.deliver.receive', client=self.channel)
+
         if not self.object_exists(do_id):
-            self.service.log.debug(f'Got field update for unknown object {do_id}')
+            self.service.client_log.debug('Got field update for unknown object %s', do_id)
 
         pos = dgi.tell()
 
@@ -527,6 +576,10 @@ class ClientProtocol(OTPProtocol, MDParticipant):
 
         self.send_datagram(resp)
 
+        if trace_id:
+            # Frames queued ahead of this one on the connection to the client.
+            self.service.tracer.record(trace_id, 'ca.deliver.send', client=self.channel, queued=sum(self.lane_depths()))
+
     def handle_owned_object_entrance(self, dgi, sender):
         do_id = dgi.get_uint32()
         parent_id = dgi.get_uint32()
@@ -547,7 +600,8 @@ class ClientProtocol(OTPProtocol, MDParticipant):
         new_zone = dgi.get_uint32()
         old_parent = dgi.get_uint32()
         old_zone = dgi.get_uint32()
-        self.service.log.debug(f'Handle location change for {do_id}: ({old_parent} {old_zone}) -> ({new_parent} {new_zone})')
+        self.service.client_log.debug('Handle location change for %s: (%s %s) -> (%s %s)', do_id, old_parent, old_zone,
+                                      new_parent, new_zone)
 
         disable = True
 
@@ -560,7 +614,7 @@ class ClientProtocol(OTPProtocol, MDParticipant):
         owned = do_id in self.owned_objects
 
         if not visible and not owned:
-            self.service.log.debug(f'Got location change for unknown object {do_id}')
+            self.service.client_log.debug('Got location change for unknown object %s', do_id)
             return
 
         if visible:
@@ -575,14 +629,14 @@ class ClientProtocol(OTPProtocol, MDParticipant):
             if owned:
                 self.send_object_location(do_id, new_parent, new_zone)
                 return
-            self.service.log.debug(f'Got location change and object is no longer visible. Disabling {do_id}')
+            self.service.client_log.debug('Got location change and object is no longer visible. Disabling %s', do_id)
             self.send_remove_object(do_id)
             del self.visible_objects[do_id]
         else:
             self.send_object_location(do_id, new_parent, new_zone)
 
     def send_remove_object(self, do_id):
-        self.service.log.debug(f'Sending removal of {do_id}.')
+        self.service.client_log.debug('Sending removal of %s.', do_id)
         resp = Datagram()
         resp.add_uint16(CLIENT_OBJECT_DISABLE)
         resp.add_uint32(do_id)
@@ -670,6 +724,32 @@ class ClientProtocol(OTPProtocol, MDParticipant):
 
         self.send_object_entrance(parent_id, zone_id, dc_id, do_id, dgi, has_other)
 
+    def handle_object_bundle(self, dgi, sender):
+        # Each entry is handled as the STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER it stands for, so it can be
+        # queued for a pending interest on its own. That message is sent by the object, whose do_id follows the
+        # has_other flag at the start of the entry.
+        while dgi.remaining():
+            size = dgi.get_uint16()
+            pos = dgi.tell()
+            dgi.get_uint8()
+            do_id = dgi.get_uint32()
+            dgi.seek(pos)
+
+            entry = Datagram()
+            entry.add_channel(do_id)
+            entry.add_uint16(STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER)
+            entry.add_bytes(dgi.get_bytes(size))
+            self.handle_datagram(entry, entry.iterator())
+
+    def handle_delete_multiple(self, dgi, sender):
+        # Handled as one STATESERVER_OBJECT_DELETE_RAM per object, deletions of pending objects are queued.
+        for i in range(dgi.get_uint16()):
+            entry = Datagram()
+            entry.add_channel(sender)
+            entry.add_uint16(STATESERVER_OBJECT_DELETE_RAM)
+            entry.add_uint32(dgi.get_uint32())
+            self.handle_datagram(entry, entry.iterator())
+
     def get_pending_interests(self, parent_id, zone_id):
         for interest in self.interests:
             if not interest.done and interest.parent_id == parent_id and zone_id in interest.zones:
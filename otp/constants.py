@@ -1,5 +1,7 @@
 CLIENTS_CHANNEL = 10
 STATESERVERS_CHANNEL = 12
+# State server shard n also listens on STATESERVER_SHARD_CHANNELS + n.
+STATESERVER_SHARD_CHANNELS = 100
 DBSERVERS_CHANNEL = 13
 
 OTP_DO_ID_SERVER_ROOT = 4007
@@ -90,6 +90,8 @@ class DBServer(DownstreamMessageDirector):
     min_channel = 100000000
     max_channel = 200000000
 
+    METRICS_PORT = config['DatabaseServer.METRICS_PORT']
+
     def __init__(self, loop):
         DownstreamMessageDirector.__init__(self, loop)
 
@@ -101,7 +103,10 @@ class DBServer(DownstreamMessageDirector):
 
         self.operations = {}
 
+        self.db_log = self.logger('db')
+
     async def run(self):
+        await self.start_metrics()
         await self.backend.setup()
         await self.connect(config['MessageDirector.HOST'], config['MessageDirector.PORT'])
         await self.route()
@@ -155,7 +160,7 @@ class DBServer(DownstreamMessageDirector):
         self.send_datagram(dg)
 
     async def set_stored_values(self, do_id, fields):
-        self.log.debug(f'Setting stored values for {do_id}: {fields}')
+        self.db_log.debug('Setting stored values for %s: %s', do_id, fields)
         await self.backend.set_fields(do_id, fields)
 
     def on_upstream_connect(self):
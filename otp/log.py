@@ -0,0 +1,87 @@
+"""
+Logging for services.
+
+Loggers only put records on a queue. A QueueListener thread writes them to the console and to logs/<service>.log,
+so file and console I/O never runs on the event loop. Levels come from the [Logging] section of local.par: LEVEL
+is the default, a service's class name sets the level of that service and <service>_<category> the level of one of
+its categories (see Service.logger). Hot paths log with %-style arguments so disabled records are never formatted.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+from otp import config
+
+
+FORMAT = '(%(name)s::%(asctime)s): %(message)s'
+
+_levels = config['Logging'].entries
+_queue = queue.SimpleQueue()
+_listener = None
+
+
+class ServiceFileHandler(logging.Handler):
+    """Writes every record to the log file of its service, the first part of the logger name."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.handlers = {}
+
+    def emit(self, record):
+        service = record.name.split('.', 1)[0]
+        handler = self.handlers.get(service)
+
+        if handler is None:
+            handler = self.handlers[service] = logging.FileHandler(f'logs/{service}.log')
+            handler.setFormatter(self.formatter)
+
+        handler.handle(record)
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+        logging.Handler.close(self)
+
+
+def start_listener():
+    global _listener
+
+    formatter = logging.Formatter(FORMAT)
+    file_handler = ServiceFileHandler()
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    _listener = logging.handlers.QueueListener(_queue, file_handler, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def level_of(name: str):
+    level = _levels.get(name.replace('.', '_'))
+    if level is None:
+        return None
+    return level if isinstance(level, int) else logging.getLevelName(level.upper())
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Returns the logger of a service, or of one of its categories when name is <service>.<category>."""
+    if _listener is None:
+        start_listener()
+
+    log = logging.getLogger(name)
+
+    if '.' not in name and not log.handlers:
+        # Categories propagate to their service's logger, only that one needs a handler.
+        log.addHandler(logging.handlers.QueueHandler(_queue))
+        log.propagate = False
+
+    level = level_of(name)
+    if level is None and '.' not in name:
+        level = level_of('LEVEL')
+    if level is not None:
+        log.setLevel(level)
+
+    return log
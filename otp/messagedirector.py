@@ -1,35 +1,119 @@
 from otp import config
-from otp.networking import OTPProtocol, MDParticipant, Service, UpstreamServer, DownstreamClient
+from otp.networking import (OTPProtocol, MDParticipant, Service, UpstreamServer, DownstreamClient, frame_datagram,
+                            server_lane, DatagramFuture, LANE_NAMES)
+from otp.subscriptions import ChannelRangeIndex, SubscriptionTable, subtract_ranges
+from otp.tracing import TRACING, is_trace_channel, trace_of
 from dc.messagetypes import *
+from otp.messagetypes import (CONTROL_UPDATE_CHANNELS, CONTROL_PEER_HELLO, CONTROL_TRACK_SHARED,
+                              CONTROL_SHARED_CHANNELS, CONTROL_QUERY_SUBSCRIBED, CONTROL_SUBSCRIBED_CHANNELS)
 from dc.util import Datagram
-from asyncio import Queue
+from collections import deque
 import asyncio
 import par
+import time
 
 
-from typing import Dict, Set, List
+from typing import Dict, Set, List, Tuple
 
 
-class MDProtocol(OTPProtocol, MDParticipant):
+class ChannelBatcher:
+    """
+    Merges the channel subscription changes sent over a connection during one loop iteration into
+    CONTROL_UPDATE_CHANNELS messages of at most MAX_BATCH_CHANNELS channels. Changes are only queued when a
+    channel gains its first subscriber or loses its last one on the sending side, so opposite changes within a
+    batch cancel out. CONTROL_SHARED_CHANNELS changes are batched the same way, keyed by their message type.
+    """
+    MAX_BATCH_CHANNELS = 4096
+
+    def __init__(self):
+        self.channel_changes: Dict[int, Dict[int, bool]] = {}
+        self._channel_flush_handle = None
+
+    def queue_channel_change(self, channel, subscribe, msg_type=CONTROL_UPDATE_CHANNELS):
+        changes = self.channel_changes.get(msg_type)
+        if changes is None:
+            changes = self.channel_changes[msg_type] = {}
+
+        if changes.get(channel, subscribe) != subscribe:
+            del changes[channel]
+            return
+
+        changes[channel] = subscribe
+
+        if self._channel_flush_handle is None:
+            self._channel_flush_handle = self.service.loop.call_soon(self.flush_channel_changes)
+
+    def flush_channel_changes(self):
+        if self._channel_flush_handle is not None:
+            self._channel_flush_handle.cancel()
+            self._channel_flush_handle = None
+
+        batches = self.channel_changes
+        self.channel_changes = {}
+
+        for msg_type, changes in batches.items():
+            self.send_channel_changes(msg_type, list(changes.items()))
+
+    def send_channel_changes(self, msg_type, changes):
+        for i in range(0, len(changes), self.MAX_BATCH_CHANNELS):
+            batch = changes[i:i + self.MAX_BATCH_CHANNELS]
+            added = [channel for channel, subscribe in batch if subscribe]
+            removed = [channel for channel, subscribe in batch if not subscribe]
+
+            dg = Datagram()
+            dg.add_uint8(1)
+            dg.add_channel(CONTROL_MESSAGE)
+            dg.add_uint16(msg_type)
+            dg.add_uint16(len(added))
+            for channel in added:
+                dg.add_channel(channel)
+            dg.add_uint16(len(removed))
+            for channel in removed:
+                dg.add_channel(channel)
+            OTPProtocol.send_frame(self, frame_datagram(dg))
+
+    def send_frame(self, frame: bytes, lane=None):
+        # Pending subscription changes have to arrive before anything sent after them.
+        if self.channel_changes:
+            self.flush_channel_changes()
+        OTPProtocol.send_frame(self, frame, lane)
+
+
+class MDProtocol(ChannelBatcher, OTPProtocol, MDParticipant):
+    WRITE_HIGH_WATER = config['MessageDirector.WRITE_HIGH_WATER']
+    WRITE_LOW_WATER = config['MessageDirector.WRITE_LOW_WATER']
+    MAX_PENDING = config['MessageDirector.MAX_PENDING']
+    SLOW_CONSUMER_POLICY = config['MessageDirector.SLOW_CONSUMER_POLICY']
+
+    relays_frames = True
+
     def __init__(self, service):
         OTPProtocol.__init__(self, service)
         MDParticipant.__init__(self, service)
+        ChannelBatcher.__init__(self)
 
         self.post_removes: List[Datagram] = []
+        # Channels the participant was last told have other subscribers, see MasterMessageDirector.track_shared.
+        self.shared_channels: Set[int] = set()
 
     def connection_made(self, transport):
         OTPProtocol.connection_made(self, transport)
 
     def connection_lost(self, exc):
         OTPProtocol.connection_lost(self, exc)
+        self.service._clients.discard(self)
         self.service.remove_participant(self)
         self.post_remove()
 
+    def upstream_protocols(self):
+        # Peer links are never paused, that would stall every MD behind them on one slow connection here.
+        return [client for client in self.service._clients if client is not self and not client.is_peer]
+
     def post_remove(self):
         self.service.log.debug(f'Sending out post removes for participant.')
         while self.post_removes:
             dg = self.post_removes.pop(0)
-            self.service.q.put_nowait((None, dg))
+            self.service.route_datagram(None, dg)
 
     def receive_datagram(self, dg):
         dgi = dg.iterator()
@@ -45,17 +129,19 @@ class MDProtocol(OTPProtocol, MDParticipant):
             elif msg_type == CONTROL_REMOVE_CHANNEL:
                 channel = dgi.get_channel()
                 self.unsubscribe_channel(channel)
+            elif msg_type == CONTROL_UPDATE_CHANNELS:
+                for _ in range(dgi.get_uint16()):
+                    self.subscribe_channel(dgi.get_channel())
+                for _ in range(dgi.get_uint16()):
+                    self.unsubscribe_channel(dgi.get_channel())
             elif msg_type == CONTROL_ADD_RANGE:
                 low = dgi.get_channel()
                 high = dgi.get_channel()
-                for channel in range(low, high, 1):
-                    self.channels.add(channel)
+                self.subscribe_range(low, high)
             elif msg_type == CONTROL_REMOVE_RANGE:
                 low = dgi.get_channel()
                 high = dgi.get_channel()
-                for channel in range(low, high, 1):
-                    if channel in self.channels:
-                        self.channels.remove(channel)
+                self.unsubscribe_range(low, high)
             elif msg_type == CONTROL_ADD_POST_REMOVE:
                 post_dg = Datagram()
                 post_dg.add_bytes(dgi.get_bytes(dgi.remaining()))
@@ -63,97 +149,411 @@ class MDProtocol(OTPProtocol, MDParticipant):
                 self.post_removes.append(post_dg)
             elif msg_type == CONTROL_CLEAR_POST_REMOVE:
                 del self.post_removes[:]
+            elif msg_type == CONTROL_PEER_HELLO:
+                self.service.add_peer(self)
+            elif msg_type == CONTROL_TRACK_SHARED:
+                self.service.track_shared(self)
+            elif msg_type == CONTROL_QUERY_SUBSCRIBED:
+                self.service.query_subscribed(self, dgi)
+        elif self.is_peer:
+            self.service.route_datagram(self, dg)
         else:
-            self.service.q.put_nowait((None, dg))
+            self.service.route_datagram(None, dg)
 
     def handle_datagram(self, dg, dgi):
         self.send_datagram(dg)
 
+    def subscribe_remote_range(self, low, high):
+        dg = Datagram()
+        dg.add_server_control_header(CONTROL_ADD_RANGE)
+        dg.add_channel(low)
+        dg.add_channel(high)
+        self.send_datagram(dg)
+
+    def unsubscribe_remote_range(self, low, high):
+        dg = Datagram()
+        dg.add_server_control_header(CONTROL_REMOVE_RANGE)
+        dg.add_channel(low)
+        dg.add_channel(high)
+        self.send_datagram(dg)
+
 
 class MessageDirector(Service):
+    # Datagrams are routed synchronously by the protocol that received them. With ROUTE_QUEUE set they are put on
+    # self.route_queue instead and routed later by the route() task, in the order they were received in.
+    ROUTE_QUEUE = bool(config['MessageDirector.ROUTE_QUEUE'])
+
     def __init__(self):
         Service.__init__(self)
         self.participants: Set[MDParticipant] = set()
-        self.channel_subscriptions: Dict[int, Set[MDParticipant]] = {}
-        self.q = Queue()
+        self.channel_subscriptions = SubscriptionTable()
+        self.channel_ranges = ChannelRangeIndex()
+        self.route_queue = deque()
+        # Queued datagrams per lane, for lane_depths.
+        self.route_depths = [0] * len(OTPProtocol.LANE_WEIGHTS)
+        self._route_ready = asyncio.Event()
+        self._routing = False
+        self._route_backlog = deque()
 
     def subscribe_channel(self, participant: MDParticipant, channel: int):
-        if channel not in participant.channels:
-            participant.channels.add(channel)
-
-        if channel not in self.channel_subscriptions:
-            self.channel_subscriptions[channel] = set()
-
-        if participant not in self.channel_subscriptions[channel]:
-            self.channel_subscriptions[channel].add(participant)
+        participant.channels.add(channel)
+        self.channel_subscriptions.add(participant, channel)
 
     def unsubscribe_channel(self, participant: MDParticipant, channel: int):
-        if channel in participant.channels:
-            participant.channels.remove(channel)
-
-        if channel in self.channel_subscriptions:
-            if participant in self.channel_subscriptions[channel]:
-                self.channel_subscriptions[channel].remove(participant)
+        participant.channels.discard(channel)
+        self.channel_subscriptions.remove(participant, channel)
 
     def unsubscribe_all(self, participant: MDParticipant):
         while participant.channels:
             channel = participant.channels.pop()
             self.unsubscribe_channel(participant, channel)
 
+    def subscribe_range(self, participant: MDParticipant, low: int, high: int):
+        self.channel_ranges.add(participant, low, high)
+
+    def unsubscribe_range(self, participant: MDParticipant, low: int, high: int):
+        self.channel_ranges.remove(participant, low, high)
+
     def add_participant(self, participant: MDParticipant):
         self.participants.add(participant)
 
     def remove_participant(self, participant: MDParticipant):
         self.unsubscribe_all(participant)
+        for low, high in self.channel_ranges.ranges_of(participant):
+            self.unsubscribe_range(participant, low, high)
+        self.channel_subscriptions.release(participant)
         self.participants.remove(participant)
 
+    def lookup_channels(self, channels) -> Set[MDParticipant]:
+        receiving_participants = set()
+
+        for channel in channels:
+            receiving_participants.update(self.channel_subscriptions.lookup(channel))
+            if self.channel_ranges:
+                receiving_participants.update(self.channel_ranges.lookup(channel))
+
+        return receiving_participants
+
     def process_datagram(self, participant: MDParticipant, dg: Datagram):
+        if self.METRICS_PORT:
+            received = time.perf_counter()
+
         dgi = dg.iterator()
 
         recipient_count = dgi.get_uint8()
-        recipients = (dgi.get_channel() for _ in range(recipient_count))
+        recipients = [dgi.get_channel() for _ in range(recipient_count)]
+
+        receiving_participants = self.lookup_channels(recipients)
 
-        receiving_participants = {p for c in recipients if c in self.channel_subscriptions for p in self.channel_subscriptions[c]}
+        trace_id = trace_of(recipients) if TRACING else None
+        if trace_id:
+            self.tracer.record(trace_id, 'md.receive')
 
         if participant is not None and participant in receiving_participants:
             receiving_participants.remove(participant)
 
+        if participant is not None and participant.is_peer:
+            # Datagrams from a peer MD are only delivered locally, peers already forward to everyone they link to.
+            receiving_participants = {p for p in receiving_participants if not p.is_peer}
+
         pos = dgi.tell()
+        frame = None
 
         try:
+            self.dispatch_internal(recipients, dg, pos)
+
             for participant in receiving_participants:
+                if participant.relays_frames:
+                    if frame is None:
+                        frame = frame_datagram(dg)
+                        lane = participant.lane_of(frame)
+                    participant.send_frame(frame, lane)
+                    continue
+
                 _dgi = dg.iterator()
                 _dgi.seek(pos)
                 participant.handle_datagram(dg, _dgi)
         except Exception as e:
             self.log.debug(f'Exception while handling datagram: {e.__class__}: {repr(e)}')
 
+        if trace_id:
+            self.tracer.record(trace_id, 'md.send', receivers=len(receiving_participants))
+
+        if self.METRICS_PORT and len(dg) >= pos + 10:
+            dgi.seek(pos + 8)
+            self.metrics.observe('server', dgi.get_uint16(), len(dg), time.perf_counter() - received)
+
+    def dispatch_internal(self, recipients, dg: Datagram, pos: int):
+        """Delivers the datagram to receivers the service keeps track of itself instead of in channel_subscriptions."""
+        pass
+
+    def route_datagram(self, participant: MDParticipant, dg: Datagram):
+        if self.ROUTE_QUEUE:
+            lane = server_lane(dg.bytes(), OTPProtocol.BULK_MSG_TYPES)
+            self.route_depths[lane] += 1
+            self.route_queue.append((participant, dg, lane))
+            self._route_ready.set()
+            return
+
+        # Datagrams routed while handling another one are held back until it is done.
+        # This keeps them in order and stops handlers from recursing into each other.
+        if self._routing:
+            self._route_backlog.append((participant, dg))
+            return
+
+        self._routing = True
+        try:
+            self.process_datagram(participant, dg)
+
+            while self._route_backlog:
+                self.process_datagram(*self._route_backlog.popleft())
+        finally:
+            self._routing = False
+
     async def route(self):
+        # Routing never waits on a connection, so the queue is always routed in order. Frames only change order on
+        # the way out, when a connection falls behind (see OTPProtocol.LANE_WEIGHTS).
         while True:
-            participant, dg = await self.q.get()
-            self.process_datagram(participant, dg)
+            await self._route_ready.wait()
+            self._route_ready.clear()
+
+            while self.route_queue:
+                participant, dg, lane = self.route_queue.popleft()
+                self.route_depths[lane] -= 1
+                self.process_datagram(participant, dg)
+
+    def metric_gauges(self):
+        gauges = Service.metric_gauges(self)
+        gauges['participants'] = len(self.participants)
+        gauges['subscribed_channels'] = len(self.channel_subscriptions)
+        gauges['range_bounds'] = len(self.channel_ranges.bounds)
+        for name, depth in zip(LANE_NAMES, self.lane_depths()):
+            gauges[f'{name}_lane_depth'] = depth
+        return gauges
+
+    def lane_depths(self) -> Tuple[int, ...]:
+        """Datagrams waiting to be routed plus frames waiting to be written to participants, per lane."""
+        depths = list(self.route_depths)
+        for participant in self.participants:
+            if isinstance(participant, OTPProtocol):
+                for lane, depth in enumerate(participant.lane_depths()):
+                    depths[lane] += depth
+        return tuple(depths)
+
+
+class MDPeerProtocol(MDProtocol):
+    """Outgoing link from this MessageDirector to one of its peers."""
+
+    def __init__(self, service):
+        MDProtocol.__init__(self, service)
+        self.closed = service.loop.create_future()
+
+    def connection_made(self, transport):
+        MDProtocol.connection_made(self, transport)
+
+        dg = Datagram()
+        dg.add_server_control_header(CONTROL_PEER_HELLO)
+        self.send_datagram(dg)
+
+        self.service.add_peer(self)
+
+    def connection_lost(self, exc):
+        MDProtocol.connection_lost(self, exc)
+        if not self.closed.done():
+            self.closed.set_result(exc)
 
 
 class MasterMessageDirector(MessageDirector, UpstreamServer):
+    """
+    The MessageDirector every service connects to.
+
+    Several of them can be federated by listing peers in PEERS. Each MD advertises the channels and ranges its own
+    participants are subscribed to over the peer links, so a peer only forwards datagrams somebody on the other
+    side listens for. Datagrams received from a peer are never forwarded to another peer, so a datagram crosses at
+    most one link and needs no loop detection. That only works if every MD links to every other one: in a chain
+    A - B - C nothing sent on A reaches C. PEERS has to list a full mesh.
+    """
     downstream_protocol = MDProtocol
+    PEER_RETRY_DELAY = 5
+    METRICS_PORT = config['MessageDirector.METRICS_PORT']
 
     def __init__(self, loop):
         MessageDirector.__init__(self)
         UpstreamServer.__init__(self, loop)
         self.loop.set_exception_handler(self._on_exception)
 
+        self.peers: Set[MDProtocol] = set()
+        # Participants that are told which of their channels have other subscribers.
+        self.shared_trackers: Set[MDProtocol] = set()
+
     def _on_exception(self, loop, context):
         print('err', context)
 
     async def run(self):
+        await self.start_metrics()
         self.loop.create_task(self.route())
+
+        for peer in (config['MessageDirector.PEERS'] or '').split(','):
+            if peer.strip():
+                host, port = peer.strip().rsplit(':', 1)
+                self.loop.create_task(self.connect_peer(host, int(port)))
+
         await self.listen(config['MessageDirector.HOST'], config['MessageDirector.PORT'])
 
+    async def connect_peer(self, host: str, port: int):
+        while True:
+            try:
+                _, protocol = await self.loop.create_connection(lambda: MDPeerProtocol(self), host, port)
+            except OSError as e:
+                self.log.debug(f'Failed to connect to peer {host}:{port}: {e}')
+            else:
+                self.log.debug(f'Connected to peer {host}:{port}')
+                await protocol.closed
+                self.log.debug(f'Lost connection to peer {host}:{port}')
+
+            await asyncio.sleep(self.PEER_RETRY_DELAY)
 
-class MDUpstreamProtocol(OTPProtocol, MDParticipant):
+    def add_peer(self, protocol: MDProtocol):
+        protocol.is_peer = True
+        self.peers.add(protocol)
+
+        for channel, participants in self.channel_subscriptions.items():
+            if self.has_local_subscriber(participants):
+                protocol.queue_channel_change(channel, True)
+
+        for low, high in self.channel_ranges.covered(0, (1 << 64) - 1, self.has_local_subscriber):
+            protocol.subscribe_remote_range(low, high)
+
+    def remove_participant(self, participant: MDParticipant):
+        MessageDirector.remove_participant(self, participant)
+        self.peers.discard(participant)
+        self.shared_trackers.discard(participant)
+
+    def track_shared(self, participant: MDProtocol):
+        """
+        From now on tells the participant with CONTROL_SHARED_CHANNELS which of its channels somebody else subscribes
+        to as well, directly or through a range, so it knows which channels it can keep to itself.
+        """
+        participant.tracks_shared = True
+        self.shared_trackers.add(participant)
+
+        for channel in participant.channels:
+            self.update_shared(participant, channel)
+
+    def query_subscribed(self, participant: MDProtocol, dgi):
+        """Answers CONTROL_QUERY_SUBSCRIBED with the channels somebody other than the participant subscribes to."""
+        context = dgi.get_uint32()
+        subscribed = []
+
+        for _ in range(dgi.get_uint16()):
+            channel = dgi.get_channel()
+            if self.lookup_channels((channel,)) - {participant}:
+                subscribed.append(channel)
+
+        dg = Datagram()
+        dg.add_server_control_header(CONTROL_SUBSCRIBED_CHANNELS)
+        dg.add_uint32(context)
+        dg.add_uint16(len(subscribed))
+        for channel in subscribed:
+            dg.add_channel(channel)
+        participant.send_datagram(dg)
+
+    def update_shared(self, participant: MDProtocol, channel: int):
+        subscribers = self.channel_subscriptions.lookup(channel)
+        shared = len(subscribers) > 1 or bool(subscribers) and subscribers[0] is not participant
+        if not shared and self.channel_ranges:
+            shared = any(owner is not participant for owner in self.channel_ranges.lookup(channel))
+
+        if shared != (channel in participant.shared_channels):
+            if shared:
+                participant.shared_channels.add(channel)
+            else:
+                participant.shared_channels.discard(channel)
+            participant.queue_channel_change(channel, shared, CONTROL_SHARED_CHANNELS)
+
+    def update_shared_subscribers(self, channel: int):
+        for participant in self.channel_subscriptions.lookup(channel):
+            if participant.tracks_shared:
+                self.update_shared(participant, channel)
+
+    def update_shared_range(self, changed_by: MDParticipant, low: int, high: int):
+        for participant in self.shared_trackers:
+            if participant is not changed_by:
+                for channel in [channel for channel in participant.channels if low <= channel < high]:
+                    self.update_shared(participant, channel)
+
+    def metric_gauges(self):
+        gauges = MessageDirector.metric_gauges(self)
+        gauges['connections'] = len(self._clients)
+        gauges['peers'] = len(self.peers)
+        return gauges
+
+    @staticmethod
+    def has_local_subscriber(participants) -> bool:
+        return any(not participant.is_peer for participant in participants)
+
+    def subscribe_channel(self, participant: MDParticipant, channel: int):
+        advertise = not participant.is_peer and not self.has_local_subscriber(self.channel_subscriptions.lookup(channel))
+        MessageDirector.subscribe_channel(self, participant, channel)
+
+        if advertise:
+            for peer in self.peers:
+                peer.queue_channel_change(channel, True)
+
+        if self.shared_trackers:
+            self.update_shared_subscribers(channel)
+
+    def unsubscribe_channel(self, participant: MDParticipant, channel: int):
+        subscribed = self.channel_subscriptions.subscribed(participant, channel)
+        MessageDirector.unsubscribe_channel(self, participant, channel)
+
+        if subscribed and not participant.is_peer and not self.has_local_subscriber(self.channel_subscriptions.lookup(channel)):
+            for peer in self.peers:
+                peer.queue_channel_change(channel, False)
+
+        if subscribed and self.shared_trackers:
+            # The participant forgets about the channel itself once it unsubscribes.
+            if participant.tracks_shared:
+                participant.shared_channels.discard(channel)
+            self.update_shared_subscribers(channel)
+
+    def subscribe_range(self, participant: MDParticipant, low: int, high: int):
+        before = self.channel_ranges.covered(low, high, self.has_local_subscriber)
+        MessageDirector.subscribe_range(self, participant, low, high)
+
+        if not participant.is_peer and self.peers:
+            self.advertise_ranges(before, self.channel_ranges.covered(low, high, self.has_local_subscriber))
+
+        if self.shared_trackers:
+            self.update_shared_range(participant, low, high)
+
+    def unsubscribe_range(self, participant: MDParticipant, low: int, high: int):
+        before = self.channel_ranges.covered(low, high, self.has_local_subscriber)
+        MessageDirector.unsubscribe_range(self, participant, low, high)
+
+        if not participant.is_peer and self.peers:
+            self.advertise_ranges(before, self.channel_ranges.covered(low, high, self.has_local_subscriber))
+
+        if self.shared_trackers:
+            self.update_shared_range(participant, low, high)
+
+    def advertise_ranges(self, before, after):
+        # Work out what changed from the merged local coverage before and after, and tell the peers about it.
+        added = subtract_ranges(after, before)
+        removed = subtract_ranges(before, after)
+
+        for peer in self.peers:
+            for low, high in added:
+                peer.subscribe_remote_range(low, high)
+            for low, high in removed:
+                peer.unsubscribe_remote_range(low, high)
+
+
+class MDUpstreamProtocol(ChannelBatcher, OTPProtocol, MDParticipant):
     def __init__(self, service):
         OTPProtocol.__init__(self, service)
         MDParticipant.__init__(self, service)
+        ChannelBatcher.__init__(self)
 
     def connection_made(self, transport):
         OTPProtocol.connection_made(self, transport)
@@ -164,23 +564,43 @@ class MDUpstreamProtocol(OTPProtocol, MDParticipant):
         raise Exception('lost upsteam connection!', exc)
 
     def subscribe_channel(self, channel):
+        self.queue_channel_change(channel, True)
+
+    def unsubscribe_channel(self, channel):
+        self.queue_channel_change(channel, False)
+
+    def subscribe_range(self, low, high):
         dg = Datagram()
         dg.add_uint8(1)
         dg.add_channel(CONTROL_MESSAGE)
-        dg.add_uint16(CONTROL_SET_CHANNEL)
-        dg.add_channel(channel)
+        dg.add_uint16(CONTROL_ADD_RANGE)
+        dg.add_channel(low)
+        dg.add_channel(high)
         self.send_datagram(dg)
 
-    def unsubscribe_channel(self, channel):
+    def unsubscribe_range(self, low, high):
         dg = Datagram()
         dg.add_uint8(1)
         dg.add_channel(CONTROL_MESSAGE)
-        dg.add_uint16(CONTROL_REMOVE_CHANNEL)
-        dg.add_channel(channel)
+        dg.add_uint16(CONTROL_REMOVE_RANGE)
+        dg.add_channel(low)
+        dg.add_channel(high)
         self.send_datagram(dg)
 
     def receive_datagram(self, dg):
-        self.service.q.put_nowait((None, dg))
+        if self.service.tracking_shared or self.futures:
+            # Control messages are never routed, the only ones the MD sends down are CONTROL_SHARED_CHANNELS and
+            # answers to queries.
+            dgi = dg.iterator()
+            if dgi.get_uint8() == 1 and dgi.get_channel() == CONTROL_MESSAGE:
+                msg_type = dgi.get_uint16()
+                if msg_type == CONTROL_SHARED_CHANNELS:
+                    self.service.handle_shared_channels(dgi)
+                else:
+                    self.check_futures(dgi, msg_type, CONTROL_MESSAGE)
+                return
+
+        self.service.route_datagram(None, dg)
 
     def handle_datagram(self, dg, dgi):
         raise NotImplementedError
@@ -193,22 +613,103 @@ class DownstreamMessageDirector(MessageDirector, DownstreamClient):
         MessageDirector.__init__(self)
         DownstreamClient.__init__(self, loop)
 
+        # Channels claimed by participants of this process, and the ones of them the upstream MD reported somebody
+        # else subscribes to as well, see claim_channel.
+        self.local_channels: Set[int] = set()
+        self.shared_channels: Set[int] = set()
+        self.tracking_shared = False
+        self.next_context = 0
+
     async def run(self):
         raise NotImplementedError
 
+    def claim_channel(self, participant, channel):
+        """
+        Subscribes the participant to a channel that normally nothing outside this process listens on, such as a
+        state server object's do_id. Datagrams sent from here to claimed channels are delivered locally instead of
+        making a round trip through the upstream MD. That is only safe while nobody else subscribes to the channel,
+        so the upstream MD reports the claimed channels that are shared (CONTROL_SHARED_CHANNELS), and datagrams to
+        those go upstream like any other.
+        """
+        self.add_local_channel(channel)
+        self.subscribe_channel(participant, channel)
+
+    def add_local_channel(self, channel):
+        if not self.tracking_shared:
+            self.tracking_shared = True
+            dg = Datagram()
+            dg.add_server_control_header(CONTROL_TRACK_SHARED)
+            self._client.send_datagram(dg)
+
+        self.local_channels.add(channel)
+
+    def remove_local_channel(self, channel):
+        self.local_channels.discard(channel)
+        self.shared_channels.discard(channel)
+
+    async def query_subscribed(self, channels, timeout=10) -> Set[int]:
+        """Returns which of the channels somebody outside this process subscribes to, asking the upstream MD."""
+        context = self.next_context
+        self.next_context = (self.next_context + 1) & 0xFFFFFFFF
+
+        dg = Datagram()
+        dg.add_server_control_header(CONTROL_QUERY_SUBSCRIBED)
+        dg.add_uint32(context)
+        dg.add_uint16(len(channels))
+        for channel in channels:
+            dg.add_channel(channel)
+
+        future = DatagramFuture(self.loop, CONTROL_SUBSCRIBED_CHANNELS, context=context, timeout=timeout)
+        self._client.futures.add(future)
+        self._client.send_datagram(dg)
+
+        _, dgi = await future
+        dgi.get_uint32()
+        return {dgi.get_channel() for _ in range(dgi.get_uint16())}
+
+    def handle_shared_channels(self, dgi):
+        for _ in range(dgi.get_uint16()):
+            self.shared_channels.add(dgi.get_channel())
+        for _ in range(dgi.get_uint16()):
+            self.shared_channels.discard(dgi.get_channel())
+
+    def needs_channel(self, channel) -> bool:
+        """Whether anything in this process still needs the upstream subscription to channel."""
+        return channel in self.channel_subscriptions
+
     def subscribe_channel(self, participant, channel):
-        subscribe_upstream = channel not in self.channel_subscriptions or not len(self.channel_subscriptions[channel])
+        subscribe_upstream = not self.needs_channel(channel)
         MessageDirector.subscribe_channel(self, participant, channel)
 
         if subscribe_upstream:
             self._client.subscribe_channel(channel)
 
     def unsubscribe_channel(self, participant, channel):
+        if not self.channel_subscriptions.subscribed(participant, channel):
+            return
+
         MessageDirector.unsubscribe_channel(self, participant, channel)
 
-        if len(self.channel_subscriptions[channel]) == 0:
+        if not self.needs_channel(channel):
+            self.remove_local_channel(channel)
             self._client.unsubscribe_channel(channel)
 
+    def subscribe_range(self, participant, low, high):
+        # Only the parts of the range no local participant covers yet need to go upstream.
+        gaps = self.channel_ranges.uncovered(low, high)
+        MessageDirector.subscribe_range(self, participant, low, high)
+
+        for gap_low, gap_high in gaps:
+            self._client.subscribe_range(gap_low, gap_high)
+
+    def unsubscribe_range(self, participant, low, high):
+        # Only the parts that were covered before and nobody covers anymore go upstream.
+        before = self.channel_ranges.uncovered(low, high)
+        MessageDirector.unsubscribe_range(self, participant, low, high)
+
+        for gap_low, gap_high in subtract_ranges(self.channel_ranges.uncovered(low, high), before):
+            self._client.unsubscribe_range(gap_low, gap_high)
+
     def process_datagram(self, participant, dg):
         MessageDirector.process_datagram(self, participant, dg)
 
@@ -217,8 +718,45 @@ class DownstreamMessageDirector(MessageDirector, DownstreamClient):
             self._client.send_datagram(dg)
 
     def send_datagram(self, dg: Datagram):
+        if self.local_channels:
+            dgi = dg.iterator()
+            recipients = [dgi.get_channel() for _ in range(dgi.get_uint8())]
+            local = [channel for channel in recipients
+                     if channel in self.local_channels and channel not in self.shared_channels]
+
+            if local:
+                # Trace channels go along with both parts, nobody upstream subscribes to them.
+                traces = [channel for channel in recipients if is_trace_channel(channel)] if TRACING else []
+                remote = [channel for channel in recipients if channel not in local and channel not in traces]
+
+                if not remote:
+                    self.flow_counters['routed_local'] += 1
+                    self.flow_counters['routed_local_bytes'] += len(dg)
+                    self.route_datagram(None, dg)
+                    return
+
+                # Deliver the local part here and send the rest upstream with the local recipients stripped.
+                body = dgi.remaining_bytes()
+                local_dg = self.readdress(local + traces, body)
+                dg = self.readdress(remote + traces, body)
+
+                self.flow_counters['routed_split'] += 1
+                self.flow_counters['routed_local_bytes'] += len(local_dg)
+                self.route_datagram(None, local_dg)
+
+        self.flow_counters['routed_upstream'] += 1
+        self.flow_counters['routed_upstream_bytes'] += len(dg)
         self._client.send_datagram(dg)
 
+    @staticmethod
+    def readdress(recipients, body: bytes) -> Datagram:
+        dg = Datagram()
+        dg.add_uint8(len(recipients))
+        for channel in recipients:
+            dg.add_channel(channel)
+        dg.add_bytes(body)
+        return dg
+
 
 async def main():
     loop = asyncio.get_running_loop()
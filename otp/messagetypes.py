@@ -13,6 +13,19 @@ CONTROL_ADD_RANGE = 2008
 CONTROL_REMOVE_RANGE = 2009
 CONTROL_ADD_POST_REMOVE = 2010
 CONTROL_CLEAR_POST_REMOVE = 2011
+# uint16 count, channels to subscribe, uint16 count, channels to unsubscribe.
+CONTROL_UPDATE_CHANNELS = 2012
+# Sent by a MessageDirector connecting to one of its peers.
+CONTROL_PEER_HELLO = 2013
+# Sent by a downstream MessageDirector with claimed channels, the MD then keeps it up to date with
+# CONTROL_SHARED_CHANNELS on which of its channels somebody else subscribes to as well.
+CONTROL_TRACK_SHARED = 2014
+# uint16 count, channels that gained another subscriber, uint16 count, channels that lost their last other one.
+CONTROL_SHARED_CHANNELS = 2015
+# uint32 context, uint16 count, channels. Asks the MD which of the channels somebody else subscribes to, answered with
+# CONTROL_SUBSCRIBED_CHANNELS: uint32 context, uint16 count, the channels that have other subscribers.
+CONTROL_QUERY_SUBSCRIBED = 2016
+CONTROL_SUBSCRIBED_CHANNELS = 2017
 
 
 CLIENT_AGENT_OPEN_CHANNEL = 3104
@@ -53,11 +66,24 @@ STATESERVER_OBJECT_SET_OWNER_RECV = 2070
 STATESERVER_OBJECT_QUERY_FIELDS = 2080
 STATESERVER_OBJECT_QUERY_FIELDS_RESP = 2081
 STATESERVER_OBJECT_QUERY_FIELDS_STRING = 2082
+# Sent by an object to a parent on another shard, answered with STATESERVER_OBJECT_NOTIFY_MANAGING_AI.
 STATESERVER_OBJECT_QUERY_MANAGING_AI = 2083
+# uint32 parent id, uint64 AI channel of the parent (0 for none). Sent to children on other shards.
+STATESERVER_OBJECT_NOTIFY_MANAGING_AI = 2084
 STATESERVER_BOUNCE_MESSAGE = 2086
 STATESERVER_QUERY_OBJECT_CHILDREN_LOCAL = 2087
 STATESERVER_QUERY_OBJECT_CHILDREN_LOCAL_DONE = 2089
 STATESERVER_QUERY_OBJECT_CHILDREN_RESP = 2087
+# Answers STATESERVER_QUERY_ZONE_OBJECT_ALL with many objects at once: each entry is a uint16 length followed by
+# the body of the STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER it stands for. Only sent to client channels.
+STATESERVER_OBJECT_ENTERZONE_BUNDLE = 2091
+# uint16 count, then the uint32 ids of objects that were deleted, sent instead of one DELETE_RAM per object when an
+# AI's objects are deleted at once. Only sent to location and client channels.
+STATESERVER_OBJECT_DELETE_RAM_MULTIPLE = 2092
+# uint32 query id, uint64 location, uint32 parent id, then the uint32 ids of the objects of the zone query the
+# receiving shard has. It sends their entries to the location and answers the query id with ..._SHARD_DONE.
+STATESERVER_QUERY_ZONE_OBJECTS_SHARD = 2093
+STATESERVER_QUERY_ZONE_OBJECTS_SHARD_DONE = 2094
 
 ACCOUNT_AVATAR_USAGE = 3005
 ACCOUNT_ACCOUNT_USAGE = 3006
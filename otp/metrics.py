@@ -0,0 +1,110 @@
+"""
+Per service metrics served over HTTP.
+
+Every Service counts the datagrams it handles per message type, with byte totals and a histogram of the time spent
+handling them, and reports gauges such as queue depths, connection and object counts (see Service.metric_gauges)
+and the event loop lag. When the service's METRICS_PORT is set in local.par they are served in the Prometheus text
+format at http://General.METRICS_HOST:METRICS_PORT/metrics.
+"""
+
+import asyncio
+
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+from otp.messagetypes import MSG_TO_NAME_DICT
+
+
+# Histogram bucket bounds in seconds.
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class MessageStats:
+    __slots__ = 'count', 'bytes', 'buckets', 'seconds'
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.seconds = 0.0
+
+    def observe(self, size: int, duration: float):
+        self.count += 1
+        self.bytes += size
+        self.buckets[bisect_left(BUCKETS, duration)] += 1
+        self.seconds += duration
+
+
+class Metrics:
+    LAG_INTERVAL = 0.5
+
+    def __init__(self, service):
+        self.service = service
+        self.messages: Dict[Tuple[str, int], MessageStats] = {}
+        self.loop_lag = 0.0
+        self.max_loop_lag = 0.0
+        self.runner = None
+
+    def observe(self, kind: str, msg_type: int, size: int, duration: float):
+        stats = self.messages.get((kind, msg_type))
+        if stats is None:
+            stats = self.messages[kind, msg_type] = MessageStats()
+        stats.observe(size, duration)
+
+    async def start(self, loop, host: str, port: int):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        loop.create_task(self.measure_loop_lag(loop))
+        self.service.log.debug(f'Serving metrics on {host}:{port}')
+
+    async def measure_loop_lag(self, loop):
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.LAG_INTERVAL)
+            self.loop_lag = max(loop.time() - start - self.LAG_INTERVAL, 0.0)
+            self.max_loop_lag = max(self.max_loop_lag, self.loop_lag)
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.render(), content_type='text/plain')
+
+    def render(self) -> str:
+        service = self.service.__class__.__name__
+        lines: List[str] = []
+
+        for (kind, msg_type), stats in sorted(self.messages.items()):
+            labels = f'service="{service}",kind="{kind}",type="{MSG_TO_NAME_DICT.get(msg_type, msg_type)}"'
+            lines.append(f'otp_messages_total{{{labels}}} {stats.count}')
+            lines.append(f'otp_message_bytes_total{{{labels}}} {stats.bytes}')
+
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), stats.buckets):
+                cumulative += count
+                lines.append(f'otp_message_handling_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'otp_message_handling_seconds_sum{{{labels}}} {stats.seconds}')
+            lines.append(f'otp_message_handling_seconds_count{{{labels}}} {stats.count}')
+
+        for name, value in self.service.flow_counters.items():
+            lines.append(f'otp_flow_{name}_total{{service="{service}"}} {value}')
+
+        for protocol in self.service.flow_peers:
+            peer = protocol.peer_name() or ('', '')
+            labels = f'service="{service}",peer="{peer[0]}:{peer[1]}"'
+            lines.append(f'otp_connection_pauses_total{{{labels}}} {protocol.pause_count}')
+            lines.append(f'otp_connection_dropped_frames_total{{{labels}}} {protocol.dropped_frames}')
+            lines.append(f'otp_connection_dropped_bytes_total{{{labels}}} {protocol.dropped_bytes}')
+            for name, depth, peak in protocol.lane_stats():
+                lines.append(f'otp_connection_lane_depth{{{labels},lane="{name}"}} {depth}')
+                lines.append(f'otp_connection_lane_peak{{{labels},lane="{name}"}} {peak}')
+
+        for name, value in self.service.metric_gauges().items():
+            lines.append(f'otp_{name}{{service="{service}"}} {value}')
+
+        lines.append(f'otp_loop_lag_seconds{{service="{service}"}} {self.loop_lag}')
+        lines.append(f'otp_loop_lag_max_seconds{{service="{service}"}} {self.max_loop_lag}')
+
+        return '\n'.join(lines) + '\n'
@@ -1,35 +1,122 @@
-from asyncio import Queue
 from dc.util import Datagram
 import logging
 import traceback
 
 
 import asyncio
-import struct
+import time
 
 
 from asyncio import Future
-from typing import List
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from otp import config
+from otp.messagetypes import (CONTROL_MESSAGE, STATESERVER_OBJECT_UPDATE_FIELD, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE,
+                              STATESERVER_OBJECT_DELETE_RAM, STATESERVER_OBJECT_CHANGE_ZONE,
+                              STATESERVER_OBJECT_ENTER_AI_RECV, STATESERVER_OBJECT_ENTER_OWNER_RECV,
+                              STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER, STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE)
+from otp.log import get_logger
+from otp.metrics import Metrics
+from otp.tracing import Tracer
+
+
+# Priority lanes of outgoing frames, see OTPProtocol.LANE_WEIGHTS.
+LANE_CONTROL = 0
+LANE_BULK = 1
+LANE_NAMES = ('control', 'bulk')
+
+# Objects outgoing frames are about, see OTPProtocol.object_of. Besides do_ids a frame can be about any object, as
+# far as we know, or about none in particular.
+ANY_OBJECT = -1
+NO_OBJECT = -2
+
+# Offset of the do_id in the body of the server messages that are about one object, NO_OBJECT for the ones that are
+# about none. Anything else counts as ANY_OBJECT.
+SERVER_OBJECT_OFFSETS = {
+    STATESERVER_OBJECT_UPDATE_FIELD: 0,
+    STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE: 0,
+    STATESERVER_OBJECT_DELETE_RAM: 0,
+    STATESERVER_OBJECT_CHANGE_ZONE: 0,
+    STATESERVER_OBJECT_ENTER_AI_RECV: 0,
+    STATESERVER_OBJECT_ENTER_OWNER_RECV: 0,
+    STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER: 1,
+    STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE: NO_OBJECT,
+}
+
+_CONTROL_CHANNEL = CONTROL_MESSAGE.to_bytes(8, byteorder='little')
+
+
+def frame_datagram(dg: Datagram) -> bytes:
+    """Returns the datagram as a length-prefixed wire frame."""
+    data = dg.bytes()
+    return len(data).to_bytes(2, byteorder='little') + data
+
+
+def server_lane(data, bulk_msg_types, offset=0) -> int:
+    """Returns the lane of the server datagram starting at offset in data, by its message type."""
+    count = data[offset]
+    msg_type_offset = offset + 1 + 8 * count + 8
+
+    if count == 1 and data[offset + 1:offset + 9] == _CONTROL_CHANNEL or len(data) < msg_type_offset + 2:
+        return LANE_CONTROL
+
+    msg_type = data[msg_type_offset] | (data[msg_type_offset + 1] << 8)
+    return LANE_BULK if msg_type in bulk_msg_types else LANE_CONTROL
+
+
+def message_object(data, msg_type_offset, object_offsets) -> int:
+    """Returns the object of the message whose type is at msg_type_offset in data, by object_offsets."""
+    if len(data) < msg_type_offset + 2:
+        return ANY_OBJECT
+
+    offset = object_offsets.get(data[msg_type_offset] | (data[msg_type_offset + 1] << 8), ANY_OBJECT)
+    if offset < 0:
+        return offset
+
+    start = msg_type_offset + 2 + offset
+    if len(data) < start + 4:
+        return ANY_OBJECT
+    return data[start] | (data[start + 1] << 8) | (data[start + 2] << 16) | (data[start + 3] << 24)
+
+
+def server_object(data, offset=0) -> int:
+    """Returns the do_id the server datagram starting at offset in data is about, or ANY_OBJECT or NO_OBJECT."""
+    count = data[offset]
+    if count == 1 and data[offset + 1:offset + 9] == _CONTROL_CHANNEL:
+        return ANY_OBJECT
+    return message_object(data, offset + 1 + 8 * count + 8, SERVER_OBJECT_OFFSETS)
 
 
 class Service:
+    # Port of the HTTP metrics endpoint, 0 disables it. Set from local.par by each service.
+    METRICS_PORT = 0
+
     def __init__(self):
-        self.log = logging.getLogger(self.__class__.__name__)
-        self.log.setLevel(logging.DEBUG)
-        fh = logging.FileHandler('logs/' + self.__class__.__name__ + '.log')
-        fh.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('(%(name)s::%(asctime)s): %(message)s')
-        fh.setFormatter(formatter)
-        ch.setFormatter(formatter)
-        # add the handlers to the logger
-        self.log.addHandler(fh)
-        self.log.addHandler(ch)
+        self.log = get_logger(self.__class__.__name__)
+
+        # Connections whose transport is currently over its high watermark.
+        self.throttled: Set[OTPProtocol] = set()
+        # Connections that were throttled or dropped frames, their counts are reported per peer until they close.
+        self.flow_peers: Set[OTPProtocol] = set()
+        self.flow_counters = Counter()
+        self.tracer = Tracer(self.__class__.__name__)
+        self.metrics = Metrics(self)
 
     async def run(self):
         raise NotImplementedError
 
+    def logger(self, category: str) -> logging.Logger:
+        """Returns a logger for one category of this service's messages, its level can be set separately."""
+        return get_logger(f'{self.log.name}.{category}')
+
+    async def start_metrics(self):
+        if self.METRICS_PORT:
+            await self.metrics.start(self.loop, config['General.METRICS_HOST'], self.METRICS_PORT)
+
+    def metric_gauges(self) -> Dict[str, float]:
+        return {'throttled_connections': len(self.throttled)}
+
     def add_participant(self, participant):
         raise NotImplementedError
 
@@ -39,6 +126,12 @@ class Service:
     def unsubscribe_channel(self, participant, channel):
         raise NotImplementedError
 
+    def subscribe_range(self, participant, low, high):
+        raise NotImplementedError
+
+    def unsubscribe_range(self, participant, low, high):
+        raise NotImplementedError
+
 
 class UpstreamServer:
     SERVER_SSL_CONTEXT = None
@@ -85,92 +178,528 @@ class DownstreamClient:
 
 
 class DatagramFuture(Future):
-    def __init__(self, loop, msg_id, sender=None, context=None):
+    def __init__(self, loop, msg_id, sender=None, context=None, timeout=None):
         Future.__init__(self, loop=loop)
 
         self.future_msg_id = msg_id
         self.future_sender = sender
         self.context = context
+        self.timeout = timeout
+        # Timer wheel slot of the future while it is pending, see FutureRegistry.
+        self.wheel_slot = None
+
+
+class FutureRegistry:
+    """
+    Pending DatagramFutures indexed by (msg_id, sender, context).
+
+    A future with no sender matches any sender. A future with a context only matches responses whose first uint32
+    is that context. Futures with a timeout are kept on a timer wheel with TICK second slots and fail with
+    asyncio.TimeoutError once it has passed. Futures that are resolved or cancelled (e.g. by asyncio.wait_for) are
+    removed from the index and their slot right away, so only pending futures are kept.
+    """
+    TICK = 0.5
+
+    def __init__(self):
+        self._futures: Dict[Tuple[int, Optional[int], Optional[int]], List[DatagramFuture]] = {}
+        self._context_counts = Counter()
+        self._wheel: Dict[int, Set[DatagramFuture]] = {}
+        self._wheel_handle = None
+
+    def __len__(self):
+        return sum(len(futures) for futures in self._futures.values())
+
+    def __bool__(self):
+        return bool(self._futures)
+
+    @staticmethod
+    def _key(future):
+        return future.future_msg_id, future.future_sender, future.context or None
+
+    def add(self, future: DatagramFuture):
+        key = self._key(future)
+        self._futures.setdefault(key, []).append(future)
+
+        if key[2] is not None:
+            self._context_counts[key[0]] += 1
+
+        future.add_done_callback(self._discard)
+
+        if future.timeout is not None:
+            loop = future.get_loop()
+            slot = future.wheel_slot = int((loop.time() + future.timeout) / self.TICK) + 1
+            self._wheel.setdefault(slot, set()).add(future)
+
+            if self._wheel_handle is None:
+                self._wheel_handle = loop.call_later(self.TICK, self._turn_wheel, loop)
+
+    def _remove(self, key, future):
+        futures = self._futures.get(key)
+        if not futures or future not in futures:
+            return False
+
+        futures.remove(future)
+        if not futures:
+            del self._futures[key]
+
+        if key[2] is not None:
+            self._context_counts[key[0]] -= 1
+            if not self._context_counts[key[0]]:
+                del self._context_counts[key[0]]
+
+        return True
+
+    def _discard(self, future):
+        self._remove(self._key(future), future)
+
+        if future.wheel_slot is not None:
+            slot = self._wheel.get(future.wheel_slot)
+            if slot is not None:
+                slot.discard(future)
+                if not slot:
+                    del self._wheel[future.wheel_slot]
+            future.wheel_slot = None
+
+    def _pop(self, key):
+        futures = self._futures.get(key)
+        if not futures:
+            return None
+
+        future = futures[0]
+        self._remove(key, future)
+        return future
+
+    def resolve(self, dgi, msg_id, sender) -> bool:
+        future = None
+
+        if msg_id in self._context_counts and dgi.remaining() >= 4:
+            pos = dgi.tell()
+            context = dgi.get_uint32()
+            dgi.seek(pos)
+            future = self._pop((msg_id, sender, context)) or self._pop((msg_id, None, context))
+
+        if future is None:
+            future = self._pop((msg_id, sender, None)) or self._pop((msg_id, None, None))
+
+        if future is None:
+            return False
+
+        future.set_result((sender, dgi))
+        return True
+
+    def _turn_wheel(self, loop):
+        self._wheel_handle = None
+        current = int(loop.time() / self.TICK)
+
+        for slot in [slot for slot in self._wheel if slot <= current]:
+            for future in self._wheel.pop(slot):
+                if not future.done():
+                    future.set_exception(asyncio.TimeoutError())
+
+        if self._wheel:
+            self._wheel_handle = loop.call_later(self.TICK, self._turn_wheel, loop)
+
+    def cancel_all(self):
+        if self._wheel_handle is not None:
+            self._wheel_handle.cancel()
+            self._wheel_handle = None
+
+        futures = [future for key_futures in self._futures.values() for future in key_futures]
+        self._futures.clear()
+        self._context_counts.clear()
+        self._wheel.clear()
+
+        for future in futures:
+            future.cancel()
 
 
 class OTPProtocol(asyncio.Protocol):
+    # Outgoing frames are collected and written with a single writelines() call. By default they are flushed at
+    # the end of the current loop iteration. FLUSH_DELAY holds them for up to that many seconds instead, and
+    # FLUSH_SIZE flushes early once that many bytes are pending. A value of 0 disables either limit.
+    FLUSH_SIZE = 0
+    FLUSH_DELAY = 0
+
+    # Flow control. The transport pauses writing once its buffer grows past WRITE_HIGH_WATER bytes and resumes
+    # once it drains below WRITE_LOW_WATER. Frames sent while paused are held back, and SLOW_CONSUMER_POLICY
+    # decides what to do about them:
+    #   drop:       frames that would push the held back bytes past MAX_PENDING are discarded.
+    #   disconnect: the connection is dropped through on_slow_consumer() once MAX_PENDING is exceeded.
+    #   block:      reading is paused on upstream_protocols() until this connection drains. Exactly the
+    #               connections paused then are resumed, connections made in between are never blocked.
+    WRITE_HIGH_WATER = 64 * 1024
+    WRITE_LOW_WATER = 16 * 1024
+    MAX_PENDING = 1024 * 1024
+    SLOW_CONSUMER_POLICY = 'block'
+
+    # Priority lanes. Outgoing frames are queued on LANE_CONTROL or LANE_BULK by their message type (see lane_of).
+    # Whatever fits under WRITE_HIGH_WATER is written in the order it was sent in. Only when it doesn't, a flush
+    # takes up to LANE_WEIGHTS[lane] frames from each lane per round, so generates, deletes and interest completion
+    # aren't stuck behind a flood of field updates, and the rest waits for resume_writing. A frame only overtakes
+    # older frames of the other lanes if they are all about other objects (see object_of), so everything about one
+    # object still arrives in order. The drop policy discards bulk frames first.
+    LANE_WEIGHTS = (8, 1)
+    BULK_MSG_TYPES = frozenset({STATESERVER_OBJECT_UPDATE_FIELD, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE})
+
+    # Connections whose frames start with a message type, counted as this kind of message by the service metrics.
+    # Server datagrams are counted by MessageDirector.process_datagram instead.
+    METRICS_KIND = None
+
     def __init__(self, service):
         asyncio.Protocol.__init__(self)
         self.service = service
-        self.expected = 0
         self.buf = bytearray()
         self.transport = None
-        self.outgoing_q = Queue()
-        self.incoming_q = Queue()
+        self.lanes: Tuple[Deque[bytes], ...] = tuple(deque() for _ in self.LANE_WEIGHTS)
+        # The lane of every pending frame in the order they were sent in. Frames taken off a lane before their turn
+        # are counted in lane_skips and their entries dropped once they reach the front.
+        self.lane_order: Deque[int] = deque()
+        self.lane_skips = [0] * len(self.LANE_WEIGHTS)
+        # Per lane, how many pending frames are about each object. Only kept while draining, see next_lane.
+        self.lane_objects: Optional[Tuple[Counter, ...]] = None
+        self.lane_sizes = [0] * len(self.LANE_WEIGHTS)
+        # Deepest each lane has been, in frames.
+        self.lane_peaks = [0] * len(self.LANE_WEIGHTS)
+        self.outgoing_size = 0
+        self._flush_handle = None
+        self.paused = False
+        self.read_blocks = 0
+        # Connections this one paused reading on under the block policy, resumed by resume_writing.
+        self.blocked: List[OTPProtocol] = []
+        # Flow control counts of this connection, see Service.flow_peers.
+        self.pause_count = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
         self.tasks: List[asyncio.Task] = []
-        self.futures: List[DatagramFuture] = []
+        self.futures = FutureRegistry()
 
     def connection_made(self, transport):
         # name = transport.get_extra_info('peername')
         self.transport = transport
-        self.tasks.append(self.service.loop.create_task(self.handle_datagrams()))
-        self.tasks.append(self.service.loop.create_task(self.transport_datagrams()))
+        transport.set_write_buffer_limits(high=self.WRITE_HIGH_WATER, low=self.WRITE_LOW_WATER)
+
+        if self.outgoing_size:
+            self.flush()
 
     def connection_lost(self, exc):
         for task in self.tasks:
             task.cancel()
 
+        if self.paused:
+            self.resume_writing()
+
+        self.discard_outgoing()
+        self.futures.cancel_all()
+        self.service.flow_peers.discard(self)
+
+    def pause_writing(self):
+        self.paused = True
+        self.pause_count += 1
+        self.service.throttled.add(self)
+        self.service.flow_peers.add(self)
+        self.service.flow_counters['paused'] += 1
+        self.service.log.debug('Throttling %s (%s), lane depths %s.', self.peer_name(), self.SLOW_CONSUMER_POLICY,
+                               self.lane_depths())
+
+        if self.SLOW_CONSUMER_POLICY == 'block':
+            self.blocked = list(self.upstream_protocols())
+            for protocol in self.blocked:
+                protocol.block_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        self.service.throttled.discard(self)
+        self.service.log.debug('Resuming %s.', self.peer_name())
+
+        blocked, self.blocked = self.blocked, []
+        for protocol in blocked:
+            protocol.unblock_reading()
+
+        if self.outgoing_size:
+            self.flush()
+
+    def upstream_protocols(self):
+        """Returns the connections that feed this one and are paused under the block policy."""
+        return ()
+
+    def block_reading(self):
+        self.read_blocks += 1
+        if self.read_blocks == 1 and self.transport is not None and not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def unblock_reading(self):
+        self.read_blocks -= 1
+        if not self.read_blocks and self.transport is not None and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def on_slow_consumer(self):
+        self.service.flow_counters['slow_consumer_disconnects'] += 1
+        self.service.log.debug('Disconnecting slow consumer %s.', self.peer_name())
+        self.discard_outgoing()
+        self.transport.abort()
+
+    def peer_name(self):
+        if self.transport is None:
+            return None
+        return self.transport.get_extra_info('peername')
+
     def data_received(self, data: bytes):
-        self.buf.extend(data)
+        # Frames are read in place through a memoryview and the consumed prefix is dropped once per read,
+        # so a read holding many frames costs one copy per frame instead of shifting the buffer per frame.
+        if self.buf:
+            self.buf.extend(data)
+            data = self.buf
+
+        view = memoryview(data)
+        end = len(view)
+        offset = 0
+
+        metrics = self.service.metrics if self.METRICS_KIND and self.service.METRICS_PORT else None
+
+        while end - offset >= 2:
+            start = offset + 2
+            length = view[offset] | (view[offset + 1] << 8)
+
+            if end - start < length:
+                break
+
+            offset = start + length
+
+            dg = Datagram()
+            dg.add_bytes(view[start:offset])
+
+            if metrics is not None and length >= 2:
+                received = time.perf_counter()
+
+            try:
+                self.receive_datagram(dg)
+            except Exception:
+                traceback.print_exc()
+
+            if metrics is not None and length >= 2:
+                metrics.observe(self.METRICS_KIND, view[start] | (view[start + 1] << 8), length,
+                                time.perf_counter() - received)
+
+            if self.transport.is_closing():
+                break
+
+        view.release()
+
+        if data is self.buf:
+            del self.buf[:offset]
+        elif offset < end:
+            self.buf.extend(data[offset:])
 
     def send_datagram(self, data: Datagram):
-        self.outgoing_q.put_nowait(data.bytes())
-
-    async def transport_datagrams(self):
-        while True:
-            data: bytes = await self.outgoing_q.get()
-            self.transport.write(len(data).to_bytes(2, byteorder='little'))
-            self.transport.write(data)
-
-    async def handle_datagrams(self):
-        # TODO: run this tight loop in a seperate process, maybe proccess pool for CA and MD
-        expected = 0
-
-        while True:
-            if expected:
-                if len(self.buf) < expected:
-                    await asyncio.sleep(0.01)
-                    continue
-                else:
-                    try:
-                        dg = Datagram()
-                        dg.add_bytes(self.buf[:expected])
-                        self.receive_datagram(dg)
-                        del self.buf[:expected]
-                        expected = 0
-                        continue
-                    except Exception as e:
-                        import traceback
-                        traceback.print_exc()
-                        continue
-            elif len(self.buf) > 2:
-                expected = struct.unpack('H', self.buf[:2])[0]
-                del self.buf[:2]
-                continue
+        self.send_frame(frame_datagram(data))
+
+    def lane_of(self, frame: bytes) -> int:
+        return server_lane(frame, self.BULK_MSG_TYPES, offset=2)
+
+    def object_of(self, frame: bytes) -> int:
+        return server_object(frame, offset=2)
+
+    def lane_depths(self) -> Tuple[int, ...]:
+        return tuple(len(lane) for lane in self.lanes)
+
+    def lane_stats(self) -> List[Tuple[str, int, int]]:
+        """Returns the name, current depth and peak depth of every lane."""
+        return [(name, len(lane), peak) for name, lane, peak in zip(LANE_NAMES, self.lanes, self.lane_peaks)]
+
+    def send_frame(self, frame: bytes, lane: Optional[int] = None):
+        if lane is None:
+            lane = self.lane_of(frame)
+
+        if self.paused and self.outgoing_size + len(frame) > self.MAX_PENDING:
+            if self.SLOW_CONSUMER_POLICY == 'drop':
+                if lane == LANE_BULK or not self.shed_bulk(self.outgoing_size + len(frame) - self.MAX_PENDING):
+                    self.drop_frame(frame)
+                    return
+            elif self.SLOW_CONSUMER_POLICY == 'disconnect':
+                if not self.transport.is_closing():
+                    self.on_slow_consumer()
+                return
+
+        self.lanes[lane].append(frame)
+        self.lane_order.append(lane)
+        if self.lane_objects is not None:
+            self.lane_objects[lane][self.object_of(frame)] += 1
+        self.lane_sizes[lane] += len(frame)
+        self.outgoing_size += len(frame)
+
+        if len(self.lanes[lane]) > self.lane_peaks[lane]:
+            self.lane_peaks[lane] = len(self.lanes[lane])
+
+        if self.FLUSH_SIZE and self.outgoing_size >= self.FLUSH_SIZE:
+            self.flush()
+        elif self._flush_handle is None:
+            if self.FLUSH_DELAY:
+                self._flush_handle = self.service.loop.call_later(self.FLUSH_DELAY, self.flush)
             else:
-                await asyncio.sleep(0.01)
+                self._flush_handle = self.service.loop.call_soon(self.flush)
+
+    def drop_frame(self, frame: bytes):
+        self.dropped_frames += 1
+        self.dropped_bytes += len(frame)
+        self.service.flow_peers.add(self)
+        self.service.flow_counters['dropped_frames'] += 1
+        self.service.flow_counters['dropped_bytes'] += len(frame)
+
+    def shed_bulk(self, size: int) -> bool:
+        """Drops the oldest pending bulk frames until size bytes are freed, returns whether that was possible."""
+        if self.lane_sizes[LANE_BULK] < size:
+            return False
+
+        while size > 0:
+            frame = self.pop_frame(LANE_BULK)
+            size -= len(frame)
+            self.drop_frame(frame)
+
+        return True
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if self.transport is None or self.paused:
+            # Not connected yet or over the high watermark, connection_made or resume_writing will flush.
+            return
+
+        if self.transport.is_closing():
+            self.discard_outgoing()
+            return
+
+        room = self.WRITE_HIGH_WATER - self.transport.get_write_buffer_size()
+        if room < 0:
+            # Over the high watermark, the transport pauses writing and resume_writing flushes.
+            return
+
+        if self.outgoing_size <= room:
+            frames = self.take_all()
+        else:
+            frames = self.drain(room)
+
+        if frames:
+            self.transport.writelines(frames)
+
+        # Draining goes past the high watermark, so the transport pauses and resume_writing flushes the rest. Only
+        # when the transport sent it all off right away is there still room, and then this flush made progress.
+        if self.outgoing_size and not self.paused and self._flush_handle is None:
+            self._flush_handle = self.service.loop.call_soon(self.flush)
+
+    def take_all(self) -> List[bytes]:
+        """Takes all pending frames off the lanes, in the order they were sent in."""
+        busy = [lane for lane in self.lanes if lane]
+        if len(busy) == 1:
+            frames = list(busy[0])
+        else:
+            frames = []
+            skips = self.lane_skips
+            for lane in self.lane_order:
+                if skips[lane]:
+                    skips[lane] -= 1
+                else:
+                    frames.append(self.lanes[lane].popleft())
+
+        self.clear_lanes()
+        return frames
+
+    def drain(self, size: int) -> List[bytes]:
+        """Takes pending frames off the lanes in weighted rounds until more than size bytes are taken, or all."""
+        if self.lane_objects is None:
+            self.lane_objects = tuple(Counter(map(self.object_of, lane)) for lane in self.lanes)
+
+        frames = []
+        while self.outgoing_size and size >= 0:
+            for i, (lane, weight) in enumerate(zip(self.lanes, self.LANE_WEIGHTS)):
+                for _ in range(min(weight, len(lane))):
+                    frame = self.pop_frame(self.next_lane(i))
+                    frames.append(frame)
+                    size -= len(frame)
+
+        if not self.outgoing_size:
+            self.clear_lanes()
+        return frames
+
+    def oldest_lane(self) -> int:
+        """Returns the lane of the oldest pending frame."""
+        order, skips = self.lane_order, self.lane_skips
+        while skips[order[0]]:
+            skips[order.popleft()] -= 1
+        return order[0]
+
+    def next_lane(self, lane: int) -> int:
+        """
+        Returns the lane to take the next frame from when it is lane's turn: lane itself if its first frame doesn't
+        overtake an older frame that may be about the same object, otherwise the lane of the oldest frame.
+        """
+        oldest = self.oldest_lane()
+        if oldest == lane:
+            return lane
+
+        obj = self.object_of(self.lanes[lane][0])
+        if obj == NO_OBJECT:
+            return lane
+
+        for other, objects in enumerate(self.lane_objects):
+            if other != lane and self.lanes[other]:
+                if obj == ANY_OBJECT or objects[ANY_OBJECT] or objects[obj]:
+                    return oldest
+
+        return lane
+
+    def pop_frame(self, lane: int) -> bytes:
+        frame = self.lanes[lane].popleft()
+
+        if self.oldest_lane() == lane:
+            self.lane_order.popleft()
+        else:
+            self.lane_skips[lane] += 1
+
+        if self.lane_objects is not None:
+            objects = self.lane_objects[lane]
+            obj = self.object_of(frame)
+            objects[obj] -= 1
+            if not objects[obj]:
+                del objects[obj]
+
+        self.lane_sizes[lane] -= len(frame)
+        self.outgoing_size -= len(frame)
+        return frame
+
+    def clear_lanes(self):
+        for lane in self.lanes:
+            lane.clear()
+        self.lane_order.clear()
+        self.lane_skips = [0] * len(self.lanes)
+        self.lane_objects = None
+        self.lane_sizes = [0] * len(self.lanes)
+        self.outgoing_size = 0
+
+    def discard_outgoing(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        self.clear_lanes()
 
     def receive_datagram(self, data: bytes):
         raise NotImplementedError
 
     def check_futures(self, dgi, msg_id, sender):
-        for f in self.futures[:]:
-            if msg_id != f.future_msg_id:
-                continue
-
-            if f.future_sender is not None and sender != f.future_sender:
-                continue
-
-            f.set_result((sender, dgi))
-            self.futures.remove(f)
+        return self.futures.resolve(dgi, msg_id, sender)
 
 
 class MDParticipant:
+    # Participants that pass routed datagrams on unchanged to another process. The MD hands them a wire frame
+    # through send_frame, encoded once per datagram, instead of calling handle_datagram.
+    relays_frames = False
+    # Links to other MessageDirectors, see MasterMessageDirector.add_peer.
+    is_peer = False
+    # Told which of its channels have other subscribers, see MasterMessageDirector.track_shared.
+    tracks_shared = False
+
     def __init__(self, service: Service):
         self.channels = set()
         self.service = service
@@ -182,6 +711,15 @@ class MDParticipant:
     def unsubscribe_channel(self, channel):
         self.service.unsubscribe_channel(self, channel)
 
+    def claim_channel(self, channel):
+        self.service.claim_channel(self, channel)
+
+    def subscribe_range(self, low, high):
+        self.service.subscribe_range(self, low, high)
+
+    def unsubscribe_range(self, low, high):
+        self.service.unsubscribe_range(self, low, high)
+
 
 class ChannelAllocator:
     min_channel = None
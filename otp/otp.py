@@ -3,14 +3,20 @@ from multiprocessing import Pool
 
 import sys
 
+from otp import config
+
 
 def run_process(process):
     os.system(f'{sys.executable} {process}')
 
 
 def main():
-    pool = Pool(processes=4)
-    pool.map(run_process, ('-m otp.messagedirector', '-m otp.dbserver', '-m otp.stateserver', '-m otp.clientagent'))
+    processes = ['-m otp.messagedirector', '-m otp.dbserver']
+    processes.extend(f'-m otp.stateserver {shard}' for shard in range(config['StateServer.SHARDS']))
+    processes.append('-m otp.clientagent')
+
+    pool = Pool(processes=len(processes))
+    pool.map(run_process, processes)
 
 
 if __name__ == "__main__":
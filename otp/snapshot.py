@@ -0,0 +1,165 @@
+"""
+Snapshots of the objects of a state server shard.
+
+The StateServer writes its objects to StateServer.SNAPSHOT_PATH every SNAPSHOT_INTERVAL seconds and when it shuts
+down, and restores them from there when it starts, so RAM objects such as districts survive a restart (see
+StateServer.restore_snapshot for which objects are kept). Objects are encoded on the event loop, a slice at a time
+(see encode_object), and the file is written by an executor. The snapshot replaces the previous one atomically. All
+values are little endian:
+
+    header   4s magic, uint16 version, uint32 number of fields in the DC file, uint32 object count,
+             float64 time the snapshot was taken
+    object   uint32 do_id, uint32 parent, uint32 zone, uint16 dclass, uint64 AI channel (0 for none),
+             uint8 AI explicitly set, uint64 owner channel (0 for none), uint8 db,
+             uint16 required count, uint16 ram count, uint16 zone count
+    field    uint16 field number, uint16 length, the packed field (required fields first, then ram)
+    zone     uint32 zone, uint32 child count, uint32 child ids
+"""
+
+import mmap
+import os
+import struct
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+
+MAGIC = b'OTPS'
+VERSION = 2
+
+VERSION_HEADER = struct.Struct('<4sH')
+HEADER = struct.Struct('<4sHIId')
+OBJECT = struct.Struct('<IIIHQBQBHHH')
+FIELD = struct.Struct('<HH')
+ZONE = struct.Struct('<II')
+
+
+@dataclass
+class SnapshotObject:
+    do_id: int
+    parent_id: int
+    zone_id: int
+    dclass: int
+    ai_channel: Optional[int]
+    ai_explicitly_set: bool
+    owner_channel: Optional[int]
+    db: bool
+    required: List[Tuple[int, bytes]]
+    ram: List[Tuple[int, bytes]]
+    zone_objects: Dict[int, List[int]]
+
+
+@dataclass
+class Snapshot:
+    time: float
+    objects: List[SnapshotObject]
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def encode_object(obj) -> bytes:
+    """Encodes one DistributedObject."""
+    required = obj.required or {}
+    ram = obj.ram or {}
+    by_name = obj.table.by_name
+
+    parts = [OBJECT.pack(obj.do_id, obj.parent_id, obj.zone_id, obj.dclass.number, obj.ai_channel or 0,
+                         obj.ai_explicitly_set, obj.owner_channel or 0, obj.db, len(required), len(ram),
+                         len(obj.zone_objects))]
+
+    for fields in (required, ram):
+        for name, data in fields.items():
+            parts.append(FIELD.pack(by_name[name].number, len(data)))
+            parts.append(data)
+
+    for zone, children in obj.zone_objects.items():
+        parts.append(ZONE.pack(zone, len(children)))
+        parts.append(struct.pack(f'<{len(children)}I', *children))
+
+    return b''.join(parts)
+
+
+def join_snapshot(encoded: List[bytes], field_count: int, taken: float) -> bytes:
+    """
+    Makes a snapshot of objects encoded with encode_object at time taken, field_count is the number of fields in the
+    DC file they were made with.
+    """
+    return HEADER.pack(MAGIC, VERSION, field_count, len(encoded), taken) + b''.join(encoded)
+
+
+def encode_snapshot(objects, field_count: int, taken: float) -> bytes:
+    return join_snapshot([encode_object(obj) for obj in objects], field_count, taken)
+
+
+def write_snapshot(path: str, data: bytes):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(path + '.tmp', path)
+
+
+def read_snapshot(path: str, field_count: int, class_count: int) -> Optional[Snapshot]:
+    """
+    Returns the snapshot at path, None if there is none or it was made with another DC file or version. Raises
+    SnapshotError if it is malformed.
+    """
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return None
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        try:
+            return decode_snapshot(view, field_count, class_count)
+        except struct.error as e:
+            raise SnapshotError(f'truncated snapshot: {e}')
+
+
+def decode_snapshot(view, field_count: int, class_count: int) -> Optional[Snapshot]:
+    magic, version = VERSION_HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise SnapshotError(f'bad magic {magic!r}')
+    if version != VERSION:
+        return None
+
+    _, _, snapshot_fields, count, taken = HEADER.unpack_from(view, 0)
+    if snapshot_fields != field_count:
+        return None
+
+    pos = HEADER.size
+    objects = []
+
+    for _ in range(count):
+        (do_id, parent_id, zone_id, dclass, ai_channel, ai_explicitly_set, owner_channel, db, required_count,
+         ram_count, zone_count) = OBJECT.unpack_from(view, pos)
+        pos += OBJECT.size
+        if dclass >= class_count:
+            raise SnapshotError(f'object {do_id} has unknown dclass {dclass}')
+
+        fields = []
+        for _ in range(required_count + ram_count):
+            number, length = FIELD.unpack_from(view, pos)
+            pos += FIELD.size
+            if number >= field_count or pos + length > len(view):
+                raise SnapshotError(f'bad field {number} of object {do_id}')
+            fields.append((number, view[pos:pos + length]))
+            pos += length
+
+        zone_objects = {}
+        for _ in range(zone_count):
+            zone, child_count = ZONE.unpack_from(view, pos)
+            pos += ZONE.size
+            zone_objects[zone] = list(struct.unpack_from(f'<{child_count}I', view, pos))
+            pos += 4 * child_count
+
+        objects.append(SnapshotObject(do_id, parent_id, zone_id, dclass, ai_channel or None,
+                                      bool(ai_explicitly_set), owner_channel or None, bool(db),
+                                      fields[:required_count], fields[required_count:], zone_objects))
+
+    return Snapshot(taken, objects)
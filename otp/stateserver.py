@@ -1,34 +1,144 @@
 from otp import config
 
 import asyncio
+import logging
+import os
+import signal
+import sys
+import time
 
 
 from otp.messagedirector import MDUpstreamProtocol, DownstreamMessageDirector
 from dc.util import Datagram
-from otp.constants import STATESERVERS_CHANNEL
+from otp.constants import STATESERVERS_CHANNEL, STATESERVER_SHARD_CHANNELS
 from otp.messagetypes import *
-from otp.messagedirector import MDParticipant
 from otp.networking import ChannelAllocator
+from otp.tracing import TRACING, trace_of_datagram
+from otp.snapshot import SnapshotError, encode_object, encode_snapshot, join_snapshot, read_snapshot, write_snapshot
 from otp.constants import *
-from dc.objects import MolecularField, AtomicField
+from dc.objects import MolecularField
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from dataslots import with_slots
 
-from typing import Dict, Set
+from typing import Callable, Dict, List, Set, Tuple
 
 from otp.zone import *
 
 
-class DistributedObject(MDParticipant):
-    def __init__(self, state_server, sender, do_id, parent_id, zone_id, dclass, required, ram, owner_channel=None, db=False):
-        MDParticipant.__init__(self, state_server)
+# The views of an object that are sent out: to clients that see it, to its owner and to its AI (or anyone that
+# gets all of its fields).
+VIEW_CLIENT = 0
+VIEW_OWNER = 1
+VIEW_AI = 2
+
+
+def view_of(client_only: bool, also_owner: bool) -> int:
+    if not client_only:
+        return VIEW_AI
+    return VIEW_OWNER if also_owner else VIEW_CLIENT
+
+
+@with_slots
+@dataclass
+class FieldEntry:
+    """The parts of a DC field the state server needs, read off the field once when the DC file is loaded."""
+    number: int
+    name: str
+    unpack: Callable
+    molecular: bool
+    # The atomic fields a molecular field is made of, in order.
+    atomics: Tuple['FieldEntry', ...]
+    required: bool
+    ram: bool
+    db: bool
+    broadcast: bool
+    airecv: bool
+    ownrecv: bool
+    # Sent to clients that can see the object.
+    visible: bool
+    # The views the field is part of.
+    views: Tuple[int, ...]
+
+
+def build_field_table(dc_file) -> List[FieldEntry]:
+    """Returns a FieldEntry for every field of the DC file, indexed by field number."""
+    fields = [field_ref() for field_ref in dc_file.fields]
+    table = [None] * len(fields)
+
+    def entry(field):
+        if table[field.number] is None:
+            molecular = isinstance(field, MolecularField)
+            atomics = ()
+
+            if molecular:
+                atomics = []
+                for subfield in field.subfields:
+                    subentry = entry(subfield)
+                    atomics.extend(subentry.atomics if subentry.molecular else (subentry,))
+                atomics = tuple(atomics)
+
+            visible = field.is_broadcast or field.is_clrecv
+            if visible:
+                views = (VIEW_CLIENT, VIEW_OWNER, VIEW_AI)
+            elif field.is_ownrecv:
+                views = (VIEW_OWNER, VIEW_AI)
+            else:
+                views = (VIEW_AI,)
+
+            table[field.number] = FieldEntry(field.number, field.name, field.unpack_bytes, molecular, atomics,
+                                             field.is_required, field.is_ram, field.is_db, field.is_broadcast,
+                                             field.is_airecv, field.is_ownrecv, visible, views)
+        return table[field.number]
+
+    for field in fields:
+        entry(field)
+
+    return table
+
+
+class DClassTable:
+    """Field lookups of one dclass, built when the DC file is loaded."""
+
+    def __init__(self, dclass, fields: List[FieldEntry]):
+        self.number = dclass.number
+        self.fields = fields
+        self.by_name: Dict[str, FieldEntry] = {field.name: fields[field.number] for field in dclass.inherited_fields}
+
+        # Required fields in the order they are sent in, and the names of the ones each kind of recipient gets.
+        self.required = tuple(fields[field.number] for field in dclass.inherited_fields
+                              if not isinstance(field, MolecularField) and field.is_required)
+        self.required_names = tuple(entry.name for entry in self.required)
+        self.client_required = tuple(entry.name for entry in self.required if entry.visible)
+        self.owner_required = tuple(entry.name for entry in self.required if entry.visible or entry.ownrecv)
+        # Atomic fields stored in the database.
+        self.db_fields = tuple(fields[field.number] for field in dclass.inherited_fields
+                               if not isinstance(field, MolecularField) and field.is_db)
+
+
+class DistributedObject:
+    """
+    An object in the state server. Objects aren't MD participants: the StateServer subscribes their channels upstream
+    and hands them the datagrams sent to them through handle_message, see StateServer.dispatch_internal.
+    """
+
+    def __init__(self, state_server, sender, do_id, parent_id, zone_id, dclass, required, ram, owner_channel=None, db=False,
+                 announce=True):
+        self.service = state_server
         self.sender = sender
         self.do_id = do_id
         self.parent_id = 0
         self.zone_id = 0
         self.dclass = dclass
+        self.table: DClassTable = state_server.dclass_tables[dclass.number] if dclass else None
         self.required = required
         self.ram = ram
         self.db = db
 
+        # Encoded required and other fields per view, cleared by save_field when one of their fields changes.
+        self.encoded_required = [None, None, None]
+        self.encoded_other = [None, None, None]
+
         self.ai_channel = None
         self.owner_channel = owner_channel
 
@@ -37,11 +147,20 @@ class DistributedObject(MDParticipant):
         self.next_context = 0
         self.zone_objects: Dict[int, Set[int]] = {}
 
-        if self.dclass:
-            self.service.log.debug(f'Generating new object {do_id} with dclass {self.dclass.name} in location {parent_id} {zone_id}')
+        if announce:
+            if self.dclass:
+                self.service.object_log.debug('Generating new object %s with dclass %s in location %s %s',
+                                              do_id, self.dclass.name, parent_id, zone_id)
 
-        self.handle_location_change(parent_id, zone_id, sender)
-        self.subscribe_channel(do_id)
+            self.handle_location_change(parent_id, zone_id, sender)
+        else:
+            # Restored from a snapshot, the rest of the cluster already knows the object.
+            self.parent_id = parent_id
+            self.zone_id = zone_id
+            if parent_id:
+                state_server.add_child(parent_id, do_id)
+
+        state_server.claim_object_channel(do_id)
 
     def append_required_data(self, dg, client_only, also_owner):
         dg.add_uint32(self.do_id)
@@ -51,50 +170,61 @@ class DistributedObject(MDParticipant):
             print('dclass is none for object id', self.do_id)
             return
 
-        dg.add_uint16(self.dclass.number)
-        for field in self.dclass.inherited_fields:
-            if isinstance(field, MolecularField):
-                continue
+        view = view_of(client_only, also_owner)
+        encoded = self.encoded_required[view]
 
-            if not field.is_required:
-                continue
+        if encoded is None:
+            if view == VIEW_AI:
+                names = self.table.required_names
+            elif view == VIEW_OWNER:
+                names = self.table.owner_required
+            else:
+                names = self.table.client_required
+
+            fields_dg = Datagram()
+            fields_dg.add_uint16(self.dclass.number)
+            for name in names:
+                fields_dg.add_bytes(self.required[name])
+            encoded = self.encoded_required[view] = fields_dg.bytes()
 
-            if not client_only or field.is_broadcast or field.is_clrecv or (also_owner and field.is_ownrecv):
-                dg.add_bytes(self.required[field.name])
+        dg.add_bytes(encoded)
 
     def append_other_data(self, dg, client_only, also_owner):
-        if client_only:
+        view = view_of(client_only, also_owner)
+        encoded = self.encoded_other[view]
+
+        if encoded is None:
             fields_dg = Datagram()
+            fields_dg.add_uint16(0)
 
             count = 0
+            by_name = self.table.by_name
             for field_name, raw_data in self.ram.items():
-                field = self.dclass.fields_by_name[field_name]
-                if field.is_broadcast or field.is_clrecv or (also_owner and field.is_ownrecv):
-                    fields_dg.add_uint16(field.number)
+                entry = by_name[field_name]
+                if view in entry.views:
+                    fields_dg.add_uint16(entry.number)
                     fields_dg.add_bytes(raw_data)
                     count += 1
 
-            dg.add_uint16(count)
-            if count:
-                dg.add_bytes(fields_dg.bytes())
+            fields_dg.seek(0)
+            fields_dg.add_uint16(count)
+            encoded = self.encoded_other[view] = fields_dg.bytes()
 
-        else:
-            dg.add_uint16(len(self.ram))
-            for field_name, raw_data in self.ram.items():
-                field = self.dclass.fields_by_name[field_name]
-                dg.add_uint16(field.number)
-                dg.add_bytes(raw_data)
+        dg.add_bytes(encoded)
 
     def send_interest_entry(self, location, context):
         pass
 
-    def send_location_entry(self, location):
-        dg = Datagram()
-        dg.add_server_header([location], self.do_id, STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER)
+    def append_location_entry(self, dg):
         dg.add_uint8(bool(self.ram))
         self.append_required_data(dg, True, False)
         if self.ram:
             self.append_other_data(dg, True, False)
+
+    def send_location_entry(self, location):
+        dg = Datagram()
+        dg.add_server_header([location], self.do_id, STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER)
+        self.append_location_entry(dg)
         self.service.send_datagram(dg)
 
     def send_ai_entry(self, location):
@@ -134,7 +264,7 @@ class DistributedObject(MDParticipant):
 
         if new_parent != old_parent:
             if old_parent:
-                self.unsubscribe_channel(parent_to_children(old_parent))
+                self.service.remove_child(old_parent, self.do_id)
                 targets.append(old_parent)
                 targets.append(location_as_channel(old_parent, old_zone))
 
@@ -142,13 +272,18 @@ class DistributedObject(MDParticipant):
             self.zone_id = new_zone
 
             if new_parent:
-                self.subscribe_channel(parent_to_children(new_parent))
+                self.service.add_child(new_parent, self.do_id)
 
                 if not self.ai_explicitly_set:
-                    new_ai_channel = self.service.resolve_ai_channel(new_parent)
-                    if new_ai_channel != self.ai_channel:
-                        self.ai_channel = new_ai_channel
-                        self.send_ai_entry(new_ai_channel)
+                    if self.service.owns(new_parent):
+                        new_ai_channel = self.service.resolve_ai_channel(new_parent)
+                        if new_ai_channel != self.ai_channel:
+                            self.handle_ai_change(new_ai_channel, sender, False)
+                    else:
+                        # The parent answers with STATESERVER_OBJECT_NOTIFY_MANAGING_AI.
+                        dg = Datagram()
+                        dg.add_server_header([new_parent], self.do_id, STATESERVER_OBJECT_QUERY_MANAGING_AI)
+                        self.service.send_datagram(dg)
 
                 targets.append(new_parent)
 
@@ -177,10 +312,77 @@ class DistributedObject(MDParticipant):
             self.send_location_entry(location_as_channel(new_parent, new_zone))
 
     def handle_ai_change(self, new_ai, sender, channel_is_explicit):
-        pass
+        """Sets the AI of this object and of the descendants that inherit it, which is what resolve_ai_channel reads."""
+        self.set_ai_channel(new_ai)
+        self.ai_explicitly_set = channel_is_explicit
+        if new_ai is not None:
+            self.send_ai_entry(new_ai)
+
+        objects = self.service.objects
+        parents = [self]
+        # Parent id -> its children on other shards, which are told by STATESERVER_OBJECT_NOTIFY_MANAGING_AI.
+        remote = {}
+
+        while parents:
+            parent = parents.pop()
+            for children in parent.zone_objects.values():
+                for child_id in children:
+                    child = objects.get(child_id)
+                    if child is None:
+                        # A child of this shard that isn't here any more has nothing to update.
+                        if not self.service.owns(child_id):
+                            if parent.do_id not in remote:
+                                remote[parent.do_id] = []
+                            remote[parent.do_id].append(child_id)
+                        continue
+
+                    if child.ai_explicitly_set or child.ai_channel == new_ai:
+                        continue
+
+                    child.set_ai_channel(new_ai)
+                    if new_ai is not None:
+                        child.send_ai_entry(new_ai)
+                    parents.append(child)
+
+        for parent_id, child_ids in remote.items():
+            # Up to 255 recipients fit in a header.
+            for start in range(0, len(child_ids), 255):
+                self.send_managing_ai(child_ids[start:start + 255], parent_id, new_ai)
+
+    def send_managing_ai(self, recipients, parent_id, ai_channel):
+        dg = Datagram()
+        dg.add_server_header(recipients, self.do_id, STATESERVER_OBJECT_NOTIFY_MANAGING_AI)
+        dg.add_uint32(parent_id)
+        dg.add_channel(ai_channel or 0)
+        self.service.send_datagram(dg)
 
-    def annihilate(self, sender, notify_parent=True):
+    def set_ai_channel(self, ai_channel):
+        """Sets ai_channel and keeps the state server's index of objects per AI in step with it."""
+        ai_objects = self.service.ai_objects
+
+        if self.ai_channel is not None and self.ai_channel in ai_objects:
+            owned = ai_objects[self.ai_channel]
+            owned.discard(self.do_id)
+            if not owned:
+                del ai_objects[self.ai_channel]
+
+        self.ai_channel = ai_channel
+
+        if ai_channel is not None:
+            if ai_channel not in ai_objects:
+                ai_objects[ai_channel] = set()
+            ai_objects[ai_channel].add(self.do_id)
+
+    def annihilate(self, sender, notify_parent=True, deletes=None):
+        """
+        Deletes the object. Unless deletes is given the DELETE_RAM is sent right away, otherwise the object's id is
+        added to deletes under its location and client owner channels, to be sent in one
+        STATESERVER_OBJECT_DELETE_RAM_MULTIPLE with others. Only the ClientAgent decodes those, so the AI and owners
+        that aren't clients still get a DELETE_RAM.
+        """
         targets = list()
+        # Recipients that only get a DELETE_RAM when deletes is given.
+        single_targets = list()
 
         if self.parent_id:
             targets.append(location_as_channel(self.parent_id, self.zone_id))
@@ -196,36 +398,59 @@ class DistributedObject(MDParticipant):
                 self.service.send_datagram(dg)
 
         if self.owner_channel:
-            targets.append(self.owner_channel)
+            if deletes is None or self.owner_channel in self.service.BUNDLE_CHANNELS:
+                targets.append(self.owner_channel)
+            else:
+                single_targets.append(self.owner_channel)
         if self.ai_channel:
-            targets.append(self.ai_channel)
+            if deletes is None:
+                targets.append(self.ai_channel)
+            else:
+                single_targets.append(self.ai_channel)
 
-        dg = Datagram()
-        dg.add_server_header(targets, sender, STATESERVER_OBJECT_DELETE_RAM)
-        dg.add_uint32(self.do_id)
-        self.service.send_datagram(dg)
+        if deletes is None:
+            dg = Datagram()
+            dg.add_server_header(targets, sender, STATESERVER_OBJECT_DELETE_RAM)
+            dg.add_uint32(self.do_id)
+            self.service.send_datagram(dg)
+        else:
+            if single_targets:
+                dg = Datagram()
+                dg.add_server_header(single_targets, sender, STATESERVER_OBJECT_DELETE_RAM)
+                dg.add_uint32(self.do_id)
+                self.service.send_datagram(dg)
+
+            if targets:
+                targets = tuple(targets)
+                if targets not in deletes:
+                    deletes[targets] = []
+                deletes[targets].append(self.do_id)
 
         self.delete_children(sender)
+        self.set_ai_channel(None)
 
         del self.service.objects[self.do_id]
 
-        self.service.remove_participant(self)
+        self.service.remove_object(self)
 
         if self.db:
             self.service.database_objects.remove(self.do_id)
 
-        self.service.log.debug(f'Object {self.do_id} has been deleted.')
+        self.service.object_log.debug('Object %s has been deleted.', self.do_id)
 
     def delete_children(self, sender):
         pass
 
-    def handle_one_update(self, dgi, sender):
+    def handle_one_update(self, dgi, sender, trace_id=None):
         field_id = dgi.get_uint16()
-        field = self.dclass.dcfile().fields[field_id]()
+        field = self.table.fields[field_id]
+
+        if trace_id:
+            self.service.tracer.record(trace_id, 'ss.receive', do_id=self.do_id, field=field.name)
         pos = dgi.tell()
-        data = field.unpack_bytes(dgi)
+        data = field.unpack(dgi)
 
-        if isinstance(field, MolecularField):
+        if field.molecular:
             dgi.seek(pos)
             self.save_molecular(field, dgi)
         else:
@@ -233,35 +458,39 @@ class DistributedObject(MDParticipant):
 
         targets = []
 
-        if field.is_broadcast:
+        if field.broadcast:
             targets.append(location_as_channel(self.parent_id, self.zone_id))
-        if field.is_airecv and self.ai_channel and self.ai_channel != sender:
+        if field.airecv and self.ai_channel and self.ai_channel != sender:
             targets.append(self.ai_channel)
-        if field.is_ownrecv and self.owner_channel and self.owner_channel != sender:
+        if field.ownrecv and self.owner_channel and self.owner_channel != sender:
             targets.append(self.owner_channel)
 
         if targets:
             dg = Datagram()
-            dg.add_server_header(targets, sender, STATESERVER_OBJECT_UPDATE_FIELD)
+            dg.add_server_header(targets + [trace_id] if trace_id else targets, sender, STATESERVER_OBJECT_UPDATE_FIELD)
             dg.add_uint32(self.do_id)
             dg.add_uint16(field_id)
             dg.add_bytes(data)
             self.service.send_datagram(dg)
 
-    def save_molecular(self, field: MolecularField, dgi):
-        for subfield in field.subfields:
-            if isinstance(subfield, MolecularField):
-                self.save_molecular(subfield, dgi)
-            else:
-                self.save_field(subfield, subfield.unpack_bytes(dgi))
+        if trace_id:
+            self.service.tracer.record(trace_id, 'ss.send', targets=len(targets))
 
-    def save_field(self, field: AtomicField, data):
-        if field.is_required:
+    def save_molecular(self, field: FieldEntry, dgi):
+        for atomic in field.atomics:
+            self.save_field(atomic, atomic.unpack(dgi))
+
+    def save_field(self, field: FieldEntry, data):
+        if field.required:
             self.required[field.name] = data
-        elif field.is_ram:
+            for view in field.views:
+                self.encoded_required[view] = None
+        elif field.ram:
             self.ram[field.name] = data
+            for view in field.views:
+                self.encoded_other[view] = None
 
-        if self.db and field.is_db:
+        if self.db and field.db:
             dg = Datagram()
             dg.add_server_header([DBSERVERS_CHANNEL], self.do_id, DBSERVER_SET_STORED_VALUES)
             dg.add_uint32(self.do_id)
@@ -269,15 +498,15 @@ class DistributedObject(MDParticipant):
             dg.add_uint16(field.number)
             dg.add_bytes(data)
             self.service.send_datagram(dg)
-            self.service.log.debug(f'Object {self.do_id} saved value {data} for field {field.name} to database.')
+            self.service.object_log.debug('Object %s saved value %s for field %s to database.', self.do_id, data, field.name)
 
     def handle_one_get(self, dg, field_id, subfield=False):
-        field = self.dclass.dcfile().fields[field_id]()
+        field = self.table.fields[field_id]
 
-        if isinstance(field, MolecularField):
+        if field.molecular:
             if not subfield:
                 dg.add_uint16(field_id)
-            for field in field.subfields:
+            for field in field.atomics:
                 self.handle_one_get(dg, field.number, subfield)
 
         if field.name in self.required:
@@ -285,10 +514,7 @@ class DistributedObject(MDParticipant):
         elif field.name in self.ram:
             dg.append_data(self.ram[field.name])
 
-    def handle_datagram(self, dg, dgi):
-        sender = dgi.get_channel()
-        msgtype = dgi.get_uint16()
-
+    def handle_message(self, dg, dgi, sender, msgtype):
         if msgtype == STATESERVER_OBJECT_DELETE_RAM:
             do_id = dgi.get_uint32()
             if do_id == self.do_id or do_id == self.parent_id:
@@ -297,14 +523,15 @@ class DistributedObject(MDParticipant):
         elif msgtype == STATESERVER_OBJECT_UPDATE_FIELD:
             if self.do_id != dgi.get_uint32():
                 return
-            self.handle_one_update(dgi, sender)
+            self.handle_one_update(dgi, sender, trace_of_datagram(dg) if TRACING else None)
         elif msgtype == STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE:
             if self.do_id != dgi.get_uint32():
                 return
 
+            trace_id = trace_of_datagram(dg) if TRACING else None
             field_count = dgi.get_uint16()
             for i in range(field_count):
-                self.handle_one_update(dgi, sender)
+                self.handle_one_update(dgi, sender, trace_id)
         elif msgtype == STATESERVER_OBJECT_SET_ZONE:
             new_parent = dgi.get_uint32()
             new_zone = dgi.get_uint32()
@@ -337,6 +564,14 @@ class DistributedObject(MDParticipant):
 
                 if not len(children):
                     del self.zone_objects[old_zone]
+        elif msgtype == STATESERVER_OBJECT_QUERY_MANAGING_AI:
+            self.send_managing_ai([sender], self.do_id, self.ai_channel)
+        elif msgtype == STATESERVER_OBJECT_NOTIFY_MANAGING_AI:
+            parent_id = dgi.get_uint32()
+            ai_channel = dgi.get_channel() or None
+
+            if parent_id == self.parent_id and not self.ai_explicitly_set and ai_channel != self.ai_channel:
+                self.handle_ai_change(ai_channel, sender, False)
         elif msgtype == STATESERVER_QUERY_ZONE_OBJECT_ALL:
             self.handle_query_zone(dgi, sender)
         elif msgtype == STATESERVER_QUERY_OBJECT_ALL:
@@ -386,19 +621,48 @@ class DistributedObject(MDParticipant):
             self.service.send_datagram(resp)
             return
 
-        self.send_location_entry(sender)
+        state_server = self.service
+        objects = state_server.objects
+        local = [objects[do_id] for do_id in object_ids if do_id in objects]
+        remote = [do_id for do_id in object_ids if not state_server.owns(do_id)]
 
-        for do_id in object_ids:
-            self.service.objects[do_id].send_location_entry(sender)
+        state_server.send_location_entries(sender, self.do_id, [self] + local)
 
-        self.service.send_datagram(resp)
+        if remote:
+            # The shards of the other objects send their entries, DONE goes out once all of them are finished.
+            state_server.query_shards(sender, self.do_id, remote, resp)
+        else:
+            state_server.send_datagram(resp)
 
 
 class StateServerProtocol(MDUpstreamProtocol):
+    # Offset of the do_id in the body of the messages to STATESERVERS_CHANNEL only the owning shard handles.
+    DO_ID_OFFSETS = {
+        STATESERVER_OBJECT_GENERATE_WITH_REQUIRED: 10,
+        STATESERVER_OBJECT_GENERATE_WITH_REQUIRED_OTHER: 10,
+        STATESERVER_OBJECT_CREATE_WITH_REQUIRED_CONTEXT: 0,
+        STATESERVER_OBJECT_CREATE_WITH_REQUIR_OTHER_CONTEXT: 0,
+        STATESERVER_ADD_AI_RECV: 0,
+        STATESERVER_OBJECT_SET_OWNER_RECV: 0,
+        DBSERVER_GET_STORED_VALUES_RESP: 4,
+        STATESERVER_OBJECT_LOCATE: 4,
+    }
+
     def handle_datagram(self, dg, dgi):
         sender = dgi.get_channel()
         msgtype = dgi.get_uint16()
-        self.service.log.debug(f'State server directly received msgtype {MSG_TO_NAME_DICT[msgtype]} from {sender}.')
+        if self.service.object_log.isEnabledFor(logging.DEBUG):
+            self.service.object_log.debug('State server directly received msgtype %s from %s.', MSG_TO_NAME_DICT[msgtype],
+                                          sender)
+
+        if self.service.SHARDS > 1 and msgtype in self.DO_ID_OFFSETS:
+            pos = dgi.tell()
+            dgi.seek(pos + self.DO_ID_OFFSETS[msgtype])
+            owned = self.service.owns(dgi.get_uint32())
+            dgi.seek(pos)
+
+            if not owned:
+                return
 
         if msgtype == STATESERVER_OBJECT_GENERATE_WITH_REQUIRED:
             self.handle_generate(dgi, sender, False)
@@ -438,6 +702,30 @@ class StateServerProtocol(MDUpstreamProtocol):
                 ai_channel = do.ai_channel if do.ai_channel else 0
                 resp.add_uint32(ai_channel)
                 self.service.send_datagram(resp)
+        elif msgtype == STATESERVER_QUERY_ZONE_OBJECTS_SHARD:
+            self.handle_query_shard(dgi, sender)
+        elif msgtype == STATESERVER_QUERY_ZONE_OBJECTS_SHARD_DONE:
+            self.service.shard_query_done(dgi.get_uint32())
+
+    def handle_query_shard(self, dgi, sender):
+        query_id = dgi.get_uint32()
+        location = dgi.get_channel()
+        parent_id = dgi.get_uint32()
+
+        objects = self.service.objects
+        found = []
+
+        while dgi.remaining():
+            do_id = dgi.get_uint32()
+            if do_id in objects:
+                found.append(objects[do_id])
+
+        self.service.send_location_entries(location, parent_id, found)
+
+        resp = Datagram()
+        resp.add_server_header([sender], self.service.channel, STATESERVER_QUERY_ZONE_OBJECTS_SHARD_DONE)
+        resp.add_uint32(query_id)
+        self.service.send_datagram(resp)
 
     def handle_db_generate(self, dgi, sender, other=False):
         do_id = dgi.get_uint32()
@@ -460,26 +748,24 @@ class StateServerProtocol(MDUpstreamProtocol):
 
             for i in range(field_count):
                 field_number = dgi.get_uint16()
-                field = state_server.dc_file.fields[field_number]()
-                data = field.unpack_bytes(dgi)
+                data = state_server.field_table[field_number].unpack(dgi)
                 other_data.append((field_number, data))
 
         dclass = state_server.dc_file.classes[number]
 
         query = Datagram()
-        query.add_server_header([DBSERVERS_CHANNEL], STATESERVERS_CHANNEL, DBSERVER_GET_STORED_VALUES)
+        query.add_server_header([DBSERVERS_CHANNEL], state_server.channel, DBSERVER_GET_STORED_VALUES)
         query.add_uint32(1)
         query.add_uint32(do_id)
 
         pos = query.tell()
         query.add_uint16(0)
         count = 0
-        for field in dclass:
-            if not isinstance(field, MolecularField) and field.is_db:
-                if field.name == 'DcObjectType':
-                    continue
-                query.add_uint16(field.number)
-                count += 1
+        for field in state_server.dclass_tables[number].db_fields:
+            if field.name == 'DcObjectType':
+                continue
+            query.add_uint16(field.number)
+            count += 1
         query.seek(pos)
         query.add_uint16(count)
 
@@ -505,22 +791,21 @@ class StateServerProtocol(MDUpstreamProtocol):
         count = dgi.get_uint16()
 
         for i in range(count):
-            field_number = dgi.get_uint16()
-            field = state_server.dc_file.fields[field_number]()
+            field = state_server.field_table[dgi.get_uint16()]
 
-            if field.is_required:
-                required[field.name] = field.unpack_bytes(dgi)
+            if field.required:
+                required[field.name] = field.unpack(dgi)
             else:
-                ram[field.name] = field.unpack_bytes(dgi)
+                ram[field.name] = field.unpack(dgi)
 
         for field_number, data in other_data:
-            field = state_server.dc_file.fields[field_number]()
-            if field.is_required:
+            field = state_server.field_table[field_number]
+            if field.required:
                 required[field.name] = data
             else:
                 ram[field.name] = data
 
-            if field.is_db:
+            if field.db:
                 dg = Datagram()
                 dg.add_server_header([DBSERVERS_CHANNEL], do_id, DBSERVER_SET_STORED_VALUES)
                 dg.add_uint32(do_id)
@@ -542,10 +827,8 @@ class StateServerProtocol(MDUpstreamProtocol):
         ai_channel = dgi.get_channel()
         state_server = self.service
         obj = state_server.objects[object_id]
-        obj.ai_channel = ai_channel
-        obj.ai_explicitly_set = True
         print('AI SET FOR', object_id, 'TO', ai_channel)
-        obj.send_ai_entry(ai_channel)
+        obj.handle_ai_change(ai_channel, sender, True)
 
     def handle_set_owner(self, dgi, sender):
         object_id = dgi.get_uint32()
@@ -576,35 +859,29 @@ class StateServerProtocol(MDUpstreamProtocol):
         required = {}
         ram = {}
 
-        for field in dclass.inherited_fields:
-            if not isinstance(field, MolecularField) and field.is_required:
-                required[field.name] = field.unpack_bytes(dgi)
+        for field in state_server.dclass_tables[number].required:
+            required[field.name] = field.unpack(dgi)
 
         if other:
             num_optional_fields = dgi.get_uint16()
 
             for i in range(num_optional_fields):
-                field_number = dgi.get_uint16()
+                field = state_server.field_table[dgi.get_uint16()]
+                data = field.unpack(dgi)
 
-                field = dclass.fields[field_number]
-
-                if not field.is_ram:
+                if not field.ram:
                     self.service.log.debug(f'Received non-RAM field {field.name} within an OTHER section.\n')
-                    field.unpack_bytes(dgi)
                     continue
-                else:
-                    ram[field.name] = field.unpack_bytes(dgi)
+
+                ram[field.name] = data
 
         obj = DistributedObject(state_server, sender, do_id, parent_id, zone_id, dclass, required, ram)
         state_server.objects[do_id] = obj
 
     def handle_shard_rest(self, dgi):
         ai_channel = dgi.get_channel()
-
-        for object_id in list(self.service.objects.keys()):
-            obj = self.service.objects[object_id]
-            if obj.ai_channel == ai_channel:
-                obj.annihilate(ai_channel)
+        deleted = self.service.delete_ai_objects(ai_channel)
+        self.service.log.debug(f'Shard {ai_channel} went down, deleted {deleted} objects.')
 
 
 from dc.parser import parse_dc_file
@@ -618,49 +895,386 @@ class StateServer(DownstreamMessageDirector, ChannelAllocator):
     min_channel = 100000000
     max_channel = 399999999
 
-    def __init__(self, loop):
+    DC_FILE = 'toon.dc'
+    METRICS_PORT = config['StateServer.METRICS_PORT']
+    ZONE_BUNDLE_SIZE = config['StateServer.ZONE_BUNDLE_SIZE']
+    # Only the ClientAgent decodes STATESERVER_OBJECT_ENTERZONE_BUNDLE and STATESERVER_OBJECT_DELETE_RAM_MULTIPLE,
+    # everyone else gets one STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER or DELETE_RAM per object.
+    BUNDLE_CHANNELS = range(config['ClientAgent.MIN_CHANNEL'], config['ClientAgent.MAX_CHANNEL'] + 1)
+    SHARDS = config['StateServer.SHARDS']
+    SHARD_QUERY_TIMEOUT = config['StateServer.SHARD_QUERY_TIMEOUT']
+    # Do_ids per STATESERVER_QUERY_ZONE_OBJECTS_SHARD, which keeps the queries within ZONE_BUNDLE_SIZE like the bundles.
+    SHARD_QUERY_SIZE = ZONE_BUNDLE_SIZE // 4
+    SNAPSHOT_PATH = config['StateServer.SNAPSHOT_PATH']
+    SNAPSHOT_INTERVAL = config['StateServer.SNAPSHOT_INTERVAL']
+    SNAPSHOT_MAX_AGE = config['StateServer.SNAPSHOT_MAX_AGE']
+    # Objects encoded per event loop iteration while taking a snapshot.
+    SNAPSHOT_SLICE = 1000
+    # Object ids per STATESERVER_OBJECT_DELETE_RAM_MULTIPLE, 16 KiB of ids keeps it well within a frame.
+    DELETE_BATCH = 4096
+
+    def __init__(self, loop, shard=0):
         DownstreamMessageDirector.__init__(self, loop)
         ChannelAllocator.__init__(self)
 
-        self.dc_file = parse_dc_file('toon.dc')
+        self.shard = shard
+        self.channel = shard_channel(shard)
+        if self.METRICS_PORT:
+            self.METRICS_PORT += shard
+
+        self.dc_file = parse_dc_file(self.DC_FILE)
+        self.field_table = build_field_table(self.dc_file)
+        self.dclass_tables = [DClassTable(dclass, self.field_table) for dclass in self.dc_file.classes]
 
         self.loop.set_exception_handler(self._on_exception)
 
         self.objects: Dict[int, DistributedObject] = {}
+        # AI channel -> ids of the objects it manages, see DistributedObject.set_ai_channel.
+        self.ai_objects: Dict[int, Set[int]] = {}
+        # Parent id -> ids of the objects parented to it, who get what is sent to parent_to_children(parent id).
+        self.children: Dict[int, Set[int]] = {}
+        # Upstream subscriptions made for objects, counted as a do_id can double as a parent_to_children channel.
+        # Participants subscribing to the same channels are counted in channel_subscriptions, see needs_channel.
+        self.object_channels: Dict[int, int] = {}
+        # Zone queries waiting for other shards: query id -> [unanswered queries, the DONE datagram, the expiry timer].
+        self.shard_queries: Dict[int, list] = {}
+        self.next_query_id = 0
+
+        self.snapshot_path = self.SNAPSHOT_PATH.format(shard=shard) if self.SNAPSHOT_PATH else None
+        # One thread, so snapshots reach the disk in the order they were taken.
+        self.snapshot_executor = ThreadPoolExecutor(max_workers=1)
         self.database_objects = set()
         self.queries = {}
 
+        # Object lifecycle and field logging.
+        self.object_log = self.logger('objects')
+
     def _on_exception(self, loop, context):
         print('err', context)
 
     async def run(self):
+        await self.start_metrics()
         await self.connect(config['MessageDirector.HOST'], config['MessageDirector.PORT'])
-        await self.route()
+
+        if self.snapshot_path and self.SNAPSHOT_INTERVAL:
+            self.loop.create_task(self.take_snapshots())
+
+        try:
+            await self.route()
+        finally:
+            if self.snapshot_path:
+                self.snapshot_executor.submit(write_snapshot, self.snapshot_path, self.encode_snapshot()).result()
+                self.log.debug(f'Wrote snapshot of {len(self.objects)} objects to {self.snapshot_path}.')
+
+    async def take_snapshots(self):
+        while True:
+            await asyncio.sleep(self.SNAPSHOT_INTERVAL)
+            data = await self.encode_snapshot_slices()
+            await self.loop.run_in_executor(self.snapshot_executor, write_snapshot, self.snapshot_path, data)
+
+    def encode_snapshot(self) -> bytes:
+        objects = (obj for obj in self.objects.values() if obj.dclass)
+        return encode_snapshot(objects, len(self.field_table), time.time())
+
+    async def encode_snapshot_slices(self) -> bytes:
+        """
+        Encodes the snapshot SNAPSHOT_SLICE objects at a time, letting the loop run in between. Objects deleted in the
+        meantime are left out, the others are captured as they are when their slice is encoded.
+        """
+        taken = time.time()
+        objects = list(self.objects.values())
+        encoded = []
+
+        for start in range(0, len(objects), self.SNAPSHOT_SLICE):
+            for obj in objects[start:start + self.SNAPSHOT_SLICE]:
+                if obj.dclass and self.objects.get(obj.do_id) is obj:
+                    encoded.append(encode_object(obj))
+            await asyncio.sleep(0)
+
+        return join_snapshot(encoded, len(self.field_table), taken)
+
+    def restore_snapshot(self):
+        """
+        Restores the objects of the snapshot unless it is older than SNAPSHOT_MAX_AGE seconds. Objects of AIs that
+        went away while the shard was down are deleted again once the MD confirms it, see check_restored_ais.
+        """
+        try:
+            snapshot = read_snapshot(self.snapshot_path, len(self.field_table), len(self.dc_file.classes))
+        except SnapshotError as e:
+            os.replace(self.snapshot_path, self.snapshot_path + '.bad')
+            self.log.error(f'Moved malformed snapshot {self.snapshot_path} aside: {e}')
+            return
+
+        if snapshot is None:
+            return
+
+        age = time.time() - snapshot.time
+        if self.SNAPSHOT_MAX_AGE and age > self.SNAPSHOT_MAX_AGE:
+            self.log.warning(f'Not restoring {self.snapshot_path}, it is {age:.0f} seconds old.')
+            return
+
+        fields = self.field_table
+        restored = 0
+
+        for entry in snapshot.objects:
+            obj = self.objects.get(entry.do_id)
+
+            if obj is None:
+                if not self.owns(entry.do_id):
+                    continue
+
+                required = {fields[number].name: data for number, data in entry.required}
+                ram = {fields[number].name: data for number, data in entry.ram}
+                obj = DistributedObject(self, STATESERVERS_CHANNEL, entry.do_id, entry.parent_id, entry.zone_id,
+                                        self.dc_file.classes[entry.dclass], required, ram,
+                                        owner_channel=entry.owner_channel, db=entry.db, announce=False)
+                self.objects[entry.do_id] = obj
+                if entry.db:
+                    self.database_objects.add(entry.do_id)
+                restored += 1
+
+            obj.set_ai_channel(entry.ai_channel)
+            obj.ai_explicitly_set = entry.ai_explicitly_set
+            obj.zone_objects = {zone: set(children) for zone, children in entry.zone_objects.items()}
+
+        self.log.debug(f'Restored {restored} objects from {self.snapshot_path}, taken {age:.0f} seconds ago.')
+
+        if self.ai_objects:
+            self.loop.create_task(self.check_restored_ais(list(self.ai_objects)))
+
+    async def check_restored_ais(self, ai_channels):
+        """Deletes the restored objects of the AIs that nobody subscribes to anymore, as if they had sent SHARD_REST."""
+        try:
+            alive = await self.query_subscribed(ai_channels)
+        except asyncio.TimeoutError:
+            self.log.warning('Could not check whether the AIs of restored objects are still connected.')
+            return
+
+        for ai_channel in ai_channels:
+            if ai_channel not in alive:
+                deleted = self.delete_ai_objects(ai_channel)
+                self.log.debug(f'AI {ai_channel} went away while the shard was down, deleted {deleted} objects.')
+
+    def delete_ai_objects(self, ai_channel) -> int:
+        """Deletes the objects the AI manages, returns how many."""
+        do_ids = self.ai_objects.pop(ai_channel, set())
+        deletes = {}
+
+        for do_id in do_ids:
+            obj = self.objects[do_id]
+            # Parents going down with the AI don't need to hear about their children.
+            obj.annihilate(ai_channel, notify_parent=obj.parent_id not in do_ids, deletes=deletes)
+
+        for targets, deleted in deletes.items():
+            for start in range(0, len(deleted), self.DELETE_BATCH):
+                batch = deleted[start:start + self.DELETE_BATCH]
+                dg = Datagram()
+                dg.add_server_header(targets, ai_channel, STATESERVER_OBJECT_DELETE_RAM_MULTIPLE)
+                dg.add_uint16(len(batch))
+                for do_id in batch:
+                    dg.add_uint32(do_id)
+                self.send_datagram(dg)
+
+        return len(do_ids)
 
     def on_upstream_connect(self):
         self.subscribe_channel(self._client, STATESERVERS_CHANNEL)
-        self.objects[self.root_object_id] = DistributedObject(self, STATESERVERS_CHANNEL, self.root_object_id,
-                                                              0, 2, self.dc_file.namespace['DistributedDirectory'],
-                                                              None, None)
+        self.subscribe_channel(self._client, self.channel)
 
-    def resolve_ai_channel(self, parent_id):
-        ai_channel = None
+        if self.owns(self.root_object_id):
+            self.objects[self.root_object_id] = DistributedObject(self, STATESERVERS_CHANNEL, self.root_object_id,
+                                                                  0, 2, self.dc_file.namespace['DistributedDirectory'],
+                                                                  None, None)
+
+        if self.snapshot_path:
+            self.restore_snapshot()
+
+    def owns(self, do_id):
+        return do_id % self.SHARDS == self.shard
+
+    def send_location_entries(self, location, sender, objects):
+        """Sends the location entries of objects in bundles of up to ZONE_BUNDLE_SIZE bytes if location accepts them."""
+        if location not in self.BUNDLE_CHANNELS:
+            for obj in objects:
+                obj.send_location_entry(location)
+            return
+
+        bundle = None
+
+        for obj in objects:
+            entry = Datagram()
+            obj.append_location_entry(entry)
+            entry = entry.bytes()
+
+            if bundle is not None and len(bundle) + 2 + len(entry) > self.ZONE_BUNDLE_SIZE:
+                self.send_datagram(bundle)
+                bundle = None
+
+            if bundle is None:
+                bundle = Datagram()
+                bundle.add_server_header([location], sender, STATESERVER_OBJECT_ENTERZONE_BUNDLE)
+
+            bundle.add_uint16(len(entry))
+            bundle.add_bytes(entry)
+
+        if bundle is not None:
+            self.send_datagram(bundle)
+
+    def query_shards(self, location, parent_id, do_ids, done):
+        """
+        Has the shards owning do_ids send their entries to location, then sends done. Each shard is asked in queries
+        of up to SHARD_QUERY_SIZE do_ids, which it answers one by one. Queries that haven't been answered after
+        SHARD_QUERY_TIMEOUT seconds are given up on.
+        """
+        shards = {}
+        for do_id in do_ids:
+            shard = do_id % self.SHARDS
+            if shard not in shards:
+                shards[shard] = []
+            shards[shard].append(do_id)
+
+        chunks = []
+        for shard, shard_do_ids in shards.items():
+            for start in range(0, len(shard_do_ids), self.SHARD_QUERY_SIZE):
+                chunks.append((shard, shard_do_ids[start:start + self.SHARD_QUERY_SIZE]))
+
+        query_id = self.next_query_id
+        self.next_query_id = (self.next_query_id + 1) & 0xFFFFFFFF
+        expiry = self.loop.call_later(self.SHARD_QUERY_TIMEOUT, self.shard_query_expired, query_id)
+        self.shard_queries[query_id] = [len(chunks), done, expiry]
+
+        for shard, chunk in chunks:
+            dg = Datagram()
+            dg.add_server_header([shard_channel(shard)], self.channel, STATESERVER_QUERY_ZONE_OBJECTS_SHARD)
+            dg.add_uint32(query_id)
+            dg.add_channel(location)
+            dg.add_uint32(parent_id)
+            for do_id in chunk:
+                dg.add_uint32(do_id)
+            self.send_datagram(dg)
+
+    def shard_query_done(self, query_id):
+        query = self.shard_queries.get(query_id)
+        if query is None:
+            return
+
+        query[0] -= 1
+        if not query[0]:
+            del self.shard_queries[query_id]
+            query[2].cancel()
+            self.send_datagram(query[1])
+
+    def shard_query_expired(self, query_id):
+        answers_left, done, _ = self.shard_queries.pop(query_id)
+        self.log.warning(f'Zone query {query_id} timed out waiting for {answers_left} shard queries.')
+        self.send_datagram(done)
+
+    def dispatch_internal(self, recipients, dg, pos):
+        objects = self.objects
+        children = self.children
+        receivers = {}
+
+        for channel in recipients:
+            if channel in objects:
+                receivers[channel] = objects[channel]
 
-        while ai_channel is None:
+            for parent_id in children_to_parents(channel):
+                if parent_id in children:
+                    for do_id in children[parent_id]:
+                        receivers[do_id] = objects[do_id]
+
+        if not receivers:
+            return
+
+        dgi = dg.iterator()
+        dgi.seek(pos)
+        sender = dgi.get_channel()
+        msgtype = dgi.get_uint16()
+        body = dgi.tell()
+
+        for obj in receivers.values():
+            dgi.seek(body)
             try:
-                obj = self.objects[parent_id]
-                parent_id = obj.parent_id
-                ai_channel = obj.ai_channel
-            except KeyError:
-                return None
+                obj.handle_message(dg, dgi, sender, msgtype)
+            except Exception as e:
+                self.log.debug(f'Exception while handling datagram for object {obj.do_id}: {e.__class__}: {repr(e)}')
+
+    def claim_object_channel(self, do_id):
+        self.add_local_channel(do_id)
+        self.watch_channel(do_id)
+
+    def remove_object(self, obj):
+        if obj.parent_id:
+            self.remove_child(obj.parent_id, obj.do_id)
+        self.unwatch_channel(obj.do_id)
+
+    def add_child(self, parent_id, do_id):
+        if parent_id not in self.children:
+            self.children[parent_id] = set()
+            self.watch_channel(parent_to_children(parent_id))
+        self.children[parent_id].add(do_id)
+
+    def remove_child(self, parent_id, do_id):
+        children = self.children[parent_id]
+        children.discard(do_id)
+
+        if not children:
+            del self.children[parent_id]
+            self.unwatch_channel(parent_to_children(parent_id))
+
+    def needs_channel(self, channel) -> bool:
+        return channel in self.object_channels or DownstreamMessageDirector.needs_channel(self, channel)
+
+    def watch_channel(self, channel):
+        if not self.needs_channel(channel):
+            self._client.subscribe_channel(channel)
+        self.object_channels[channel] = self.object_channels.get(channel, 0) + 1
+
+    def unwatch_channel(self, channel):
+        count = self.object_channels[channel] - 1
+
+        if count:
+            self.object_channels[channel] = count
+            return
 
-        return ai_channel
+        del self.object_channels[channel]
+        if not self.needs_channel(channel):
+            self.remove_local_channel(channel)
+            self._client.unsubscribe_channel(channel)
 
+    def metric_gauges(self):
+        gauges = DownstreamMessageDirector.metric_gauges(self)
+        gauges['objects'] = len(self.objects)
+        gauges['database_objects'] = len(self.database_objects)
+        gauges['object_channels'] = len(self.object_channels)
+        return gauges
 
-async def main():
+    def resolve_ai_channel(self, parent_id):
+        # Objects carry the AI they inherit from their ancestors (see DistributedObject.handle_ai_change), so this
+        # only walks up past ancestors that have no AI at all.
+        while parent_id in self.objects:
+            parent = self.objects[parent_id]
+            if parent.ai_channel is not None:
+                return parent.ai_channel
+            parent_id = parent.parent_id
+
+        return None
+
+
+def shard_channel(shard):
+    return STATESERVER_SHARD_CHANNELS + shard
+
+
+async def main(shard):
     loop = asyncio.get_running_loop()
-    service = StateServer(loop)
-    await service.run()
+    service = StateServer(loop, shard)
+    # Stopping run() instead of the process lets it write its last snapshot.
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    try:
+        await service.run()
+    except asyncio.CancelledError:
+        pass
 
 if __name__ == '__main__':
-    asyncio.run(main(), debug=True)
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 0), debug=True)
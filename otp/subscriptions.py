@@ -0,0 +1,240 @@
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterator, List, Tuple, Union
+
+
+class ChannelRangeIndex:
+    """
+    Channel range subscriptions stored as sorted, non-overlapping segments.
+
+    bounds[i] is the first channel of segment i and owners[i] holds the participants subscribed to every channel
+    from bounds[i] up to bounds[i + 1]. The last segment never has owners and neighbouring segments never have the
+    same owners. Ranges are half open, [low, high). A lookup is a single bisect and each range adds at most two
+    bounds, however many channels it covers. Changes only splice the segments between low and high.
+    """
+
+    def __init__(self):
+        self.bounds: List[int] = []
+        self.owners: List[tuple] = []
+
+    def __bool__(self):
+        return bool(self.bounds)
+
+    def lookup(self, channel: int) -> tuple:
+        i = bisect_right(self.bounds, channel) - 1
+        if i < 0:
+            return ()
+        return self.owners[i]
+
+    def add(self, participant, low: int, high: int):
+        if low >= high:
+            return
+
+        start, stop = self._split(low, high)
+        for i in range(start, stop):
+            if participant not in self.owners[i]:
+                self.owners[i] += (participant,)
+        self._compact(start, stop)
+
+    def remove(self, participant, low: int, high: int):
+        if low >= high or not self.bounds:
+            return
+
+        start, stop = self._split(low, high)
+        for i in range(start, stop):
+            if participant in self.owners[i]:
+                self.owners[i] = tuple(owner for owner in self.owners[i] if owner is not participant)
+        self._compact(start, stop)
+
+    def ranges_of(self, participant) -> List[Tuple[int, int]]:
+        """Returns the merged ranges the participant is subscribed to."""
+        return self._collect(0, len(self.owners), lambda owners: participant in owners)
+
+    def covered(self, low: int, high: int, predicate=bool) -> List[Tuple[int, int]]:
+        """Returns the parts of [low, high) whose owners satisfy predicate, by default any owner at all."""
+        if low >= high:
+            return []
+
+        start = max(bisect_right(self.bounds, low) - 1, 0)
+        stop = bisect_right(self.bounds, high - 1)
+        return [(max(lo, low), min(hi, high)) for lo, hi in self._collect(start, stop, predicate)
+                if max(lo, low) < min(hi, high)]
+
+    def uncovered(self, low: int, high: int) -> List[Tuple[int, int]]:
+        """Returns the parts of [low, high) nobody is subscribed to."""
+        gaps = []
+        for lo, hi in self.covered(low, high):
+            if low < lo:
+                gaps.append((low, lo))
+            low = hi
+        if low < high:
+            gaps.append((low, high))
+        return gaps
+
+    def _collect(self, start, stop, predicate):
+        ranges = []
+        for i in range(start, stop):
+            if not predicate(self.owners[i]):
+                continue
+
+            low, high = self.bounds[i], self.bounds[i + 1]
+            if ranges and ranges[-1][1] == low:
+                ranges[-1] = (ranges[-1][0], high)
+            else:
+                ranges.append((low, high))
+        return ranges
+
+    def _split(self, low, high):
+        """Makes sure segments start at low and high, and returns their indices."""
+        return self._split_at(low), self._split_at(high)
+
+    def _split_at(self, point):
+        i = bisect_right(self.bounds, point) - 1
+        if i >= 0 and self.bounds[i] == point:
+            return i
+
+        self.bounds.insert(i + 1, point)
+        self.owners.insert(i + 1, self.owners[i] if i >= 0 else ())
+        return i + 1
+
+    def _compact(self, start, stop):
+        """Drops the bounds from start to stop that no longer separate segments with different owners."""
+        stop = min(stop, len(self.bounds) - 1)
+        previous = self.owners[start - 1] if start > 0 else ()
+        bounds, owners = [], []
+
+        for i in range(start, stop + 1):
+            owner = self.owners[i]
+            if same_owners(previous, owner):
+                continue
+            bounds.append(self.bounds[i])
+            owners.append(owner)
+            previous = owner
+
+        self.bounds[start:stop + 1] = bounds
+        self.owners[start:stop + 1] = owners
+
+
+def same_owners(a: tuple, b: tuple) -> bool:
+    # Owners are kept in the order they subscribed in, so compare them as sets.
+    return a == b or len(a) == len(b) and set(a) == set(b)
+
+
+def subtract_ranges(ranges, removed) -> List[Tuple[int, int]]:
+    """Returns the parts of ranges outside of removed, both sorted lists of disjoint [low, high) ranges."""
+    result = []
+    i = 0
+
+    for low, high in ranges:
+        while i < len(removed) and removed[i][1] <= low:
+            i += 1
+
+        j = i
+        while low < high and j < len(removed) and removed[j][0] < high:
+            removed_low, removed_high = removed[j]
+            if low < removed_low:
+                result.append((low, removed_low))
+            low = max(low, removed_high)
+            j += 1
+
+        if low < high:
+            result.append((low, high))
+
+    return result
+
+
+class SubscriptionTable:
+    """
+    Maps channels to the participants subscribed to them.
+
+    Participants are numbered the first time they subscribe. Most channels (object, client and zone channels) only
+    ever have one subscriber, so a channel stores its subscriber's number directly and only switches to an array of
+    numbers once a second participant subscribes. Channels are removed as soon as their last subscriber leaves.
+    """
+
+    def __init__(self):
+        self.channels: Dict[int, Union[int, array]] = {}
+        self.participants: list = []
+        self.ids: dict = {}
+        self._free_ids: List[int] = []
+
+    def __contains__(self, channel: int) -> bool:
+        return channel in self.channels
+
+    def __len__(self):
+        return len(self.channels)
+
+    def lookup(self, channel: int) -> tuple:
+        entry = self.channels.get(channel)
+        if entry is None:
+            return ()
+        if entry.__class__ is int:
+            return self.participants[entry],
+        return tuple(self.participants[i] for i in entry)
+
+    def subscribed(self, participant, channel: int) -> bool:
+        entry = self.channels.get(channel)
+        i = self.ids.get(participant)
+        if entry is None or i is None:
+            return False
+        if entry.__class__ is int:
+            return entry == i
+        return i in entry
+
+    def add(self, participant, channel: int) -> bool:
+        """Subscribes the participant, returns whether the channel had no subscribers before."""
+        i = self.ids.get(participant)
+        if i is None:
+            i = self._new_id(participant)
+
+        entry = self.channels.get(channel)
+        if entry is None:
+            self.channels[channel] = i
+            return True
+
+        if entry.__class__ is int:
+            if entry != i:
+                self.channels[channel] = array('I', (entry, i))
+        elif i not in entry:
+            entry.append(i)
+        return False
+
+    def remove(self, participant, channel: int) -> bool:
+        """Unsubscribes the participant, returns whether that left the channel without subscribers."""
+        i = self.ids.get(participant)
+        entry = self.channels.get(channel)
+        if i is None or entry is None:
+            return False
+
+        if entry.__class__ is int:
+            if entry != i:
+                return False
+            del self.channels[channel]
+            return True
+
+        if i in entry:
+            entry.remove(i)
+            if len(entry) == 1:
+                self.channels[channel] = entry[0]
+        return False
+
+    def items(self) -> Iterator[Tuple[int, tuple]]:
+        for channel in list(self.channels):
+            yield channel, self.lookup(channel)
+
+    def release(self, participant):
+        """Frees the participant's number, it must not be subscribed to anything anymore."""
+        i = self.ids.pop(participant, None)
+        if i is not None:
+            self.participants[i] = None
+            self._free_ids.append(i)
+
+    def _new_id(self, participant) -> int:
+        if self._free_ids:
+            i = self._free_ids.pop()
+            self.participants[i] = participant
+        else:
+            i = len(self.participants)
+            self.participants.append(participant)
+        self.ids[participant] = i
+        return i
@@ -0,0 +1,129 @@
+"""
+Sampled end-to-end tracing of field updates.
+
+With Tracing.SAMPLE_RATE above 0 the ClientAgent tags that fraction of the field updates clients send with a trace
+id. The id travels as an extra recipient channel from TRACE_CHANNEL_MIN up, which nothing subscribes to, so the
+message formats don't change and services just route it along. Every service a traced datagram passes through
+writes a JSON line per hop to its own file at Tracing.PATH:
+
+    {"trace": 18446462598732840961, "service": "StateServer", "hop": "ss.receive", "time": 1700000000.123456}
+
+Merging the files of all services and sorting each trace by time gives the per-hop breakdown. Like log records,
+records are only put on a queue on the event loop; a writer thread encodes them and writes the files.
+"""
+
+import atexit
+import json
+import queue
+import random
+import threading
+import time
+
+from typing import Iterable, Optional
+
+from dc.util import Datagram
+
+from otp import config
+
+
+SAMPLE_RATE = config['Tracing.SAMPLE_RATE']
+TRACING = SAMPLE_RATE > 0
+
+TRACE_CHANNEL_MIN = 0xFFFF << 48
+
+_queue = queue.SimpleQueue()
+_writer = None
+
+
+def is_trace_channel(channel: int) -> bool:
+    return channel >= TRACE_CHANNEL_MIN
+
+
+def trace_of(recipients: Iterable[int]) -> Optional[int]:
+    for channel in recipients:
+        if channel >= TRACE_CHANNEL_MIN:
+            return channel
+    return None
+
+
+def trace_of_datagram(dg: Datagram) -> Optional[int]:
+    dgi = dg.iterator()
+    return trace_of([dgi.get_channel() for _ in range(dgi.get_uint8())])
+
+
+class TraceWriter(threading.Thread):
+    """Writes the records on the queue to their files, flushing whenever the queue runs empty."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='TraceWriter', daemon=True)
+        self.files = {}
+
+    def run(self):
+        while True:
+            item = _queue.get()
+
+            if item is None:
+                break
+            elif isinstance(item, threading.Event):
+                self.flush()
+                item.set()
+                continue
+
+            path, record = item
+            file = self.files.get(path)
+            if file is None:
+                file = self.files[path] = open(path, 'a')
+            file.write(json.dumps(record) + '\n')
+
+            if _queue.empty():
+                self.flush()
+
+        for file in self.files.values():
+            file.close()
+
+    def flush(self):
+        for file in self.files.values():
+            file.flush()
+
+    def stop(self):
+        _queue.put(None)
+        self.join()
+
+
+def start_writer():
+    global _writer
+
+    _writer = TraceWriter()
+    _writer.start()
+    atexit.register(_writer.stop)
+
+
+def flush_traces():
+    """Blocks until every record so far is written."""
+    if _writer is not None:
+        written = threading.Event()
+        _queue.put(written)
+        written.wait()
+
+
+class Tracer:
+    PATH = config['Tracing.PATH']
+
+    def __init__(self, service_name: str):
+        self.service_name = service_name
+        self.path = None
+
+    def sample(self) -> Optional[int]:
+        if random.random() < SAMPLE_RATE:
+            return TRACE_CHANNEL_MIN + random.getrandbits(48)
+        return None
+
+    def record(self, trace_id: int, hop: str, **fields):
+        if self.path is None:
+            if _writer is None:
+                start_writer()
+            self.path = self.PATH.format(service=self.service_name)
+
+        record = {'trace': trace_id, 'service': self.service_name, 'hop': hop, 'time': time.time()}
+        record.update(fields)
+        _queue.put((self.path, record))
@@ -37,30 +37,12 @@ class UberdogProtocol(MDUpstreamProtocol):
                 return
             self.service.receive_update(sender, dgi)
 
-    def check_futures(self, dgi, msg_id, sender):
-        pos = dgi.tell()
-        for i in range(len(self.futures)):
-            future = self.futures[i]
-            if future.future_msg_id == msg_id and future.future_sender == sender:
-                if not future.context:
-                    self.futures.remove(future)
-                    future.set_result((sender, dgi))
-                    return True
-                else:
-                    context = dgi.get_uint32()
-                    dgi.seek(pos)
-                    if future.context == context:
-                        self.futures.remove(future)
-                        future.set_result((sender, dgi))
-                        return True
-        else:
-            return False
-
 
 class Uberdog(DownstreamMessageDirector):
     upstream_protocol = UberdogProtocol
     GLOBAL_ID = None
     GAME_ID = OTP_DO_ID_COMMON
+    METRICS_PORT = config['Uberdog.METRICS_PORT']
 
     def __init__(self, loop):
         DownstreamMessageDirector.__init__(self, loop)
@@ -70,6 +52,7 @@ class Uberdog(DownstreamMessageDirector):
         self.last_sender = None
 
     async def run(self):
+        await self.start_metrics()
         await self.connect(config['MessageDirector.HOST'], config['MessageDirector.PORT'])
         await self.route()
 
@@ -94,9 +77,9 @@ class Uberdog(DownstreamMessageDirector):
         self.log.debug(f'Receiving field update for field {field.name} from {sender}.')
         field.receive_update(self, dgi)
 
-    def register_future(self, msg_type, sender, context):
-        f = DatagramFuture(self.loop, msg_type, sender, context)
-        self._client.futures.append(f)
+    def register_future(self, msg_type, sender, context, timeout=None):
+        f = DatagramFuture(self.loop, msg_type, sender, context, timeout)
+        self._client.futures.add(f)
         return f
 
     async def query_location(self, avId, context):
@@ -106,11 +89,11 @@ class Uberdog(DownstreamMessageDirector):
         dg.add_uint32(avId)
         self.send_datagram(dg)
 
-        f = self.register_future(STATESERVER_OBJECT_LOCATE_RESP, avId, context)
+        f = self.register_future(STATESERVER_OBJECT_LOCATE_RESP, avId, context, timeout=10)
 
         try:
-            sender, dgi = await asyncio.wait_for(f, timeout=10, loop=self.loop)
-        except TimeoutError:
+            sender, dgi = await f
+        except asyncio.TimeoutError:
             return None, None
         dgi.get_uint32(), dgi.get_uint32()
         success = dgi.get_uint8()
@@ -8,4 +8,11 @@ def location_as_channel(parent_id, zone):
 
 
 def parent_to_children(parent_id):
-    return (1 << ZONE_BITS) | parent_id
\ No newline at end of file
+    return (1 << ZONE_BITS) | parent_id
+
+
+def children_to_parents(channel):
+    """Returns the parent ids parent_to_children maps to channel."""
+    if not channel & (1 << ZONE_BITS):
+        return ()
+    return channel, channel & ~(1 << ZONE_BITS)
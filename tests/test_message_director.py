@@ -1,19 +1,734 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
 import unittest
+from collections import Counter
 
-from otp.networking import DownstreamClient, OTPProtocol
+from dc.util import Datagram
+from dc.messagetypes import CONTROL_MESSAGE, CONTROL_SET_CHANNEL
+
+from otp.messagedirector import ChannelBatcher, DownstreamMessageDirector, MasterMessageDirector, MDProtocol
+from otp.messagetypes import STATESERVER_OBJECT_UPDATE_FIELD, STATESERVER_OBJECT_DELETE_RAM, CONTROL_UPDATE_CHANNELS
+from otp.networking import (DownstreamClient, MDParticipant, OTPProtocol, DatagramFuture, FutureRegistry, LANE_BULK,
+                            LANE_CONTROL, frame_datagram)
+from otp.log import get_logger
+from otp.metrics import Metrics
+from otp.subscriptions import ChannelRangeIndex, SubscriptionTable, same_owners
+from otp.tracing import Tracer, TRACE_CHANNEL_MIN, flush_traces, trace_of_datagram
+
+from benchmarks.harness import Harness, WORKLOADS
+from benchmarks.latency import BenchService, HOST
+
+
+class TestTransport(asyncio.Transport):
+    def __init__(self):
+        asyncio.Transport.__init__(self, {'peername': ('127.0.0.1', 4000)})
+        self.closing = False
+        self.written = []
+        self.reading = True
+        self.buffered = 0
+
+    def is_closing(self):
+        return self.closing
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def writelines(self, frames):
+        self.written.extend(frames)
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+
+class TestService:
+    def __init__(self, loop):
+        self.loop = loop
+        self.flow_counters = Counter()
+        self.throttled = set()
+        self.flow_peers = set()
+        self.log = logging.getLogger('TestService')
 
 
 class TestProtocol(OTPProtocol):
-    pass
+    def __init__(self, service):
+        OTPProtocol.__init__(self, service)
+        self.transport = TestTransport()
+        self.received = []
+
+    def receive_datagram(self, dg):
+        self.received.append(dg.bytes())
 
 
 class TestClient(DownstreamClient):
     upstream_protocol = TestProtocol
 
 
-class TestMessageDirector(unittest.TestCase):
-    pass
+def frame(payload: bytes) -> bytes:
+    return len(payload).to_bytes(2, byteorder='little') + payload
+
+
+class RangeRecorder:
+    def __init__(self):
+        self.ranges = []
+
+    def subscribe_range(self, low, high):
+        self.ranges.append(('+', low, high))
+
+    def unsubscribe_range(self, low, high):
+        self.ranges.append(('-', low, high))
+
+
+class TestFraming(unittest.TestCase):
+    def test_many_frames_in_one_read(self):
+        protocol = TestProtocol(None)
+        payloads = [bytes([i & 0xFF]) * i for i in range(300)]
+        protocol.data_received(b''.join(frame(payload) for payload in payloads))
+        self.assertEqual(protocol.received, payloads)
+        self.assertFalse(protocol.buf)
+
+    def test_split_reads(self):
+        protocol = TestProtocol(None)
+        data = frame(b'first') + frame(b'') + frame(b'second')
+
+        for i in range(len(data)):
+            protocol.data_received(data[i:i + 1])
+
+        self.assertEqual(protocol.received, [b'first', b'', b'second'])
+        self.assertFalse(protocol.buf)
+
+    def test_partial_frame_is_kept(self):
+        protocol = TestProtocol(None)
+        data = frame(b'complete') + frame(b'partial')
+        protocol.data_received(data[:-3])
+        self.assertEqual(protocol.received, [b'complete'])
+        protocol.data_received(data[-3:])
+        self.assertEqual(protocol.received, [b'complete', b'partial'])
+
+    def test_stops_when_closing(self):
+        protocol = TestProtocol(None)
+        protocol.transport.closing = True
+        protocol.data_received(frame(b'a') + frame(b'b'))
+        self.assertEqual(protocol.received, [b'a'])
+
+
+class TestLanes(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.protocol = TestProtocol(TestService(self.loop))
+
+    def tearDown(self):
+        self.loop.close()
+
+    def server_frame(self, msg_type, i=0):
+        dg = Datagram()
+        dg.add_server_header([5000], 1000, msg_type)
+        dg.add_uint32(i)
+        return frame(dg.bytes())
+
+    def test_lane_of(self):
+        dg = Datagram()
+        dg.add_server_control_header(CONTROL_SET_CHANNEL)
+        dg.add_channel(5000)
+        self.assertEqual(self.protocol.lane_of(frame(dg.bytes())), LANE_CONTROL)
+        self.assertEqual(self.protocol.lane_of(self.server_frame(STATESERVER_OBJECT_UPDATE_FIELD)), LANE_BULK)
+        self.assertEqual(self.protocol.lane_of(self.server_frame(STATESERVER_OBJECT_DELETE_RAM)), LANE_CONTROL)
+
+    def test_weighted_drain(self):
+        bulk = [self.server_frame(STATESERVER_OBJECT_UPDATE_FIELD, i) for i in range(20)]
+        control = [self.server_frame(STATESERVER_OBJECT_DELETE_RAM, 100 + i) for i in range(20)]
+        for bulk_frame, control_frame in zip(bulk, control):
+            self.protocol.send_frame(bulk_frame)
+            self.protocol.send_frame(control_frame)
+
+        self.protocol.WRITE_HIGH_WATER = len(bulk[0]) * 9 - 1
+        self.protocol.flush()
+        self.assertEqual(self.protocol.transport.written, control[:8] + bulk[:1])
+
+        # Once everything fits, the rest goes out in the order it was sent in.
+        self.protocol.WRITE_HIGH_WATER = 1 << 16
+        self.protocol.flush()
+        rest = bulk[1:8] + [frame for pair in zip(bulk[8:], control[8:]) for frame in pair]
+        self.assertEqual(self.protocol.transport.written, control[:8] + bulk[:1] + rest)
+        self.assertEqual(self.protocol.outgoing_size, 0)
+
+    def test_fifo_when_not_congested(self):
+        frames = [self.server_frame(STATESERVER_OBJECT_UPDATE_FIELD if i % 3 else STATESERVER_OBJECT_DELETE_RAM, i)
+                  for i in range(30)]
+        for sent in frames:
+            self.protocol.send_frame(sent)
+
+        self.protocol.flush()
+        self.assertEqual(self.protocol.transport.written, frames)
+
+    def test_drain_keeps_object_order(self):
+        update = self.server_frame(STATESERVER_OBJECT_UPDATE_FIELD, 5)
+        other_update = self.server_frame(STATESERVER_OBJECT_UPDATE_FIELD, 6)
+        delete = self.server_frame(STATESERVER_OBJECT_DELETE_RAM, 5)
+        other_delete = self.server_frame(STATESERVER_OBJECT_DELETE_RAM, 7)
+        for sent in (other_update, update, delete, other_delete):
+            self.protocol.send_frame(sent)
+
+        self.protocol.WRITE_HIGH_WATER = 1
+        while self.protocol.outgoing_size:
+            self.protocol.flush()
+
+        # The delete can't overtake the update of its object, so the control lane waits for it.
+        self.assertEqual(self.protocol.transport.written, [other_update, update, delete, other_delete])
+
+    def test_waits_for_room(self):
+        self.protocol.send_frame(self.server_frame(STATESERVER_OBJECT_UPDATE_FIELD))
+        self.protocol.transport.buffered = self.protocol.WRITE_HIGH_WATER + 1
+        self.protocol.flush()
+
+        self.assertEqual(self.protocol.transport.written, [])
+        self.assertIsNone(self.protocol._flush_handle)
+
+    def test_drop_sheds_bulk_first(self):
+        self.protocol.SLOW_CONSUMER_POLICY = 'drop'
+        bulk = [self.server_frame(STATESERVER_OBJECT_UPDATE_FIELD, i) for i in range(4)]
+        self.protocol.MAX_PENDING = len(bulk[0]) * 4
+        self.protocol.paused = True
+
+        for bulk_frame in bulk:
+            self.protocol.send_frame(bulk_frame)
+        self.protocol.send_frame(self.server_frame(STATESERVER_OBJECT_UPDATE_FIELD, 4))
+        self.protocol.send_frame(self.server_frame(STATESERVER_OBJECT_DELETE_RAM))
+
+        self.assertEqual(self.protocol.lane_depths(), (1, 3))
+        self.assertEqual(list(self.protocol.lanes[LANE_BULK]), bulk[1:])
+        self.assertEqual(self.protocol.dropped_frames, 2)
+
+        # The connection is reported by peer until it closes.
+        service = self.protocol.service
+        service.metric_gauges = dict
+        lines = Metrics(service).render().splitlines()
+        self.assertIn('otp_connection_dropped_frames_total{service="TestService",peer="127.0.0.1:4000"} 2', lines)
+        self.assertIn('otp_connection_lane_depth{service="TestService",peer="127.0.0.1:4000",lane="bulk"} 3', lines)
+        self.assertIn('otp_connection_lane_peak{service="TestService",peer="127.0.0.1:4000",lane="bulk"} 4', lines)
+        self.protocol.connection_lost(None)
+        self.assertEqual(service.flow_peers, set())
+
+
+class TestFlowControl(unittest.TestCase):
+    def test_block_resumes_what_it_paused(self):
+        service = TestService(None)
+        feeders = [TestProtocol(service) for _ in range(2)]
+        slow = TestProtocol(service)
+        slow.upstream_protocols = lambda: list(feeders)
+
+        slow.pause_writing()
+        self.assertFalse(any(feeder.transport.reading for feeder in feeders))
+
+        # Connected while the slow consumer was paused, it was never blocked and must not be unblocked.
+        feeders.append(TestProtocol(service))
+        slow.resume_writing()
+
+        self.assertEqual([feeder.read_blocks for feeder in feeders], [0, 0, 0])
+        self.assertTrue(all(feeder.transport.reading for feeder in feeders))
+
+        slow.pause_writing()
+        self.assertFalse(feeders[2].transport.reading)
+        slow.resume_writing()
+        self.assertEqual(service.throttled, set())
+
+
+class BatchingProtocol(ChannelBatcher, TestProtocol):
+    def __init__(self, service):
+        TestProtocol.__init__(self, service)
+        ChannelBatcher.__init__(self)
+
+
+class TestChannelBatcher(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.protocol = BatchingProtocol(TestService(self.loop))
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_once(self):
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def written(self):
+        """Returns the message type, added and removed channels of the frames written."""
+        messages = []
+        for written in self.protocol.transport.written:
+            dg = Datagram()
+            dg.add_bytes(written[2:])
+            dgi = dg.iterator()
+            self.assertEqual([dgi.get_channel() for _ in range(dgi.get_uint8())], [CONTROL_MESSAGE])
+            msg_type = dgi.get_uint16()
+            added = [dgi.get_channel() for _ in range(dgi.get_uint16())]
+            removed = [dgi.get_channel() for _ in range(dgi.get_uint16())]
+            messages.append((msg_type, added, removed))
+        return messages
+
+    def test_changes_are_coalesced(self):
+        for channel in (1, 2, 3):
+            self.protocol.queue_channel_change(channel, True)
+        self.protocol.queue_channel_change(10, False)
+        self.run_once()
+        self.assertEqual(self.written(), [(CONTROL_UPDATE_CHANNELS, [1, 2, 3], [10])])
+
+    def test_opposite_changes_cancel(self):
+        self.protocol.queue_channel_change(1, True)
+        self.protocol.queue_channel_change(2, True)
+        self.protocol.queue_channel_change(2, False)
+        self.protocol.queue_channel_change(3, False)
+        self.protocol.queue_channel_change(3, True)
+        self.run_once()
+        self.assertEqual(self.written(), [(CONTROL_UPDATE_CHANNELS, [1], [])])
+
+        self.protocol.queue_channel_change(4, True)
+        self.protocol.queue_channel_change(4, False)
+        self.run_once()
+        self.assertEqual(len(self.protocol.transport.written), 1)
+
+    def test_large_batches_are_split(self):
+        self.protocol.MAX_BATCH_CHANNELS = 2
+        for channel in range(5):
+            self.protocol.queue_channel_change(channel, channel != 3)
+        self.run_once()
+        self.assertEqual(self.written(), [(CONTROL_UPDATE_CHANNELS, [0, 1], []),
+                                          (CONTROL_UPDATE_CHANNELS, [2], [3]),
+                                          (CONTROL_UPDATE_CHANNELS, [4], [])])
+
+    def test_changes_go_before_later_frames(self):
+        self.protocol.queue_channel_change(1, True)
+        dg = Datagram()
+        dg.add_server_header([5000], 1000, STATESERVER_OBJECT_UPDATE_FIELD)
+        update = frame_datagram(dg)
+        self.protocol.send_frame(update)
+        self.run_once()
+        self.assertEqual(len(self.protocol.transport.written), 2)
+        self.assertEqual(self.protocol.transport.written[1], update)
+        self.protocol.transport.written.pop()
+        self.assertEqual(self.written(), [(CONTROL_UPDATE_CHANNELS, [1], [])])
+
+
+class TestFutureRegistry(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def response(self, context):
+        dg = Datagram()
+        dg.add_uint32(context)
+        return dg.iterator()
+
+    def test_resolve_by_context(self):
+        registry = FutureRegistry()
+        first = DatagramFuture(self.loop, 1, sender=5, context=10)
+        second = DatagramFuture(self.loop, 1, sender=5, context=11)
+        registry.add(first)
+        registry.add(second)
+
+        self.assertTrue(registry.resolve(self.response(11), 1, 5))
+        self.assertTrue(second.done())
+        self.assertFalse(first.done())
+        self.assertFalse(registry.resolve(self.response(12), 1, 5))
+        self.assertEqual(len(registry), 1)
+
+    def test_any_sender(self):
+        registry = FutureRegistry()
+        future = DatagramFuture(self.loop, 1)
+        registry.add(future)
+        self.assertFalse(registry.resolve(self.response(0), 2, 5))
+        self.assertTrue(registry.resolve(self.response(0), 1, 5))
+        self.assertEqual(future.result()[0], 5)
+
+    def test_timeout_and_cancel_remove_future(self):
+        registry = FutureRegistry()
+        registry.TICK = 0.01
+        expiring = DatagramFuture(self.loop, 1, timeout=0.02)
+        cancelled = DatagramFuture(self.loop, 2)
+        registry.add(expiring)
+        registry.add(cancelled)
+        cancelled.cancel()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(expiring)
+
+        self.assertEqual(len(registry), 0)
+
+    def test_resolved_futures_leave_the_wheel(self):
+        registry = FutureRegistry()
+        futures = [DatagramFuture(self.loop, 1, timeout=30) for _ in range(100)]
+        for future in futures:
+            registry.add(future)
+
+        for _ in futures:
+            registry.resolve(self.response(0), 1, 5)
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(len(registry), 0)
+        self.assertEqual(registry._wheel, {})
+        registry.cancel_all()
+
+
+class TestChannelRangeIndex(unittest.TestCase):
+    def test_lookup(self):
+        index = ChannelRangeIndex()
+        index.add('a', 100, 1000000)
+        index.add('b', 500, 600)
+
+        self.assertEqual(index.lookup(99), ())
+        self.assertEqual(index.lookup(100), ('a',))
+        self.assertEqual(set(index.lookup(550)), {'a', 'b'})
+        self.assertEqual(index.lookup(600), ('a',))
+        self.assertEqual(index.lookup(1000000), ())
+        self.assertEqual(len(index.bounds), 4)
+
+    def test_remove_splits_range(self):
+        index = ChannelRangeIndex()
+        index.add('a', 0, 100)
+        index.remove('a', 40, 60)
+
+        self.assertEqual(index.ranges_of('a'), [(0, 40), (60, 100)])
+        self.assertEqual(index.lookup(50), ())
+        self.assertEqual(index.uncovered(0, 100), [(40, 60)])
+
+        index.remove('a', 0, 100)
+        self.assertFalse(index)
+
+    def test_uncovered(self):
+        index = ChannelRangeIndex()
+        index.add('a', 10, 20)
+        index.add('b', 30, 40)
+
+        self.assertEqual(index.uncovered(0, 50), [(0, 10), (20, 30), (40, 50)])
+        self.assertEqual(index.uncovered(12, 18), [])
+        self.assertEqual(index.covered(15, 35), [(15, 20), (30, 35)])
+
+    def test_compaction_ignores_subscription_order(self):
+        index = ChannelRangeIndex()
+        index.add('a', 0, 10)
+        index.add('b', 0, 10)
+        index.add('b', 10, 20)
+        index.add('a', 10, 20)
+
+        self.assertEqual(index.bounds, [0, 20])
+        self.assertEqual(index.ranges_of('a'), [(0, 20)])
+
+    def test_matches_brute_force(self):
+        rng = random.Random(7)
+        index = ChannelRangeIndex()
+        expected = {channel: set() for channel in range(64)}
+
+        for _ in range(2000):
+            participant = rng.choice('abc')
+            low = rng.randrange(64)
+            high = rng.randrange(low, 65)
+            if rng.random() < 0.5:
+                index.add(participant, low, high)
+                for channel in range(low, high):
+                    expected[channel].add(participant)
+            else:
+                index.remove(participant, low, high)
+                for channel in range(low, high):
+                    expected[channel].discard(participant)
+
+            self.assertEqual({channel: set(index.lookup(channel)) for channel in expected}, expected)
+            self.assertFalse(any(same_owners(a, b) for a, b in zip(index.owners, index.owners[1:])))
+
+    def test_upstream_unsubscribes_only_what_was_covered(self):
+        md = DownstreamMessageDirector(None)
+        md._client = RangeRecorder()
+
+        md.subscribe_range('a', 100, 200)
+        md.unsubscribe_range('a', 0, 300)
+        md.unsubscribe_range('b', 0, 300)
+        self.assertEqual(md._client.ranges, [('+', 100, 200), ('-', 100, 200)])
+
+        md.subscribe_range('a', 0, 100)
+        md.subscribe_range('b', 50, 150)
+        md.unsubscribe_range('a', 0, 100)
+        self.assertEqual(md._client.ranges[2:], [('+', 0, 100), ('+', 100, 150), ('-', 0, 50)])
+
+
+class TestSubscriptionTable(unittest.TestCase):
+    def test_add_remove(self):
+        table = SubscriptionTable()
+        self.assertTrue(table.add('a', 5))
+        self.assertFalse(table.add('a', 5))
+        self.assertFalse(table.add('b', 5))
+        self.assertEqual(set(table.lookup(5)), {'a', 'b'})
+        self.assertTrue(table.subscribed('b', 5))
+        self.assertFalse(table.subscribed('b', 6))
+
+        self.assertFalse(table.remove('a', 5))
+        self.assertEqual(table.lookup(5), ('b',))
+        self.assertFalse(table.remove('a', 5))
+        self.assertTrue(table.remove('b', 5))
+        self.assertNotIn(5, table)
+        self.assertEqual(len(table), 0)
+
+    def test_release_reuses_ids(self):
+        table = SubscriptionTable()
+        table.add('a', 1)
+        table.remove('a', 1)
+        table.release('a')
+        table.add('b', 2)
+        self.assertEqual(table.ids, {'b': 0})
+        self.assertEqual(table.lookup(2), ('b',))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        service = TestService(None)
+        service.metric_gauges = lambda: {'objects': 3}
+        metrics = Metrics(service)
+        metrics.observe('server', STATESERVER_OBJECT_UPDATE_FIELD, 40, 0.0002)
+        metrics.observe('server', STATESERVER_OBJECT_UPDATE_FIELD, 60, 2.0)
+
+        lines = metrics.render().splitlines()
+        labels = 'service="TestService",kind="server",type="STATESERVER_OBJECT_UPDATE_FIELD"'
+        self.assertIn(f'otp_messages_total{{{labels}}} 2', lines)
+        self.assertIn(f'otp_message_bytes_total{{{labels}}} 100', lines)
+        self.assertIn(f'otp_message_handling_seconds_bucket{{{labels},le="0.0005"}} 1', lines)
+        self.assertIn(f'otp_message_handling_seconds_bucket{{{labels},le="+Inf"}} 2', lines)
+        self.assertIn('otp_objects{service="TestService"} 3', lines)
+
+
+class TestLogging(unittest.TestCase):
+    def test_disabled_records_are_not_formatted(self):
+        formatted = []
+
+        class Argument:
+            def __str__(self):
+                formatted.append(True)
+                return 'argument'
+
+        log = get_logger('TestLoggingService')
+        category = get_logger('TestLoggingService.objects')
+        self.assertIs(category.parent, log)
+        self.assertFalse(category.handlers)
+
+        category.setLevel(logging.INFO)
+        category.debug('Skipped %s', Argument())
+        self.assertEqual(formatted, [])
+
+
+class TestTracing(unittest.TestCase):
+    def test_record(self):
+        dg = Datagram()
+        dg.add_server_header([5000, TRACE_CHANNEL_MIN + 7], 1000, STATESERVER_OBJECT_UPDATE_FIELD)
+        trace_id = trace_of_datagram(dg)
+        self.assertEqual(trace_id, TRACE_CHANNEL_MIN + 7)
+
+        with tempfile.TemporaryDirectory() as directory:
+            tracer = Tracer('TestService')
+            tracer.PATH = os.path.join(directory, '{service}.trace')
+            tracer.record(trace_id, 'md.receive')
+            tracer.record(trace_id, 'md.send', receivers=2)
+            flush_traces()
+
+            with open(os.path.join(directory, 'TestService.trace')) as f:
+                records = [json.loads(line) for line in f]
+
+        self.assertEqual([record['hop'] for record in records], ['md.receive', 'md.send'])
+        self.assertEqual(records[1]['receivers'], 2)
+        self.assertEqual(records[0]['trace'], trace_id)
+
+
+class TestMessageDirector(unittest.IsolatedAsyncioTestCase):
+    async def test_workloads(self):
+        harness = Harness(asyncio.get_running_loop(), 4, port=57112)
+        await harness.start()
+        self.addCleanup(harness.stop)
+
+        for name in WORKLOADS:
+            result = await asyncio.wait_for(harness.run(name, 200), 5)
+            self.assertEqual(len(result.route_time), 200)
+            self.assertEqual(len(result.latency), result.deliveries)
+            self.assertGreater(result.bytes_copied, 0)
+
+
+class Recorder(BenchService):
+    def __init__(self, loop, channel):
+        BenchService.__init__(self, loop, channel)
+        self.received = []
+
+    def receive(self, sender, msg_type, dgi):
+        self.received.append(dgi.get_uint32())
+
+
+class ClaimingParticipant(MDParticipant):
+    def __init__(self, service, channel):
+        MDParticipant.__init__(self, service)
+        self.received = []
+        self.claim_channel(channel)
+
+    def handle_datagram(self, dg, dgi):
+        dgi.get_channel()
+        dgi.get_uint16()
+        self.received.append(dgi.get_uint32())
+
+
+class SubscribingParticipant(ClaimingParticipant):
+    def claim_channel(self, channel):
+        self.subscribe_channel(channel)
+
+
+class TestFanOut(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.md = MasterMessageDirector(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def connect(self):
+        protocol = MDProtocol(self.md)
+        protocol.transport = TestTransport()
+        self.md.subscribe_channel(protocol, 5000)
+        return protocol
+
+    def test_frame_is_encoded_once(self):
+        connections = [self.connect() for _ in range(20)]
+        local = SubscribingParticipant(self.md, 5000)
+
+        dg = Datagram()
+        dg.add_server_header([5000], 1, STATESERVER_OBJECT_UPDATE_FIELD)
+        dg.add_uint32(7)
+        self.md.process_datagram(None, dg)
+
+        # Every connection holds the same wire frame, local participants still get the datagram itself.
+        frames = [protocol.lanes[LANE_BULK][0] for protocol in connections]
+        self.assertEqual(frames[0], frame_datagram(dg))
+        self.assertTrue(all(frame is frames[0] for frame in frames))
+        self.assertEqual(local.received, [7])
+
+        for protocol in connections:
+            protocol.flush()
+            self.assertEqual(protocol.transport.written, [frames[0]])
+
+
+class TestSharedChannels(unittest.IsolatedAsyncioTestCase):
+    PORT = 57113
+
+    async def asyncSetUp(self):
+        loop = asyncio.get_running_loop()
+        self.md = MasterMessageDirector(loop)
+        self.task = loop.create_task(self.md.listen(HOST, self.PORT))
+        while self.md._server is None or not self.md._server.is_serving():
+            await asyncio.sleep(0.01)
+
+        self.owner = Recorder(loop, 1)
+        self.other = Recorder(loop, 2)
+        await self.owner.run(self.PORT)
+        await self.other.run(self.PORT)
+        self.claimer = ClaimingParticipant(self.owner, 5000)
+
+    async def asyncTearDown(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    def send(self, i):
+        dg = Datagram()
+        dg.add_server_header([5000], 1, STATESERVER_OBJECT_UPDATE_FIELD)
+        dg.add_uint32(i)
+        self.owner.send_datagram(dg)
+
+    async def test_shared_claimed_channel_goes_upstream(self):
+        await asyncio.sleep(0.05)
+        self.send(1)
+        self.assertEqual(self.owner.flow_counters['routed_local'], 1)
+
+        self.other.subscribe_channel(self.other._client, 5000)
+        await asyncio.sleep(0.05)
+        self.assertIn(5000, self.owner.shared_channels)
+        self.send(2)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.other.received, [2])
+        self.assertEqual(self.claimer.received, [1, 2])
+
+        self.other.unsubscribe_channel(self.other._client, 5000)
+        await asyncio.sleep(0.05)
+        self.assertNotIn(5000, self.owner.shared_channels)
+        self.send(3)
+        self.assertEqual(self.claimer.received, [1, 2, 3])
+        self.assertEqual(self.owner.flow_counters['routed_local'], 2)
+        self.assertEqual(self.owner.flow_counters['routed_upstream'], 1)
+        self.assertIn(f'otp_flow_routed_local_total{{service="{self.owner.__class__.__name__}"}} 2',
+                      self.owner.metrics.render().splitlines())
+
+    async def test_query_subscribed(self):
+        # Only channels somebody besides the asking process subscribes to count.
+        self.assertEqual(await self.owner.query_subscribed([1, 2, 3, 5000]), {2})
+        self.other.subscribe_channel(self.other._client, 5000)
+        await asyncio.sleep(0.05)
+        self.assertEqual(await self.owner.query_subscribed([5000]), {5000})
+
+
+class TestFederation(unittest.IsolatedAsyncioTestCase):
+    HOST = '127.0.0.1'
+    PORTS = (57110, 57111)
+
+    async def asyncSetUp(self):
+        loop = asyncio.get_running_loop()
+        self.mds = [MasterMessageDirector(loop) for _ in self.PORTS]
+        self.tasks = [loop.create_task(md.listen(self.HOST, port)) for md, port in zip(self.mds, self.PORTS)]
+        await self.wait_for(lambda: all(md._server is not None and md._server.is_serving() for md in self.mds))
+
+        self.mds[1].PEER_RETRY_DELAY = 0.01
+        self.tasks.append(loop.create_task(self.mds[1].connect_peer(self.HOST, self.PORTS[0])))
+        await self.wait_for(lambda: all(md.peers for md in self.mds))
+
+    async def asyncTearDown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('timed out')
+
+    async def connect(self, port, channel=None):
+        reader, writer = await asyncio.open_connection(self.HOST, port)
+        self.addCleanup(writer.close)
+        if channel is not None:
+            dg = Datagram()
+            dg.add_uint8(1)
+            dg.add_channel(CONTROL_MESSAGE)
+            dg.add_uint16(CONTROL_SET_CHANNEL)
+            dg.add_channel(channel)
+            writer.write(frame(dg.bytes()))
+        return reader, writer
+
+    async def test_routes_between_peers(self):
+        reader, _ = await self.connect(self.PORTS[0], channel=5000)
+        await self.wait_for(lambda: 5000 in self.mds[1].channel_subscriptions)
+        self.assertTrue(all(participant.is_peer for participant in self.mds[1].channel_subscriptions.lookup(5000)))
+
+        _, writer = await self.connect(self.PORTS[1])
+        dg = Datagram()
+        dg.add_server_header([5000], 1, 1)
+        dg.add_uint32(1234)
+        writer.write(frame(dg.bytes()))
+
+        data = await asyncio.wait_for(reader.readexactly(len(dg.bytes()) + 2), 1)
+        self.assertEqual(data, frame(dg.bytes()))
+
+        # A slow client never pauses reading on peer links.
+        for client in self.mds[0]._clients:
+            self.assertFalse(any(protocol.is_peer for protocol in client.upstream_protocols()))
 
+        # Delivered exactly once, the datagram must not bounce back over the peer link.
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(reader.read(1), 0.1)
 
 
 if __name__ == '__main__':
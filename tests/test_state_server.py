@@ -0,0 +1,550 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from dc.util import Datagram
+
+from otp.constants import STATESERVERS_CHANNEL
+from otp.messagedirector import MasterMessageDirector
+from otp.messagetypes import (STATESERVER_OBJECT_UPDATE_FIELD, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED,
+                              STATESERVER_ADD_AI_RECV, STATESERVER_QUERY_ZONE_OBJECT_ALL,
+                              STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE, STATESERVER_OBJECT_ENTERZONE_BUNDLE,
+                              STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER, CONTROL_MESSAGE,
+                              CONTROL_SUBSCRIBED_CHANNELS, STATESERVER_OBJECT_CREATE_WITH_REQUIR_OTHER_CONTEXT,
+                              DBSERVER_GET_STORED_VALUES, DBSERVER_GET_STORED_VALUES_RESP, DBSERVER_SET_STORED_VALUES,
+                              STATESERVER_OBJECT_NOTIFY_MANAGING_AI)
+from otp.networking import FutureRegistry, MDParticipant
+from otp.snapshot import HEADER, MAGIC, VERSION, write_snapshot
+from otp.stateserver import DistributedObject, StateServer, StateServerProtocol
+from otp.zone import parent_to_children
+
+from benchmarks.latency import BenchService, HOST
+
+
+def value(number):
+    """Encodes a value of the uint32 fields of test.dc."""
+    return number.to_bytes(4, byteorder='little')
+
+
+class FixtureStateServer(StateServer):
+    DC_FILE = os.path.join(os.path.dirname(__file__), 'test.dc')
+
+
+class UpstreamRecorder:
+    """Stands in for the connection to the upstream MD."""
+
+    def __init__(self):
+        self.subscriptions = []
+        self.sent = []
+        self.futures = FutureRegistry()
+
+    def subscribe_channel(self, channel):
+        self.subscriptions.append(('+', channel))
+
+    def unsubscribe_channel(self, channel):
+        self.subscriptions.append(('-', channel))
+
+    def send_datagram(self, dg):
+        self.sent.append(dg.bytes())
+
+
+class ServiceRecorder(BenchService):
+    """Plays a ClientAgent or an AI, keeps what is sent to its channel."""
+
+    def __init__(self, loop, channel):
+        BenchService.__init__(self, loop, channel)
+        self.received = []
+
+    def receive(self, sender, msg_type, dgi):
+        self.received.append((sender, msg_type, dgi.remaining_bytes()))
+
+
+class ObjectRecorder:
+    def __init__(self, do_id):
+        self.do_id = do_id
+        self.received = []
+
+    def handle_message(self, dg, dgi, sender, msgtype):
+        self.received.append((sender, msgtype, dgi.get_uint32()))
+
+
+class StateServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.state_server = FixtureStateServer(self.loop)
+        self.upstream = self.state_server._client = UpstreamRecorder()
+
+    def tearDown(self):
+        self.state_server.snapshot_executor.shutdown()
+        self.loop.close()
+
+    def sent_messages(self):
+        """Returns the recipients, sender, message type and body of the datagrams sent upstream, except controls."""
+        messages = []
+        for data in self.upstream.sent:
+            dg = Datagram()
+            dg.add_bytes(data)
+            dgi = dg.iterator()
+            channels = [dgi.get_channel() for _ in range(dgi.get_uint8())]
+            if channels == [CONTROL_MESSAGE]:
+                continue
+            sender = dgi.get_channel()
+            messages.append((channels, sender, dgi.get_uint16(), dgi.remaining_bytes()))
+        return messages
+
+
+class TestObjectChannels(StateServerTestCase):
+    def test_participant_on_object_channel(self):
+        state_server = self.state_server
+        participant = MDParticipant(state_server)
+
+        state_server.claim_object_channel(5000)
+        state_server.subscribe_channel(participant, 5000)
+        state_server.unsubscribe_channel(participant, 5000)
+        self.assertEqual(self.upstream.subscriptions, [('+', 5000)])
+        self.assertIn(5000, state_server.local_channels)
+
+        state_server.unwatch_channel(5000)
+        self.assertEqual(self.upstream.subscriptions, [('+', 5000), ('-', 5000)])
+        self.assertNotIn(5000, state_server.local_channels)
+
+    def test_object_on_participant_channel(self):
+        state_server = self.state_server
+        participant = MDParticipant(state_server)
+
+        state_server.subscribe_channel(participant, 5000)
+        state_server.watch_channel(5000)
+        state_server.unsubscribe_channel(participant, 5000)
+        self.assertEqual(self.upstream.subscriptions, [('+', 5000)])
+
+        state_server.unwatch_channel(5000)
+        self.assertEqual(self.upstream.subscriptions, [('+', 5000), ('-', 5000)])
+
+
+class TestDispatchInternal(StateServerTestCase):
+    def add_objects(self, *do_ids):
+        for do_id in do_ids:
+            self.state_server.objects[do_id] = ObjectRecorder(do_id)
+
+    def dispatch(self, recipients):
+        dg = Datagram()
+        dg.add_server_header(recipients, 1000, STATESERVER_OBJECT_UPDATE_FIELD)
+        dg.add_uint32(7)
+        self.state_server.route_datagram(None, dg)
+
+    def received(self):
+        return {do_id: obj.received for do_id, obj in self.state_server.objects.items() if obj.received}
+
+    def test_children_fan_out(self):
+        state_server = self.state_server
+        self.add_objects(10, 20, 21, 30)
+        state_server.add_child(10, 20)
+        state_server.add_child(10, 21)
+
+        # 20 is a recipient by itself and as a child of 10, it gets the datagram once.
+        self.dispatch([parent_to_children(10), 20, 30])
+        message = [(1000, STATESERVER_OBJECT_UPDATE_FIELD, 7)]
+        self.assertEqual(self.received(), {20: message, 21: message, 30: message})
+
+    def test_children_channel_aliases(self):
+        # A parent whose id has the children bit set shares its children channel with another parent, and the
+        # channel is the parent's own do_id too.
+        state_server = self.state_server
+        parent = parent_to_children(10)
+        self.assertEqual(parent_to_children(parent), parent)
+
+        self.add_objects(parent, 20, 40, 50)
+        state_server.add_child(10, 20)
+        state_server.add_child(parent, 40)
+        self.assertEqual(self.upstream.subscriptions, [('+', parent)])
+
+        self.dispatch([parent])
+        self.assertEqual(set(self.received()), {parent, 20, 40})
+
+        state_server.remove_child(10, 20)
+        self.dispatch([parent])
+        self.assertEqual(len(state_server.objects[20].received), 1)
+        self.assertEqual(len(state_server.objects[40].received), 2)
+        self.assertEqual(self.upstream.subscriptions, [('+', parent)])
+
+        state_server.remove_child(parent, 40)
+        self.assertEqual(self.upstream.subscriptions, [('+', parent), ('-', parent)])
+
+
+class TestShardQueryExpiry(StateServerTestCase):
+    def test_done_is_sent_when_a_shard_never_answers(self):
+        state_server = self.state_server
+        state_server.SHARDS = 3
+        state_server.SHARD_QUERY_TIMEOUT = 0.01
+
+        done = Datagram()
+        done.add_server_header([2000000001], 4618, STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE)
+        done.add_uint16(5)
+        done.add_uint32(9)
+        state_server.query_shards(2000000001, 4618, [300000, 300001, 300004], done)
+        self.assertEqual(len(self.upstream.sent), 2)
+
+        state_server.shard_query_done(0)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.upstream.sent[-1], done.bytes())
+        self.assertFalse(state_server.shard_queries)
+
+        # The other shard answering late doesn't send DONE again.
+        state_server.shard_query_done(0)
+        self.assertEqual(len(self.upstream.sent), 3)
+
+    def test_large_queries_are_split(self):
+        state_server = self.state_server
+        state_server.SHARDS = 3
+        state_server.SHARD_QUERY_SIZE = 2
+
+        done = Datagram()
+        done.add_server_header([2000000001], 4618, STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE)
+        do_ids = [300001 + 3 * i for i in range(5)] + [300002]
+        state_server.query_shards(2000000001, 4618, do_ids, done)
+
+        queried = [body[16:] for _, _, _, body in self.sent_messages()]
+        self.assertEqual([len(body) // 4 for body in queried], [2, 2, 1, 1])
+        self.assertEqual(b''.join(queried), b''.join(value(do_id) for do_id in do_ids))
+
+        # DONE waits for the answer to every query.
+        for _ in queried[:-1]:
+            state_server.shard_query_done(0)
+        self.assertEqual(len(self.upstream.sent), 4)
+        state_server.shard_query_done(0)
+        self.assertEqual(self.upstream.sent[-1], done.bytes())
+        self.assertFalse(state_server.shard_queries)
+
+
+class TestEncodedFields(StateServerTestCase):
+    def setUp(self):
+        StateServerTestCase.setUp(self)
+        state_server = self.state_server
+        dclass = state_server.dc_file.namespace['Toon']
+        self.fields = state_server.dclass_tables[dclass.number].by_name
+        required = {'setName': value(1), 'setSecret': value(2), 'setAi': value(3)}
+        ram = {'setPos': value(4), 'setHp': value(5)}
+        self.obj = DistributedObject(state_server, STATESERVERS_CHANNEL, 100000, 4618, 2, dclass, required, ram,
+                                     announce=False)
+
+    def location_entry(self):
+        dg = Datagram()
+        self.obj.append_location_entry(dg)
+        return dg.bytes()
+
+    def ai_entry(self):
+        dg = Datagram()
+        self.obj.append_required_data(dg, False, False)
+        self.obj.append_other_data(dg, False, False)
+        return dg.bytes()
+
+    def update(self, name, *values):
+        dg = Datagram()
+        dg.add_uint16(self.fields[name].number)
+        for number in values:
+            dg.add_bytes(value(number))
+        self.obj.handle_one_update(dg.iterator(), 4003)
+
+    def test_updates_are_re_encoded(self):
+        location, ai = self.location_entry(), self.ai_entry()
+        self.assertEqual((self.location_entry(), self.ai_entry()), (location, ai))
+
+        # A molecular update changes a required and a RAM field, every view sees both.
+        self.update('setNamePos', 10, 11)
+        location = self.location_entry()
+        self.assertIn(value(10), location)
+        self.assertIn(self.fields['setPos'].number.to_bytes(2, byteorder='little') + value(11), location)
+        self.assertNotIn(value(1), location)
+        self.assertIn(value(10), self.ai_entry())
+
+        # A field clients don't see only changes the AI encoding.
+        self.update('setHp', 12)
+        self.assertEqual(self.location_entry(), location)
+        self.assertIn(self.fields['setHp'].number.to_bytes(2, byteorder='little') + value(12), self.ai_entry())
+
+
+class TestDatabaseObjects(StateServerTestCase):
+    def test_activate_with_other_data(self):
+        state_server = self.state_server
+        protocol = StateServerProtocol(state_server)
+        table = state_server.dclass_tables[state_server.dc_file.namespace['Toon'].number]
+        fields = table.by_name
+
+        dg = Datagram()
+        dg.add_server_header([STATESERVERS_CHANNEL], 4003, STATESERVER_OBJECT_CREATE_WITH_REQUIR_OTHER_CONTEXT)
+        dg.add_uint32(100000)
+        dg.add_uint32(4618)
+        dg.add_uint32(2)
+        dg.add_channel(2000000001)
+        dg.add_uint16(table.number)
+        dg.add_uint16(2)
+        dg.add_uint16(fields['setName'].number)
+        dg.add_bytes(value(77))
+        dg.add_uint16(fields['setPos'].number)
+        dg.add_bytes(value(5))
+        dgi = dg.iterator()
+        dgi.get_uint8()
+        dgi.get_channel()
+        protocol.handle_datagram(dg, dgi)
+
+        # The database is asked for the stored fields of the class.
+        _, sender, msg_type, body = self.sent_messages()[-1]
+        self.assertEqual(msg_type, DBSERVER_GET_STORED_VALUES)
+        self.assertEqual(body[8:10], (1).to_bytes(2, byteorder='little'))
+        self.assertEqual(body[10:12], fields['setName'].number.to_bytes(2, byteorder='little'))
+
+        resp = Datagram()
+        resp.add_server_header([STATESERVERS_CHANNEL], 4003, DBSERVER_GET_STORED_VALUES_RESP)
+        resp.add_uint32(1)
+        resp.add_uint32(100000)
+        resp.add_uint16(3)
+        for name, number in (('setName', 1), ('setSecret', 2), ('setAi', 3)):
+            resp.add_uint16(fields[name].number)
+            resp.add_bytes(value(number))
+        dgi = resp.iterator()
+        dgi.get_uint8()
+        dgi.get_channel()
+        self.upstream.sent.clear()
+        protocol.handle_datagram(resp, dgi)
+
+        # The other data overrides the stored value and the DB field is written back.
+        obj = state_server.objects[100000]
+        self.assertIn(100000, state_server.database_objects)
+        self.assertEqual(obj.required, {'setName': value(77), 'setSecret': value(2), 'setAi': value(3)})
+        self.assertEqual(obj.ram, {'setPos': value(5)})
+
+        stored = [body for _, sender, msg_type, body in self.sent_messages() if msg_type == DBSERVER_SET_STORED_VALUES]
+        self.assertEqual(stored, [value(100000) + (1).to_bytes(2, byteorder='little') +
+                                  fields['setName'].number.to_bytes(2, byteorder='little') + value(77)])
+
+
+class TestAiChange(StateServerTestCase):
+    def test_ai_is_pushed_down(self):
+        state_server = self.state_server
+        state_server.SHARDS = 3
+        dclass = state_server.dc_file.namespace['DistributedDirectory']
+
+        def generate(do_id, parent_id):
+            obj = DistributedObject(state_server, STATESERVERS_CHANNEL, do_id, parent_id, 2, dclass, {}, {},
+                                    announce=False)
+            state_server.objects[do_id] = obj
+            if parent_id in state_server.objects:
+                state_server.objects[parent_id].zone_objects.setdefault(2, set()).add(do_id)
+            return obj
+
+        root = generate(300000, 4618)
+        child = generate(300003, 300000)
+        grandchild = generate(300006, 300003)
+        explicit = generate(300009, 300000)
+        explicit.handle_ai_change(8888, STATESERVERS_CHANNEL, True)
+        # 300001 lives on another shard, 300012 belongs to this one but was deleted.
+        root.zone_objects[2].update((300001, 300012))
+        self.upstream.sent.clear()
+
+        root.handle_ai_change(7777, STATESERVERS_CHANNEL, True)
+        self.assertEqual((child.ai_channel, grandchild.ai_channel, explicit.ai_channel), (7777, 7777, 8888))
+        self.assertEqual(state_server.ai_objects[7777], {300000, 300003, 300006})
+
+        notified = [(channels, body) for channels, _, msg_type, body in self.sent_messages()
+                    if msg_type == STATESERVER_OBJECT_NOTIFY_MANAGING_AI]
+        self.assertEqual(notified, [([300001], value(300000) + (7777).to_bytes(8, byteorder='little'))])
+
+
+class TestShards(unittest.IsolatedAsyncioTestCase):
+    PORT = 57114
+    SHARDS = 3
+    DISTRICT = 200001
+    ZONES = (1000, 1001)
+
+    async def asyncSetUp(self):
+        loop = asyncio.get_running_loop()
+        self.md = MasterMessageDirector(loop)
+        self.tasks = [loop.create_task(self.md.listen(HOST, self.PORT))]
+        await self.wait_for(lambda: self.md._server is not None and self.md._server.is_serving())
+
+        self.shards = []
+        for shard in range(self.SHARDS):
+            state_server = FixtureStateServer(loop, shard)
+            state_server.SHARDS = self.SHARDS
+            state_server.snapshot_path = None
+            await state_server.connect(HOST, self.PORT)
+            self.tasks.append(loop.create_task(state_server.route()))
+            self.shards.append(state_server)
+
+        self.client = ServiceRecorder(loop, 2000000001)
+        self.ai = ServiceRecorder(loop, 7777)
+        await self.client.run(self.PORT)
+        await self.ai.run(self.PORT)
+        self.dclass = self.shards[0].dc_file.namespace['DistributedDirectory'].number
+
+    async def asyncTearDown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for state_server in self.shards:
+            state_server.snapshot_executor.shutdown()
+
+    async def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('timed out')
+
+    def owner(self, do_id):
+        return self.shards[do_id % self.SHARDS]
+
+    def generate(self, parent_id, zone_id, do_id):
+        dg = Datagram()
+        dg.add_server_header([STATESERVERS_CHANNEL], self.client.channel, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED)
+        dg.add_uint32(parent_id)
+        dg.add_uint32(zone_id)
+        dg.add_uint16(self.dclass)
+        dg.add_uint32(do_id)
+        self.client.send_datagram(dg)
+
+    def set_ai(self, do_id, ai_channel):
+        dg = Datagram()
+        dg.add_server_header([STATESERVERS_CHANNEL], self.ai.channel, STATESERVER_ADD_AI_RECV)
+        dg.add_uint32(do_id)
+        dg.add_channel(ai_channel)
+        self.ai.send_datagram(dg)
+
+    def query_zones(self, service):
+        service.received.clear()
+        dg = Datagram()
+        dg.add_server_header([self.DISTRICT], service.channel, STATESERVER_QUERY_ZONE_OBJECT_ALL)
+        dg.add_uint16(5)
+        dg.add_uint32(9)
+        dg.add_uint32(self.DISTRICT)
+        for zone in self.ZONES:
+            dg.add_uint32(zone)
+        service.send_datagram(dg)
+
+    async def test_district(self):
+        # The district lives on another shard than the root object, its children are spread over all of them.
+        self.generate(4618, 2, self.DISTRICT)
+        await self.wait_for(lambda: self.DISTRICT in self.owner(self.DISTRICT).objects)
+        self.set_ai(self.DISTRICT, 7777)
+        await self.wait_for(lambda: self.owner(self.DISTRICT).objects[self.DISTRICT].ai_channel == 7777)
+
+        do_ids = list(range(300000, 300012))
+        for do_id in do_ids:
+            self.generate(self.DISTRICT, self.ZONES[do_id % 2], do_id)
+        await self.wait_for(lambda: all(do_id in self.owner(do_id).objects for do_id in do_ids))
+
+        for do_id in do_ids + [self.DISTRICT]:
+            self.assertEqual([shard.shard for shard in self.shards if do_id in shard.objects], [do_id % self.SHARDS])
+
+        # Children ask the district's shard for their AI (QUERY_MANAGING_AI) and hear about changes to it
+        # (NOTIFY_MANAGING_AI).
+        await self.wait_for(lambda: all(self.owner(do_id).objects[do_id].ai_channel == 7777 for do_id in do_ids))
+        self.set_ai(self.DISTRICT, 8888)
+        await self.wait_for(lambda: all(self.owner(do_id).objects[do_id].ai_channel == 8888 for do_id in do_ids))
+
+        # The client gets bundles from every shard and DONE after all of them.
+        self.query_zones(self.client)
+        await self.wait_for(lambda: self.client.received and
+                            self.client.received[-1][1] == STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE)
+        entries = []
+        for sender, msg_type, body in self.client.received[:-1]:
+            self.assertEqual(msg_type, STATESERVER_OBJECT_ENTERZONE_BUNDLE)
+            dg = Datagram()
+            dg.add_bytes(body)
+            dgi = dg.iterator()
+            while dgi.remaining():
+                entry = dgi.get_bytes(dgi.get_uint16())
+                entries.append(int.from_bytes(entry[1:5], byteorder='little'))
+        self.assertEqual(sorted(entries), [self.DISTRICT] + do_ids)
+
+        # Anyone else gets the entries one by one.
+        self.query_zones(self.ai)
+        await self.wait_for(lambda: self.ai.received and
+                            self.ai.received[-1][1] == STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE)
+        self.assertEqual(sorted(sender for sender, _, _ in self.ai.received[:-1]), [self.DISTRICT] + do_ids)
+        self.assertEqual({msg_type for _, msg_type, _ in self.ai.received[:-1]},
+                         {STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER})
+
+
+class TestSnapshots(StateServerTestCase):
+    def setUp(self):
+        StateServerTestCase.setUp(self)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = self.state_server.snapshot_path = os.path.join(directory.name, 'StateServer-0.snapshot')
+
+    def snapshot_of(self, ai_channels):
+        """Returns a snapshot of objects with the AI channels, taken by another state server."""
+        source = FixtureStateServer(self.loop)
+        self.addCleanup(source.snapshot_executor.shutdown)
+        source._client = UpstreamRecorder()
+        dclass = source.dc_file.namespace['DistributedDirectory']
+
+        for do_id, ai_channel in ai_channels.items():
+            obj = DistributedObject(source, STATESERVERS_CHANNEL, do_id, 4618, 2, dclass, {}, {}, announce=False)
+            obj.set_ai_channel(ai_channel)
+            source.objects[do_id] = obj
+
+        return source
+
+    def test_slices_encode_the_same_snapshot(self):
+        source = self.snapshot_of({300000 + i: None for i in range(5)})
+        source.SNAPSHOT_SLICE = 2
+        data = self.loop.run_until_complete(source.encode_snapshot_slices())
+        self.assertEqual(data[HEADER.size:], source.encode_snapshot()[HEADER.size:])
+        self.assertEqual(HEADER.unpack_from(data, 0)[3], 5)
+
+    def test_objects_of_dead_ais_are_deleted(self):
+        source = self.snapshot_of({300000: 7777, 300001: 8888, 300002: None})
+        write_snapshot(self.path, source.encode_snapshot())
+
+        self.state_server.restore_snapshot()
+        self.assertTrue({300000, 300001, 300002} <= self.state_server.objects.keys())
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        # The MD says only 7777 is still subscribed to.
+        query = Datagram()
+        query.add_bytes(self.upstream.sent[-1])
+        dgi = query.iterator()
+        dgi.seek(1 + 8 + 2)
+        context = dgi.get_uint32()
+        self.assertEqual(sorted(dgi.get_channel() for _ in range(dgi.get_uint16())), [7777, 8888])
+
+        reply = Datagram()
+        reply.add_uint32(context)
+        reply.add_uint16(1)
+        reply.add_channel(7777)
+        self.assertTrue(self.upstream.futures.resolve(reply.iterator(), CONTROL_SUBSCRIBED_CHANNELS, CONTROL_MESSAGE))
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertIn(300000, self.state_server.objects)
+        self.assertNotIn(300001, self.state_server.objects)
+        self.assertIn(300002, self.state_server.objects)
+        self.assertEqual(set(self.state_server.ai_objects), {7777})
+
+    def test_old_snapshot_is_not_restored(self):
+        source = self.snapshot_of({300000: None})
+        write_snapshot(self.path, source.encode_snapshot())
+        self.state_server.SNAPSHOT_MAX_AGE = 1e-9
+
+        self.state_server.restore_snapshot()
+        self.assertNotIn(300000, self.state_server.objects)
+
+    def test_malformed_snapshot_is_moved_aside(self):
+        data = self.snapshot_of({300000: None}).encode_snapshot()
+        write_snapshot(self.path, data[:-3])
+
+        self.state_server.restore_snapshot()
+        self.assertNotIn(300000, self.state_server.objects)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(self.path + '.bad'))
+
+    def test_other_version_is_ignored(self):
+        write_snapshot(self.path, HEADER.pack(MAGIC, VERSION + 1, 0, 0, 0.0))
+        self.state_server.restore_snapshot()
+        self.assertTrue(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()